@@ -1,10 +1,16 @@
  
 import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 import torch.nn.init as init
 import torch.nn.functional as F
-import numpy as np
 import torch.nn as nn
 import torch
+import torch.utils.checkpoint
+from torch.autograd.function import once_differentiable
+from torch.nn.modules.utils import _pair
+from torch.overrides import TorchFunctionMode
 from ultralytics.nn.modules.conv import Conv, autopad
  
 
@@ -34,18 +40,159 @@ class C2f(nn.Module):
         self.cv2 = Conv((2 + n) * self.c, c2, 1)  # optional act=FReLU(c2)
         self.m = nn.ModuleList(Bottleneck(self.c, self.c, shortcut, g, k=((3, 3), (3, 3)), e=1.0) for _ in range(n))
 
+    checkpoint = False  # recompute the block in backward instead of keeping its activations, see set_checkpoint
+    # concat buffers kept per block for the inference path, 0 disables it. They are full-size block activations
+    # and stay allocated until clear_buffers() / clear_concat_buffers(model) or train()
+    concat_buffers = 4
+    _buffers_cache = None
+    _buffers_lock = threading.Lock()  # the cache is shared by every thread running the model (serve.py, tiling)
+
     def forward(self, x):
         """Forward pass through C2f layer."""
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(self.forward_chunk, x, use_reentrant=False,
+                                                     context_fn=lambda: (nullcontext(), frozen_bn_stats(self)))
+        if self.concat_buffers and not torch.is_grad_enabled() and not is_tracing():
+            return self.forward_buffer(x)
+        return self.forward_chunk(x)
+
+    def forward_buffer(self, x):
+        """Inference forward without the final torch.cat.
+
+        cv1 and every bottleneck write their output straight into channel slices of one (2 + n) * c buffer, which is
+        reused by later calls with the same input shape.
+        """
+        c = self.c
+        buf = self.concat_buffer(x, (2 + len(self.m)) * c)
+        forward_into(self.cv1, x, buf[:, :2 * c])
+        for i, m in enumerate(self.m):
+            forward_into(m, buf[:, (i + 1) * c:(i + 2) * c], buf[:, (i + 2) * c:(i + 3) * c])
+        return self.cv2(buf)
+
+    def concat_buffer(self, x, channels):
+        # same dtype as the conv outputs written into it (the autocast dtype under autocast) and same layout as x
+        dtype = autocast_dtype(x.device) or x.dtype
+        fmt = torch.channels_last if not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last) \
+            else torch.contiguous_format
+        key = (threading.get_ident(), tuple(x.shape), dtype, fmt, x.device, torch.is_inference_mode_enabled())
+        with self._buffers_lock:
+            buf = self._buffers_cache.pop(key, None) if self._buffers_cache else None
+        if buf is None:
+            h, w = self.cv1_output_size(x)
+            buf = torch.empty(x.shape[0], channels, h, w, dtype=dtype, device=x.device, memory_format=fmt)
+        with self._buffers_lock:
+            if self._buffers_cache is None:
+                self._buffers_cache = OrderedDict()
+            self._buffers_cache[key] = buf
+            while len(self._buffers_cache) > self.concat_buffers:
+                self._buffers_cache.popitem(last=False)
+        return buf
+
+    def clear_buffers(self):
+        """Release the concat buffers of the inference path, they are allocated again on the next forward."""
+        with self._buffers_lock:
+            self._buffers_cache = None
+
+    def cv1_output_size(self, x):
+        conv = self.cv1.conv if hasattr(self.cv1, 'conv') else None
+        if conv is None or conv.kernel_size != (1, 1) or conv.stride != (1, 1):
+            return self.cv1(x[:1, :, :, :]).shape[2:]  # not the usual 1x1 cv1, probe it once per shape
+        return x.shape[2:]
+
+    def train(self, mode=True):
+        self.clear_buffers()
+        return super().train(mode)
+
+    def __getstate__(self):
+        state = dict(super().__getstate__() if hasattr(super(), '__getstate__') else self.__dict__)
+        state.pop('_buffers_cache', None)  # never pickle the concat buffers into checkpoints
+        return state
+
+    def forward_chunk(self, x):
+        """Forward pass using chunk()."""
         y = list(self.cv1(x).chunk(2, 1))
         y.extend(m(y[-1]) for m in self.m)
         return self.cv2(torch.cat(y, 1))
 
     def forward_split(self, x):
         """Forward pass using split() instead of chunk()."""
+        if self.concat_buffers and not torch.is_grad_enabled() and not is_tracing():
+            return self.forward_buffer(x)
         y = list(self.cv1(x).split((self.c, self.c), 1))
         y.extend(m(y[-1]) for m in self.m)
         return self.cv2(torch.cat(y, 1))
 
+@contextmanager
+def frozen_bn_stats(module):
+    """Leave the BatchNorm running statistics of module untouched, for the recomputation pass of checkpointing."""
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, n) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(n)
+
+
+def set_checkpoint(model, layers=True):
+    """Turn activation checkpointing of the C2f-family blocks (C3k2, C3k2_OREPA) of model on or off.
+
+    layers is True / False for all blocks or a list of YAML layer indices. Checkpointed blocks keep only their input
+    for backward and recompute everything else, OREPA kernel generation included. Returns the enabled layer indices.
+    """
+    enabled = []
+    for m in model.modules():
+        if isinstance(m, C2f):
+            m.checkpoint = layers is True or (not isinstance(layers, bool) and getattr(m, 'i', None) in layers)
+            if m.checkpoint:
+                enabled.append(getattr(m, 'i', None))
+    return enabled
+
+
+def clear_concat_buffers(model):
+    """Release the inference concat buffers of every C2f-family block of model (see C2f.concat_buffers)."""
+    for m in model.modules():
+        if isinstance(m, C2f):
+            m.clear_buffers()
+    return model
+
+def is_tracing():
+    return torch.jit.is_tracing() or torch.jit.is_scripting() or torch.compiler.is_compiling()
+
+
+ACT_OUT = {nn.SiLU: torch.ops.aten.silu.out, nn.Hardswish: torch.ops.aten.hardswish.out,
+           nn.Hardsigmoid: torch.ops.aten.hardsigmoid.out}
+
+
+def forward_into(m, x, out):
+    """Compute m(x) into out, typically a channel slice of a concat buffer.
+
+    The last elementwise op of Conv / OREPA layers (the activation) and of bottlenecks (the shortcut add) writes into
+    out directly, any other module falls back to a copy.
+    """
+    if isinstance(m, Bottleneck):
+        if m.add:
+            return torch.add(x, m.cv2(m.cv1(x)), out=out)
+        return forward_into(m.cv2, m.cv1(x), out)
+    if isinstance(m, C3):
+        return forward_into(m.cv3, torch.cat((m.m(m.cv1(x)), m.cv2(x)), 1), out)
+    if isinstance(m, Conv) and m.forward == m.forward_fuse:
+        act, y = m.act, m.conv(x)
+    elif isinstance(m, Conv) and type(m).forward is Conv.forward:
+        act, y = m.act, m.bn(m.conv(x))
+    elif isinstance(m, OREPA) and hasattr(m, 'orepa_reparam'):
+        act, y = m.nonlinear, m.orepa_reparam(x)
+    else:
+        return out.copy_(m(x))
+    op = ACT_OUT.get(type(act))
+    if op is not None:
+        return op(y, out=out)
+    return out.copy_(act(y))
+
+
 class C3k2(C2f):
     """Faster Implementation of CSP Bottleneck with 2 convolutions."""
 
@@ -118,12 +265,200 @@ class SEAttention(nn.Module):
         y = self.fc(y).view(b, c, 1, 1)
         return x * y.expand_as(x)
  
+def autocast_dtype(device):
+    """dtype autocast casts conv inputs to on device, or None when autocast is off."""
+    return torch.get_autocast_dtype(device.type) if torch.is_autocast_enabled(device.type) else None
+
+
+def identity_kernel(rows, cols, like):
+    """rows x cols x 1 x 1 kernel with a one at [i, i % cols]: the identity added to the 1x1-kxk branch's 1x1 conv."""
+    i = torch.arange(rows, device=like.device)
+    kernel = torch.zeros(rows, cols, 1, 1, dtype=like.dtype, device=like.device)
+    kernel[i, i % cols] = 1
+    return kernel
+
+
+def frequency_prior(channels, kernel_size):
+    """Prior of the pfir branch: a 3x3 cosine basis along h for the first half of the channels and along w for the
+    second half, in the top-left 3x3 of the kernel (computed in float64 like the scalar math.cos it replaces)."""
+    i = torch.arange(channels, dtype=torch.float64).view(-1, 1, 1)
+    h = torch.arange(3, dtype=torch.float64).view(1, -1, 1)
+    w = h.view(1, 1, -1)
+    half = channels / 2
+    prior = torch.zeros(channels, kernel_size, kernel_size)
+    prior[:, :3, :3] = torch.where(i < half, torch.cos(math.pi * (h + 0.5) * (i + 1) / 3),
+                                   torch.cos(math.pi * (w + 0.5) * (i + 1 - half) / 3))
+    return prior
+
+
+_deploy_construction = False
+
+
+class _DeployConstruction(TorchFunctionMode):
+    """Makes every torch.nn.init call a no-op and convolutions return uninitialized outputs of the right shape.
+
+    The weights are about to be replaced, so the only forward run at construction, DetectionModel's stride probe,
+    needs the output shapes alone (computed here, as meta tensors would import sympy on first use).
+    """
+
+    @staticmethod
+    def conv2d_shape(x, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
+        if isinstance(padding, str):
+            return None
+        size = [(n + 2 * p - d * (k - 1) - 1) // s + 1 for n, k, s, p, d in
+                zip(x.shape[-2:], weight.shape[-2:], _pair(stride), _pair(padding), _pair(dilation))]
+        return (*x.shape[:-3], weight.shape[0], *size)
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if getattr(func, '__module__', None) == 'torch.nn.init':
+            return args[0] if args else next(iter(kwargs.values()))
+        if func is torch.conv2d:
+            shape = self.conv2d_shape(*args, **kwargs)
+            if shape is not None:
+                return torch.empty(shape, dtype=args[0].dtype, device=args[0].device)
+        return func(*args, **kwargs)
+
+
+def constructing_deploy():
+    """True inside deploy_construction()."""
+    return _deploy_construction
+
+
+@contextmanager
+def deploy_construction():
+    """Build modules in their fused form, for weights that are loaded right after (see reparam.load_fused).
+
+    OREPA, OREPA_LargeConv, OREPA_3x3_RepVGG and ConvBN created inside behave as if deploy=True was passed, DSConv2D
+    is created as its fused conv, torch.nn.init calls are skipped and convolutions only infer their output shape:
+    no training branch is allocated, no weight is initialized only to be overwritten and the stride probe computes
+    nothing. Weights stay uninitialized memory until a state dict is loaded.
+    """
+    global _deploy_construction
+    previous, _deploy_construction = _deploy_construction, True
+    try:
+        with _DeployConstruction():
+            yield
+    finally:
+        _deploy_construction = previous
+
+
+class CachedWeightGen:
+    """Mixin memoizing weight_gen() while the module is not training.
+
+    The cache is keyed on the storage and version counter of every parameter and buffer, so optimizer steps,
+    load_state_dict, .to()/.half() and any other in-place update invalidate it; train()/eval() drop it explicitly.
+
+    The kernel is always generated in the parameter dtype with autocast disabled, so bf16 / fp16 autocast does not
+    run the einsum / bmm branch algebra in low precision; conv casts the finished kernel. Outside training the cast
+    kernel is what gets cached, once per autocast dtype.
+    """
+
+    _weight_cache = None
+
+    def _weight_key(self, dtype):
+        return tuple((t.data_ptr(), t._version) for t in (*self.parameters(), *self.buffers())) + (
+            torch.is_inference_mode_enabled(), dtype)
+
+    def get_weight(self):
+        """weight_gen(), reused across eval/inference forwards as long as no parameter changed."""
+        t = next(self.parameters(), None)
+        if t is None:
+            t = next(self.buffers(), None)
+        device = t.device if t is not None else torch.device('cpu')
+        if self.training or (torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters())):
+            with torch.autocast(device.type, enabled=False):
+                return self.weight_gen()
+        dtype = autocast_dtype(device)
+        key = self._weight_key(dtype)
+        if self._weight_cache is None or self._weight_cache[0] != key:
+            with torch.no_grad(), torch.autocast(device.type, enabled=False):
+                weight = self.weight_gen()
+            self._weight_cache = (key, weight if dtype is None or not weight.is_floating_point() else weight.to(dtype))
+        return self._weight_cache[1]
+
+    def train(self, mode=True):
+        self._weight_cache = None
+        return super().train(mode)
+
+    def __getstate__(self):
+        state = super().__getstate__() if hasattr(super(), '__getstate__') else self.__dict__.copy()
+        state = dict(state)
+        state.pop('_weight_cache', None)  # never pickle the cached kernel into checkpoints
+        return state
+
 def transVI_multiscale(kernel, target_kernel_size):
     H_pixels_to_pad = (target_kernel_size - kernel.size(2)) // 2
     W_pixels_to_pad = (target_kernel_size - kernel.size(3)) // 2
     return F.pad(kernel, [W_pixels_to_pad, W_pixels_to_pad, H_pixels_to_pad, H_pixels_to_pad])
  
-class OREPA(nn.Module):
+class OREPAWeightGen(torch.autograd.Function):
+    """OREPA kernel generation with analytic branch gradients.
+
+    forward runs OREPA._weight_gen without building a graph and saves only the leaf parameters; backward maps the
+    gradient of the generated kernel back onto every branch, so no intermediate branch kernel outlives the forward.
+    """
+
+    @staticmethod
+    def forward(ctx, module, *leaves):
+        ctx.module = module
+        ctx.save_for_backward(*leaves)
+        return module._weight_gen()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad):
+        m = ctx.module
+        v, origin, avg_conv, pfir_conv, w1x1, conv1, conv2, dw, pw = ctx.saved_tensors
+        o, g, k = m.out_channels, m.groups, m.kernel_size
+        grad = grad.to(v.dtype)
+        G = grad.flatten(2)  # [o, i/g, k*k]
+        dv = torch.empty_like(v)
+
+        # origin: vector[0] * weight_orepa_origin
+        d_origin = grad * v[0].view(-1, 1, 1, 1)
+        dv[0] = torch.linalg.vecdot(G.flatten(1), origin.flatten(1))
+
+        # avg, prior and 1x1: [i, b] factors times [b, k*k] patterns scaled by vector[1, 2, 4]
+        center = torch.zeros(k * k, dtype=v.dtype, device=v.device)
+        center[k * k // 2] = 1
+        patterns = torch.stack((m.weight_orepa_avg_avg.expand(o, k, k).flatten(1), m.weight_orepa_prior.flatten(1),
+                                center.expand(o, k * k)), 1)
+        factors = torch.stack((avg_conv.flatten(1), pfir_conv.flatten(1), w1x1.flatten(1)), 2)
+        d_factors = torch.bmm(G, (patterns * v[[1, 2, 4]].t()[:, :, None]).transpose(1, 2))
+        dv[[1, 2, 4]] = (torch.bmm(factors.transpose(1, 2), G) * patterns).sum(2).t()
+
+        # 1x1-kxk: per group, conv1 [t, i] followed by conv2 [o, t, k*k] scaled by vector[3]
+        C1 = conv1.flatten(1)
+        if hasattr(m, 'weight_orepa_1x1_kxk_idconv1'):
+            C1 = C1 + m.id_tensor.flatten(1)
+        t, ig = C1.shape
+        Gg = G.view(g, o // g, ig, k * k)
+        C1g = C1.view(g, t // g, ig)
+        C2g = conv2.view(g, o // g, t // g, k * k)
+        v3 = v[3].view(g, o // g, 1, 1)
+        H = torch.einsum('gti,goip->gotp', C1g, Gg)
+        d_conv2 = (H * v3).reshape_as(conv2)
+        dv[3] = torch.linalg.vecdot(H.flatten(2), C2g.flatten(2)).flatten()
+        d_conv1 = torch.einsum('gotp,goip->gti', C2g, Gg * v3).reshape_as(conv1)
+
+        # depthwise-separable: see dwsc2full, output channel c * o/g + j uses row j of weight_pw viewed [o/g, g, ...]
+        e = dw.shape[0] // m.in_channels
+        DW = dw.view(g, m.in_channels // g, e, k * k)
+        PW = pw.view(o // g, g, m.in_channels // g, e).transpose(0, 1)
+        v5 = v[5].view(g, o // g, 1, 1)
+        E = torch.einsum('cojp,cjtp->cojt', Gg, DW)
+        d_pw = (E * v5).transpose(0, 1).reshape_as(pw)
+        dv[5] = (E * PW).sum((2, 3)).flatten()
+        d_dw = torch.einsum('cojt,cojp->cjtp', PW * v5, Gg).reshape_as(dw)
+
+        if v.shape[0] > 6:
+            dv[6:] = 0
+        return (None, dv, d_origin, d_factors[..., 0].view_as(avg_conv), d_factors[..., 1].view_as(pfir_conv),
+                d_factors[..., 2].view_as(w1x1), d_conv1, d_conv2, d_dw, d_pw)
+ 
+ 
+class OREPA(CachedWeightGen, nn.Module):
     def __init__(self,
                  in_channels,
                  out_channels,
@@ -139,7 +474,7 @@ class OREPA(nn.Module):
                  weight_only=False,
                  init_hyper_para=1.0, init_hyper_gamma=1.0):
         super(OREPA, self).__init__()
-        self.deploy = deploy
+        self.deploy = deploy = deploy or _deploy_construction
  
         self.nonlinear = Conv.default_act if act is True else act if isinstance(act, nn.Module) else nn.Identity()
         self.weight_only = weight_only
@@ -162,15 +497,15 @@ class OREPA(nn.Module):
  
             self.branch_counter = 0
  
-            self.weight_orepa_origin = nn.Parameter(torch.Tensor(out_channels, int(in_channels / self.groups), kernel_size, kernel_size))
+            self.weight_orepa_origin = nn.Parameter(torch.empty(out_channels, int(in_channels / self.groups), kernel_size, kernel_size))
             init.kaiming_uniform_(self.weight_orepa_origin, a=math.sqrt(0.0))
             self.branch_counter += 1
  
             self.weight_orepa_avg_conv = nn.Parameter(
-                torch.Tensor(out_channels, int(in_channels / self.groups), 1,
+                torch.empty(out_channels, int(in_channels / self.groups), 1,
                             1))
             self.weight_orepa_pfir_conv = nn.Parameter(
-                torch.Tensor(out_channels, int(in_channels / self.groups), 1,
+                torch.empty(out_channels, int(in_channels / self.groups), 1,
                             1))
             init.kaiming_uniform_(self.weight_orepa_avg_conv, a=0.0)
             init.kaiming_uniform_(self.weight_orepa_pfir_conv, a=0.0)
@@ -182,7 +517,7 @@ class OREPA(nn.Module):
             self.branch_counter += 1
  
             self.weight_orepa_1x1 = nn.Parameter(
-                torch.Tensor(out_channels, int(in_channels / self.groups), 1,
+                torch.empty(out_channels, int(in_channels / self.groups), 1,
                             1))
             init.kaiming_uniform_(self.weight_orepa_1x1, a=0.0)
             self.branch_counter += 1
@@ -190,32 +525,12 @@ class OREPA(nn.Module):
             if internal_channels_1x1_3x3 is None:
                 internal_channels_1x1_3x3 = in_channels if groups <= 4 else 2 * in_channels
  
-            if internal_channels_1x1_3x3 == in_channels:
-                self.weight_orepa_1x1_kxk_idconv1 = nn.Parameter(
-                    torch.zeros(in_channels, int(in_channels / self.groups), 1, 1))
-                id_value = np.zeros(
-                    (in_channels, int(in_channels / self.groups), 1, 1))
-                for i in range(in_channels):
-                    id_value[i, i % int(in_channels / self.groups), 0, 0] = 1
-                id_tensor = torch.from_numpy(id_value).type_as(
-                    self.weight_orepa_1x1_kxk_idconv1)
-                self.register_buffer('id_tensor', id_tensor)
- 
-            else:
-                self.weight_orepa_1x1_kxk_idconv1 = nn.Parameter(
-                    torch.zeros(internal_channels_1x1_3x3,
-                                int(in_channels / self.groups), 1, 1))
-                id_value = np.zeros(
-                    (internal_channels_1x1_3x3, int(in_channels / self.groups), 1, 1))
-                for i in range(internal_channels_1x1_3x3):
-                    id_value[i, i % int(in_channels / self.groups), 0, 0] = 1
-                id_tensor = torch.from_numpy(id_value).type_as(
-                    self.weight_orepa_1x1_kxk_idconv1)
-                self.register_buffer('id_tensor', id_tensor)
-                #init.kaiming_uniform_(
-                    #self.weight_orepa_1x1_kxk_conv1, a=math.sqrt(0.0))
+            self.weight_orepa_1x1_kxk_idconv1 = nn.Parameter(
+                torch.zeros(internal_channels_1x1_3x3, int(in_channels / self.groups), 1, 1))
+            self.register_buffer('id_tensor', identity_kernel(internal_channels_1x1_3x3, int(in_channels / self.groups),
+                                                              self.weight_orepa_1x1_kxk_idconv1))
             self.weight_orepa_1x1_kxk_conv2 = nn.Parameter(
-                torch.Tensor(out_channels,
+                torch.empty(out_channels,
                             int(internal_channels_1x1_3x3 / self.groups),
                             kernel_size, kernel_size))
             init.kaiming_uniform_(self.weight_orepa_1x1_kxk_conv2, a=math.sqrt(0.0))
@@ -223,15 +538,15 @@ class OREPA(nn.Module):
  
             expand_ratio = 8
             self.weight_orepa_gconv_dw = nn.Parameter(
-                torch.Tensor(in_channels * expand_ratio, 1, kernel_size,
+                torch.empty(in_channels * expand_ratio, 1, kernel_size,
                             kernel_size))
             self.weight_orepa_gconv_pw = nn.Parameter(
-                torch.Tensor(out_channels, int(in_channels * expand_ratio / self.groups), 1, 1))
+                torch.empty(out_channels, int(in_channels * expand_ratio / self.groups), 1, 1))
             init.kaiming_uniform_(self.weight_orepa_gconv_dw, a=math.sqrt(0.0))
             init.kaiming_uniform_(self.weight_orepa_gconv_pw, a=math.sqrt(0.0))
             self.branch_counter += 1
  
-            self.vector = nn.Parameter(torch.Tensor(self.branch_counter, self.out_channels))
+            self.vector = nn.Parameter(torch.empty(self.branch_counter, self.out_channels))
             if weight_only is False:
                 self.bn = nn.BatchNorm2d(self.out_channels)
  
@@ -258,81 +573,73 @@ class OREPA(nn.Module):
                 self.single_init()  
  
     def fre_init(self):
-        prior_tensor = torch.Tensor(self.out_channels, self.kernel_size,
-                                    self.kernel_size)
-        half_fg = self.out_channels / 2
-        for i in range(self.out_channels):
-            for h in range(3):
-                for w in range(3):
-                    if i < half_fg:
-                        prior_tensor[i, h, w] = math.cos(math.pi * (h + 0.5) *
-                                                         (i + 1) / 3)
-                    else:
-                        prior_tensor[i, h, w] = math.cos(math.pi * (w + 0.5) *
-                                                         (i + 1 - half_fg) / 3)
- 
-        self.register_buffer('weight_orepa_prior', prior_tensor)
+        self.register_buffer('weight_orepa_prior', frequency_prior(self.out_channels, self.kernel_size))
  
     def weight_gen(self):
-        weight_orepa_origin = torch.einsum('oihw,o->oihw',
-                                          self.weight_orepa_origin,
-                                          self.vector[0, :])
- 
-        weight_orepa_avg = torch.einsum('oihw,hw->oihw', self.weight_orepa_avg_conv, self.weight_orepa_avg_avg)
-        weight_orepa_avg = torch.einsum(
-             'oihw,o->oihw',
-             torch.einsum('oi,hw->oihw', self.weight_orepa_avg_conv.squeeze(3).squeeze(2),
-                          self.weight_orepa_avg_avg), self.vector[1, :])
- 
- 
-        weight_orepa_pfir = torch.einsum(
-            'oihw,o->oihw',
-            torch.einsum('oi,ohw->oihw', self.weight_orepa_pfir_conv.squeeze(3).squeeze(2),
-                          self.weight_orepa_prior), self.vector[2, :])
- 
-        weight_orepa_1x1_kxk_conv1 = None
+        """The equivalent kxk kernel, through OREPAWeightGen so autograd keeps only the leaf parameters."""
+        return OREPAWeightGen.apply(self, *self.weight_leaves())
+
+    def weight_leaves(self):
+        conv1 = getattr(self, 'weight_orepa_1x1_kxk_idconv1', None)
+        if conv1 is None:
+            conv1 = self.weight_orepa_1x1_kxk_conv1
+        return (self.vector, self.weight_orepa_origin, self.weight_orepa_avg_conv, self.weight_orepa_pfir_conv,
+                self.weight_orepa_1x1, conv1, self.weight_orepa_1x1_kxk_conv2, self.weight_orepa_gconv_dw,
+                self.weight_orepa_gconv_pw)
+
+    def _weight_gen(self):
+        """Generate the equivalent kxk kernel of all six branches in a single pass.
+
+        Each branch's per-channel scale vector[i] is folded into its smallest factor before expansion, the avg, prior
+        and 1x1 branches (a 1x1 conv times a fixed kxk pattern) share one batched contraction, and the remaining
+        branches are accumulated in place, so only a few full-size [out, in, k, k] tensors are materialized.
+        """
+        v = self.vector
+        o, k = self.out_channels, self.kernel_size
+
+        # avg, prior and 1x1: per output channel, [i, b] 1x1 weights times their scaled [b, k*k] spatial patterns
+        factors = [self.weight_orepa_avg_conv.flatten(1), self.weight_orepa_pfir_conv.flatten(1)]
+        patterns = [self.weight_orepa_avg_avg.expand(o, k, k).flatten(1), self.weight_orepa_prior.flatten(1)]
+        scales = [v[1], v[2]]
+        if hasattr(self, 'weight_orepa_1x1'):
+            center = torch.zeros(k * k, dtype=v.dtype, device=v.device)
+            center[k * k // 2] = 1
+            factors.append(self.weight_orepa_1x1.flatten(1))
+            patterns.append(center.expand(o, k * k))
+            scales.append(v[4])
+        patterns = torch.stack(patterns, 1) * torch.stack(scales, 1)[:, :, None]
+        weight = torch.bmm(torch.stack(factors, 2), patterns).view(o, -1, k, k)
+
+        weight.addcmul_(self.weight_orepa_origin, v[0].view(-1, 1, 1, 1))
+
         if hasattr(self, 'weight_orepa_1x1_kxk_idconv1'):
-            weight_orepa_1x1_kxk_conv1 = (self.weight_orepa_1x1_kxk_idconv1 +
-                                        self.id_tensor).squeeze(3).squeeze(2)
+            weight_orepa_1x1_kxk_conv1 = (self.weight_orepa_1x1_kxk_idconv1 + self.id_tensor).flatten(1)
         elif hasattr(self, 'weight_orepa_1x1_kxk_conv1'):
-            weight_orepa_1x1_kxk_conv1 = self.weight_orepa_1x1_kxk_conv1.squeeze(3).squeeze(2)
+            weight_orepa_1x1_kxk_conv1 = self.weight_orepa_1x1_kxk_conv1.flatten(1)
         else:
             raise NotImplementedError
-        weight_orepa_1x1_kxk_conv2 = self.weight_orepa_1x1_kxk_conv2
- 
+        weight_orepa_1x1_kxk_conv2 = self.weight_orepa_1x1_kxk_conv2 * v[3].view(-1, 1, 1, 1)
+
         if self.groups > 1:
             g = self.groups
             t, ig = weight_orepa_1x1_kxk_conv1.size()
             o, tg, h, w = weight_orepa_1x1_kxk_conv2.size()
-            weight_orepa_1x1_kxk_conv1 = weight_orepa_1x1_kxk_conv1.view(
-                g, int(t / g), ig)
-            weight_orepa_1x1_kxk_conv2 = weight_orepa_1x1_kxk_conv2.view(
-                g, int(o / g), tg, h, w)
-            weight_orepa_1x1_kxk = torch.einsum('gti,gothw->goihw',
-                                              weight_orepa_1x1_kxk_conv1,
-                                              weight_orepa_1x1_kxk_conv2).reshape(
-                                                  o, ig, h, w)
+            weight_orepa_1x1_kxk_conv1 = weight_orepa_1x1_kxk_conv1.view(g, int(t / g), ig)
+            weight_orepa_1x1_kxk_conv2 = weight_orepa_1x1_kxk_conv2.view(g, int(o / g), tg, h, w)
+            weight += torch.einsum('gti,gothw->goihw', weight_orepa_1x1_kxk_conv1,
+                                   weight_orepa_1x1_kxk_conv2).reshape(o, ig, h, w)
         else:
-            weight_orepa_1x1_kxk = torch.einsum('ti,othw->oihw',
-                                              weight_orepa_1x1_kxk_conv1,
-                                              weight_orepa_1x1_kxk_conv2)
-        weight_orepa_1x1_kxk = torch.einsum('oihw,o->oihw', weight_orepa_1x1_kxk, self.vector[3, :])
- 
-        weight_orepa_1x1 = 0
-        if hasattr(self, 'weight_orepa_1x1'):
-            weight_orepa_1x1 = transVI_multiscale(self.weight_orepa_1x1,
-                                                self.kernel_size)
-            weight_orepa_1x1 = torch.einsum('oihw,o->oihw', weight_orepa_1x1,
-                                           self.vector[4, :])
- 
-        weight_orepa_gconv = self.dwsc2full(self.weight_orepa_gconv_dw,
-                                          self.weight_orepa_gconv_pw,
-                                          self.in_channels, self.groups)
-        weight_orepa_gconv = torch.einsum('oihw,o->oihw', weight_orepa_gconv,
-                                        self.vector[5, :])
- 
-        weight = weight_orepa_origin + weight_orepa_avg + weight_orepa_1x1 + weight_orepa_1x1_kxk + weight_orepa_pfir + weight_orepa_gconv
- 
+            weight += (weight_orepa_1x1_kxk_conv2.flatten(2).transpose(1, 2) @ weight_orepa_1x1_kxk_conv1).transpose(
+                1, 2).view_as(weight)
+
+        if self.groups > 1:
+            # dwsc2full orders the output channels of weight_pw differently from its result when groups > 1,
+            # so the scale is applied to the expanded kernel there
+            weight.addcmul_(self.dwsc2full(self.weight_orepa_gconv_dw, self.weight_orepa_gconv_pw,
+                                           self.in_channels, self.groups), v[5].view(-1, 1, 1, 1))
+        else:
+            weight += self.dwsc2full(self.weight_orepa_gconv_dw, self.weight_orepa_gconv_pw * v[5].view(-1, 1, 1, 1),
+                                     self.in_channels, self.groups)
         return weight
  
     def dwsc2full(self, weight_dw, weight_pw, groups, groups_conv=1):
@@ -353,7 +660,7 @@ class OREPA(nn.Module):
         if hasattr(self, 'orepa_reparam'):
             return self.nonlinear(self.orepa_reparam(inputs))
         
-        weight = self.weight_gen()
+        weight = self.get_weight()
  
         if self.weight_only is True:
             return weight
@@ -372,9 +679,10 @@ class OREPA(nn.Module):
         return transI_fusebn(self.weight_gen(), self.bn)
  
     def switch_to_deploy(self):
-        if hasattr(self, 'or1x1_reparam'):
+        if hasattr(self, 'orepa_reparam'):
             return
         kernel, bias = self.get_equivalent_kernel_bias()
+        self._weight_cache = None
         self.orepa_reparam = nn.Conv2d(in_channels=self.in_channels, out_channels=self.out_channels,
                                      kernel_size=self.kernel_size, stride=self.stride,
                                      padding=self.padding, dilation=self.dilation, groups=self.groups, bias=True)
@@ -410,10 +718,11 @@ class OREPA(nn.Module):
         init.constant_(self.vector[0, :], 1.0)
  
  
-class OREPA_LargeConv(nn.Module):
+class OREPA_LargeConv(CachedWeightGen, nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=1,
                  stride=1, padding=None, groups=1, dilation=1, act=True, deploy=False):
         super(OREPA_LargeConv, self).__init__()
+        deploy = deploy or _deploy_construction
         assert kernel_size % 2 == 1 and kernel_size > 3
         
         padding = autopad(kernel_size, padding, dilation)
@@ -469,7 +778,7 @@ class OREPA_LargeConv(nn.Module):
         if hasattr(self, 'or_large_reparam'):
             return self.nonlinear(self.or_large_reparam(inputs))
  
-        weight = self.weight_gen()
+        weight = self.get_weight()
         out = F.conv2d(inputs, weight, stride=self.stride, padding=self.padding, dilation=self.dilation, groups=self.groups)
         return self.nonlinear(self.bn(out))
  
@@ -480,6 +789,7 @@ class OREPA_LargeConv(nn.Module):
         if hasattr(self, 'or_large_reparam'):
             return
         kernel, bias = self.get_equivalent_kernel_bias()
+        self._weight_cache = None
         self.or_large_reparam = nn.Conv2d(in_channels=self.in_channels, out_channels=self.out_channels,
                                      kernel_size=self.kernel_size, stride=self.stride,
                                      padding=self.padding, dilation=self.dilation, groups=self.groups, bias=True)
@@ -495,6 +805,7 @@ class ConvBN(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size,
                              stride=1, padding=0, dilation=1, groups=1, deploy=False, nonlinear=None):
         super().__init__()
+        deploy = deploy or _deploy_construction
         if nonlinear is None:
             self.nonlinear = nn.Identity()
         else:
@@ -514,6 +825,8 @@ class ConvBN(nn.Module):
             return self.nonlinear(self.conv(x))
  
     def switch_to_deploy(self):
+        if not hasattr(self, 'bn'):
+            return
         kernel, bias = transI_fusebn(self.conv.weight, self.bn)
         conv = nn.Conv2d(in_channels=self.conv.in_channels, out_channels=self.conv.out_channels, kernel_size=self.conv.kernel_size,
                                       stride=self.conv.stride, padding=self.conv.padding, dilation=self.conv.dilation, groups=self.conv.groups, bias=True)
@@ -525,13 +838,13 @@ class ConvBN(nn.Module):
         self.__delattr__('bn')
         self.conv = conv
  
-class OREPA_3x3_RepVGG(nn.Module):
+class OREPA_3x3_RepVGG(CachedWeightGen, nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size,
                  stride=1, padding=None, groups=1, dilation=1, act=True,
                  internal_channels_1x1_3x3=None,
                  deploy=False):
         super(OREPA_3x3_RepVGG, self).__init__()
-        self.deploy = deploy
+        self.deploy = deploy = deploy or _deploy_construction
  
         self.nonlinear = Conv.default_act if act is True else act if isinstance(act, nn.Module) else nn.Identity()
  
@@ -546,79 +859,71 @@ class OREPA_3x3_RepVGG(nn.Module):
         self.padding = padding
         self.dilation = dilation
  
-        self.branch_counter = 0
+        if deploy:
+            self.rbr_reparam = nn.Conv2d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=stride,
+                                      padding=padding, dilation=dilation, groups=groups, bias=True)
  
-        self.weight_rbr_origin = nn.Parameter(torch.Tensor(out_channels, int(in_channels/self.groups), kernel_size, kernel_size))
-        init.kaiming_uniform_(self.weight_rbr_origin, a=math.sqrt(1.0))
-        self.branch_counter += 1
+        else:
+            self.branch_counter = 0
  
+            self.weight_rbr_origin = nn.Parameter(torch.Tensor(out_channels, int(in_channels/self.groups), kernel_size, kernel_size))
+            init.kaiming_uniform_(self.weight_rbr_origin, a=math.sqrt(1.0))
+            self.branch_counter += 1
  
-        if groups < out_channels:
-            self.weight_rbr_avg_conv = nn.Parameter(torch.Tensor(out_channels, int(in_channels/self.groups), 1, 1))
-            self.weight_rbr_pfir_conv = nn.Parameter(torch.Tensor(out_channels, int(in_channels/self.groups), 1, 1))
-            init.kaiming_uniform_(self.weight_rbr_avg_conv, a=1.0)
-            init.kaiming_uniform_(self.weight_rbr_pfir_conv, a=1.0)
-            self.weight_rbr_avg_conv.data
-            self.weight_rbr_pfir_conv.data
-            self.register_buffer('weight_rbr_avg_avg', torch.ones(kernel_size, kernel_size).mul(1.0/kernel_size/kernel_size))
+ 
+            if groups < out_channels:
+                self.weight_rbr_avg_conv = nn.Parameter(torch.Tensor(out_channels, int(in_channels/self.groups), 1, 1))
+                self.weight_rbr_pfir_conv = nn.Parameter(torch.Tensor(out_channels, int(in_channels/self.groups), 1, 1))
+                init.kaiming_uniform_(self.weight_rbr_avg_conv, a=1.0)
+                init.kaiming_uniform_(self.weight_rbr_pfir_conv, a=1.0)
+                self.weight_rbr_avg_conv.data
+                self.weight_rbr_pfir_conv.data
+                self.register_buffer('weight_rbr_avg_avg', torch.ones(kernel_size, kernel_size).mul(1.0/kernel_size/kernel_size))
+                self.branch_counter += 1
+ 
+            else:
+                raise NotImplementedError
             self.branch_counter += 1
  
-        else:
-            raise NotImplementedError
-        self.branch_counter += 1
+            if internal_channels_1x1_3x3 is None:
+                internal_channels_1x1_3x3 = in_channels if groups < out_channels else 2 * in_channels   # For mobilenet, it is better to have 2X internal channels
  
-        if internal_channels_1x1_3x3 is None:
-            internal_channels_1x1_3x3 = in_channels if groups < out_channels else 2 * in_channels   # For mobilenet, it is better to have 2X internal channels
+            if internal_channels_1x1_3x3 == in_channels:
+                self.weight_rbr_1x1_kxk_idconv1 = nn.Parameter(torch.zeros(in_channels, int(in_channels/self.groups), 1, 1))
+                self.register_buffer('id_tensor', identity_kernel(in_channels, int(in_channels/self.groups),
+                                                                  self.weight_rbr_1x1_kxk_idconv1))
  
-        if internal_channels_1x1_3x3 == in_channels:
-            self.weight_rbr_1x1_kxk_idconv1 = nn.Parameter(torch.zeros(in_channels, int(in_channels/self.groups), 1, 1))
-            id_value = np.zeros((in_channels, int(in_channels/self.groups), 1, 1))
-            for i in range(in_channels):
-                id_value[i, i % int(in_channels/self.groups), 0, 0] = 1
-            id_tensor = torch.from_numpy(id_value).type_as(self.weight_rbr_1x1_kxk_idconv1)
-            self.register_buffer('id_tensor', id_tensor)
+            else:
+                self.weight_rbr_1x1_kxk_conv1 = nn.Parameter(torch.Tensor(internal_channels_1x1_3x3, int(in_channels/self.groups), 1, 1))
+                init.kaiming_uniform_(self.weight_rbr_1x1_kxk_conv1, a=math.sqrt(1.0))
+            self.weight_rbr_1x1_kxk_conv2 = nn.Parameter(torch.Tensor(out_channels, int(internal_channels_1x1_3x3/self.groups), kernel_size, kernel_size))
+            init.kaiming_uniform_(self.weight_rbr_1x1_kxk_conv2, a=math.sqrt(1.0))
+            self.branch_counter += 1
  
-        else:
-            self.weight_rbr_1x1_kxk_conv1 = nn.Parameter(torch.Tensor(internal_channels_1x1_3x3, int(in_channels/self.groups), 1, 1))
-            init.kaiming_uniform_(self.weight_rbr_1x1_kxk_conv1, a=math.sqrt(1.0))
-        self.weight_rbr_1x1_kxk_conv2 = nn.Parameter(torch.Tensor(out_channels, int(internal_channels_1x1_3x3/self.groups), kernel_size, kernel_size))
-        init.kaiming_uniform_(self.weight_rbr_1x1_kxk_conv2, a=math.sqrt(1.0))
-        self.branch_counter += 1
- 
-        expand_ratio = 8
-        self.weight_rbr_gconv_dw = nn.Parameter(torch.Tensor(in_channels*expand_ratio, 1, kernel_size, kernel_size))
-        self.weight_rbr_gconv_pw = nn.Parameter(torch.Tensor(out_channels, in_channels*expand_ratio, 1, 1))
-        init.kaiming_uniform_(self.weight_rbr_gconv_dw, a=math.sqrt(1.0))
-        init.kaiming_uniform_(self.weight_rbr_gconv_pw, a=math.sqrt(1.0))
-        self.branch_counter += 1
- 
-        if out_channels == in_channels and stride == 1:
+            expand_ratio = 8
+            self.weight_rbr_gconv_dw = nn.Parameter(torch.Tensor(in_channels*expand_ratio, 1, kernel_size, kernel_size))
+            self.weight_rbr_gconv_pw = nn.Parameter(torch.Tensor(out_channels, in_channels*expand_ratio, 1, 1))
+            init.kaiming_uniform_(self.weight_rbr_gconv_dw, a=math.sqrt(1.0))
+            init.kaiming_uniform_(self.weight_rbr_gconv_pw, a=math.sqrt(1.0))
             self.branch_counter += 1
  
-        self.vector = nn.Parameter(torch.Tensor(self.branch_counter, self.out_channels))
-        self.bn = nn.BatchNorm2d(out_channels)
+            if out_channels == in_channels and stride == 1:
+                self.branch_counter += 1
  
-        self.fre_init()
+            self.vector = nn.Parameter(torch.Tensor(self.branch_counter, self.out_channels))
+            self.bn = nn.BatchNorm2d(out_channels)
+ 
+            self.fre_init()
  
-        init.constant_(self.vector[0, :], 0.25)    #origin
-        init.constant_(self.vector[1, :], 0.25)      #avg
-        init.constant_(self.vector[2, :], 0.0)      #prior
-        init.constant_(self.vector[3, :], 0.5)    #1x1_kxk
-        init.constant_(self.vector[4, :], 0.5)     #dws_conv
+            init.constant_(self.vector[0, :], 0.25)    #origin
+            init.constant_(self.vector[1, :], 0.25)      #avg
+            init.constant_(self.vector[2, :], 0.0)      #prior
+            init.constant_(self.vector[3, :], 0.5)    #1x1_kxk
+            init.constant_(self.vector[4, :], 0.5)     #dws_conv
  
  
     def fre_init(self):
-        prior_tensor = torch.Tensor(self.out_channels, self.kernel_size, self.kernel_size)
-        half_fg = self.out_channels/2
-        for i in range(self.out_channels):
-            for h in range(3):
-                for w in range(3):
-                    if i < half_fg:
-                        prior_tensor[i, h, w] = math.cos(math.pi*(h+0.5)*(i+1)/3)
-                    else:
-                        prior_tensor[i, h, w] = math.cos(math.pi*(w+0.5)*(i+1-half_fg)/3)
- 
-        self.register_buffer('weight_rbr_prior', prior_tensor)
+        self.register_buffer('weight_rbr_prior', frequency_prior(self.out_channels, self.kernel_size))
  
     def weight_gen(self):
  
@@ -669,16 +974,39 @@ class OREPA_3x3_RepVGG(nn.Module):
         return weight_dsc.view(o, i, h, w)
  
     def forward(self, inputs):
-        weight = self.weight_gen()
+        if hasattr(self, 'rbr_reparam'):
+            return self.nonlinear(self.rbr_reparam(inputs))
+ 
+        weight = self.get_weight()
         out = F.conv2d(inputs, weight, bias=None, stride=self.stride, padding=self.padding, dilation=self.dilation, groups=self.groups)
  
         return self.nonlinear(self.bn(out))
  
+    def get_equivalent_kernel_bias(self):
+        return transI_fusebn(self.weight_gen(), self.bn)
+ 
+    def switch_to_deploy(self):
+        if hasattr(self, 'rbr_reparam'):
+            return
+        kernel, bias = self.get_equivalent_kernel_bias()
+        self._weight_cache = None
+        self.rbr_reparam = nn.Conv2d(in_channels=self.in_channels, out_channels=self.out_channels,
+                                     kernel_size=self.kernel_size, stride=self.stride,
+                                     padding=self.padding, dilation=self.dilation, groups=self.groups, bias=True)
+        self.rbr_reparam.weight.data = kernel
+        self.rbr_reparam.bias.data = bias
+        for para in self.parameters():
+            para.detach_()
+        for name in [n for n, _ in self.named_parameters(recurse=False)] + [n for n, _ in self.named_buffers(recurse=False)]:
+            self.__delattr__(name)
+        self.__delattr__('bn')
+ 
 class Bottleneck_OREPA(Bottleneck):
     """Standard bottleneck with OREPA."""
  
     def __init__(self, c1, c2, shortcut=True, g=1, k=(3, 3), e=0.5):  # ch_in, ch_out, shortcut, groups, kernels, expand
-        super().__init__(c1, c2, shortcut, g, k, e)
+        nn.Module.__init__(self)  # not Bottleneck.__init__, whose Conv pair would be built only to be replaced
+        self.add = shortcut and c1 == c2
         c_ = int(c2 * e)  # hidden channels
         if k[0] == 1:
             self.cv1 = Conv(c1, c_)
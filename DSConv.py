@@ -4,12 +4,50 @@ from torch.nn.modules.utils import _pair
 from ultralytics.nn.modules.conv import autopad, Conv
 import math
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
  
-class DSConv(_ConvNd):
+from C3k2_OREPA import CachedWeightGen, constructing_deploy
+ 
+def pack_int(q, bits):
+    """Pack signed integers of at most 4 bits two per byte, wider ones are stored as int8."""
+    if bits > 4:
+        return q.to(torch.int8).flatten()
+    u = (q.flatten().to(torch.int16) + 8).to(torch.uint8)
+    if u.numel() % 2:
+        u = torch.cat((u, u.new_zeros(1)))
+    return u[0::2] | (u[1::2] << 4)
+ 
+ 
+def unpack_int(packed, bits, shape):
+    """Inverse of pack_int, returns an int8 tensor of the given shape."""
+    n = math.prod(shape)
+    if bits > 4:
+        return packed[:n].view(shape)
+    q = torch.stack((packed & 15, packed >> 4), 1).flatten()[:n]
+    return (q.to(torch.int8) - 8).view(shape)
+ 
+ 
+class DSConv(CachedWeightGen, _ConvNd):
+    """Distribution Shifting Convolution: a block-quantized convolution.
+
+    The kernel is bits-bit integers (VQK) times a float scale alpha shared by every block of input channels at each
+    output channel and kernel position, plus an optional KDS bias per block and a CDS scale/shift per output channel.
+    While training the float weight is the master copy and is quantized on the fly with a straight-through gradient.
+    compress() drops it and keeps only the packed integers and alpha, which is the compact export format; eval
+    forwards reuse one dequantized kernel. bits=None disables quantization.
+
+    bits is saved in the state dict. Float checkpoints of older versions have no bits and load as bits=None, which
+    keeps their float kernel and outputs; set bits on them to quantize.
+    A float state dict loaded into a compressed layer restores its float weight, a compressed one compresses it.
+    """
+
+    block_size = 32
+    bits = None  # models pickled by older versions have no bits and keep their float kernel
+
     def __init__(self, in_channels, out_channels, kernel_size, stride=1,
                  padding=None, dilation=1, groups=1, padding_mode='zeros', bias=False, block_size=32, KDSBias=False,
-                 CDS=False):
+                 CDS=False, bits=8):
         padding = _pair(autopad(kernel_size, padding, dilation))
         kernel_size = _pair(kernel_size)
         stride = _pair(stride)
@@ -19,69 +57,125 @@ class DSConv(_ConvNd):
         super(DSConv, self).__init__(
             in_channels, out_channels, kernel_size, stride, padding, dilation,
             False, _pair(0), groups, bias, padding_mode)
- 
-        # KDS weight From Paper
-        self.intweight = torch.Tensor(out_channels, in_channels, *kernel_size)
-        self.alpha = torch.Tensor(out_channels, blck_numb, *kernel_size)
+        self.block_size = block_size
+        self.bits = bits
  
         # KDS bias From Paper
         self.KDSBias = KDSBias
         self.CDS = CDS
  
         if KDSBias:
-            self.KDSb = torch.Tensor(out_channels, blck_numb, *kernel_size)
+            self.KDSb = nn.Parameter(torch.zeros(out_channels, blck_numb, *kernel_size))
         if CDS:
-            self.CDSw = torch.Tensor(out_channels)
-            self.CDSb = torch.Tensor(out_channels)
+            self.CDSw = nn.Parameter(torch.ones(out_channels))
+            self.CDSb = nn.Parameter(torch.zeros(out_channels))
  
         self.reset_parameters()
  
+    @property
+    def compressed(self):
+        return 'weight' not in self._parameters
+ 
+    def __getattr__(self, name):
+        if name == 'weight' and 'intweight' in self._buffers:
+            return self.get_weight()  # dequantized kernel of a compressed layer, e.g. for fuse_conv_and_bn
+        return super().__getattr__(name)
+ 
+    def __setattr__(self, name, value):
+        if name == 'weight' and isinstance(value, nn.Parameter) and 'intweight' in self._buffers:
+            del self._buffers['intweight'], self._buffers['alpha']  # a float kernel replaces the compressed one
+        super().__setattr__(name, value)
+ 
+    def block_index(self, device=None):
+        """Block of every input channel: blocks are depth // blocks channels wide, the last takes the remainder."""
+        depth = self.in_channels // self.groups
+        blocks = math.ceil(self.in_channels / (self.block_size * self.groups))
+        return (torch.arange(depth, device=device) // (depth // blocks)).clamp_(max=blocks - 1), blocks
+ 
+    @torch.no_grad()
+    def quantize(self):
+        """Symmetric block-wise quantization of the float weight, returns (intweight int8, alpha)."""
+        w = self.weight
+        idx, blocks = self.block_index(w.device)
+        qmax = 2 ** (self.bits - 1) - 1
+        a, bs = w.abs(), w.shape[1] // blocks
+        n = (blocks - 1) * bs
+        amax = torch.cat((a[:, :n].unflatten(1, (blocks - 1, bs)).amax(2), a[:, n:].amax(1, keepdim=True)), 1)
+        alpha = (amax / qmax).clamp_(min=torch.finfo(w.dtype).tiny)
+        intweight = torch.round(w / alpha.index_select(1, idx)).clamp_(-qmax, qmax).to(torch.int8)
+        return intweight, alpha
+ 
+    def dequantize(self):
+        """Float kernel alpha * intweight of a compressed layer."""
+        idx = self.block_index(self.alpha.device)[0]
+        shape = (self.out_channels, self.in_channels // self.groups, *self.kernel_size)
+        return unpack_int(self.intweight, self.bits, shape).to(self.alpha.dtype) * self.alpha.index_select(1, idx)
+ 
     def get_weight_res(self):
-        # Include expansion of alpha and multiplication with weights to include in the convolution layer here
-        alpha_res = torch.zeros(self.weight.shape).to(self.alpha.device)
+        """Float kernel alpha * intweight (+ KDS bias), shifted per output channel by CDS."""
+        if self.compressed:
+            idx, weight = self.block_index(self.alpha.device)[0], self.dequantize()
+        elif self.bits:
+            idx = self.block_index(self.weight.device)[0]
+            intweight, alpha = self.quantize()
+            weight = self.weight + (intweight.to(alpha.dtype) * alpha.index_select(1, idx) - self.weight).detach()
+        else:
+            idx, weight = None, self.weight
  
-        # Include KDSBias
         if self.KDSBias:
-            KDSBias_res = torch.zeros(self.weight.shape).to(self.alpha.device)
- 
-        # Handy definitions:
-        nmb_blocks = self.alpha.shape[1]
-        total_depth = self.weight.shape[1]
-        bs = total_depth // nmb_blocks
- 
-        llb = total_depth - (nmb_blocks - 1) * bs
- 
-        # Casting the Alpha values as same tensor shape as weight
-        for i in range(nmb_blocks):
-            length_blk = llb if i == nmb_blocks - 1 else bs
- 
-            shp = self.alpha.shape  # Notice this is the same shape for the bias as well
-            to_repeat = self.alpha[:, i, ...].view(shp[0], 1, shp[2], shp[3]).clone()
-            repeated = to_repeat.expand(shp[0], length_blk, shp[2], shp[3]).clone()
-            alpha_res[:, i * bs:(i * bs + length_blk), ...] = repeated.clone()
- 
-            if self.KDSBias:
-                to_repeat = self.KDSb[:, i, ...].view(shp[0], 1, shp[2], shp[3]).clone()
-                repeated = to_repeat.expand(shp[0], length_blk, shp[2], shp[3]).clone()
-                KDSBias_res[:, i * bs:(i * bs + length_blk), ...] = repeated.clone()
- 
+            if idx is None:
+                idx = self.block_index(weight.device)[0]
+            weight = weight + self.KDSb.index_select(1, idx)
         if self.CDS:
-            to_repeat = self.CDSw.view(-1, 1, 1, 1)
-            repeated = to_repeat.expand_as(self.weight)
-            print(repeated.shape)
- 
-        # Element-wise multiplication of alpha and weight
-        weight_res = torch.mul(alpha_res, self.weight)
-        if self.KDSBias:
-            weight_res = torch.add(weight_res, KDSBias_res)
-        return weight_res
+            weight = weight * self.CDSw.view(-1, 1, 1, 1) + self.CDSb.view(-1, 1, 1, 1)
+        return weight
+ 
+    weight_gen = get_weight_res
+ 
+    @torch.no_grad()
+    def compress(self):
+        """Replace the float weight by the packed integer weight and alpha, in place."""
+        if self.compressed or not self.bits:
+            return self
+        intweight, alpha = self.quantize()
+        del self.weight
+        self.register_buffer('intweight', pack_int(intweight, self.bits))
+        self.register_buffer('alpha', alpha)
+        self._weight_cache = None
+        return self
+ 
+    @torch.no_grad()
+    def decompress(self):
+        """Inverse of compress(): a float weight holding the dequantized kernel replaces intweight and alpha."""
+        if self.compressed:
+            self.weight = nn.Parameter(self.dequantize())
+            self._weight_cache = None
+        return self
+ 
+    def __setstate__(self, state):
+        for k in ('intweight', 'alpha', 'KDSb', 'CDSw', 'CDSb'):
+            state.pop(k, None)  # unused, uninitialized tensors pickled by older versions
+        super().__setstate__(state)
+ 
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        destination[prefix + 'bits'] = torch.tensor(self.bits or 0)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        bits = state_dict.pop(prefix + 'bits', None)
+        if prefix + 'weight' in state_dict and self.compressed:
+            self.decompress()  # take the layout of a float checkpoint
+        if bits is not None:
+            self.bits = int(bits) or None
+        elif prefix + 'weight' in state_dict:
+            self.bits = None  # float checkpoint of an older version: keep its float kernel and outputs
+        if prefix + 'intweight' in state_dict and not self.compressed:
+            self.compress()  # and of a compressed one
+        self._weight_cache = None
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
  
     def forward(self, input):
-        # Get resulting weight
-        # weight_res = self.get_weight_res()
- 
-        # Returning convolution
-        return F.conv2d(input, self.weight, self.bias,
+        return F.conv2d(input, self.get_weight(), self.bias,
                         self.stride, self.padding, self.dilation,
                         self.groups)
  
@@ -89,4 +183,49 @@ class DSConv(_ConvNd):
 class DSConv2D(Conv):
     def __init__(self, inc, ouc, k=1, s=1, p=None, g=1, d=1, act=True):
         super().__init__(inc, ouc, k, s, p, g, d, act)
-        self.conv = DSConv(inc, ouc, k, s, p, g, d)
\ No newline at end of file
+        if constructing_deploy():  # the switch_to_deploy result, for fused weights loaded next
+            self.conv = torch.nn.Conv2d(inc, ouc, k, s, autopad(k, p, d), d, g, bias=True).requires_grad_(False)
+            del self.bn
+            self.forward = self.forward_fuse
+        else:
+            self.conv = DSConv(inc, ouc, k, s, p, g, d)
+ 
+    def switch_to_deploy(self):
+        """Fold the DSConv kernel and BN into a plain nn.Conv2d and run Conv.forward_fuse."""
+        if not hasattr(self, 'bn'):
+            return
+        conv, bn = self.conv, self.bn
+        std = (bn.running_var + bn.eps).sqrt()
+        t = bn.weight / std
+        fused = torch.nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                                conv.dilation, conv.groups, bias=True).requires_grad_(False)
+        fused.weight.copy_(conv.get_weight_res().detach() * t.detach().view(-1, 1, 1, 1))
+        bias = bn.bias - bn.running_mean * t
+        if conv.bias is not None:
+            bias = bias + conv.bias * t
+        fused.bias.copy_(bias.detach())
+        self.conv = fused
+        del self.bn
+        self.forward = self.forward_fuse
+ 
+ 
+def compress_model(model):
+    """Compress every DSConv of model in place to its packed integer format (see DSConv.compress)."""
+    for m in model.modules():
+        if isinstance(m, DSConv):
+            m.compress()
+    return model
+ 
+ 
+if __name__ == '__main__':
+    import argparse
+ 
+    parser = argparse.ArgumentParser(description='Store the DSConv layers of a checkpoint as packed integer weights')
+    parser.add_argument('--weights', required=True, help='Ultralytics checkpoint')
+    parser.add_argument('--save', required=True, help='compressed checkpoint')
+    opt = parser.parse_args()
+    ckpt = torch.load(opt.weights, map_location='cpu', weights_only=False)
+    for k in ('model', 'ema'):
+        if isinstance(ckpt, dict) and ckpt.get(k) is not None:
+            compress_model(ckpt[k])
+    torch.save(compress_model(ckpt) if isinstance(ckpt, nn.Module) else ckpt, opt.save)
@@ -1,12 +1,57 @@
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
 
+ACTIVATIONS = {'hardsigmoid': nn.Hardsigmoid, 'sigmoid': nn.Sigmoid, 'hardswish': nn.Hardswish, 'silu': nn.SiLU,
+               'relu': nn.ReLU, 'tanh': nn.Tanh, 'identity': nn.Identity}
+ 
+ 
+class EffectiveSEFunction(torch.autograd.Function):
+    """x * act(fc(mean(x))) saving only x and the pooled [B, C] vector; the gate is recomputed in backward.
+
+    The pooled vector, the fc and the gate are computed in fp32 (or the parameter dtype) whatever the dtype of x,
+    so bf16 / fp16 inputs only lose precision in the final product.
+    """
+ 
+    @staticmethod
+    def forward(ctx, x, weight, bias, act):
+        s = x.mean((2, 3), dtype=weight.dtype)
+        gate = fp32_gate(s, weight, bias, act)
+        ctx.act = act
+        ctx.save_for_backward(x, s, weight, bias)
+        return x * gate.to(x.dtype)[..., None, None]
+ 
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad):
+        x, s, weight, bias = ctx.saved_tensors
+        with torch.enable_grad():
+            inputs = [t.detach().requires_grad_() for t in (s, weight, bias)]
+            gate = fp32_gate(*inputs, ctx.act)
+        grad_s, grad_weight, grad_bias = torch.autograd.grad(gate, inputs, (grad * x).sum((2, 3), dtype=s.dtype))
+        grad_x = None
+        if ctx.needs_input_grad[0]:
+            grad_x = grad * gate.detach().to(grad.dtype)[..., None, None]
+            grad_x += (grad_s / (x.shape[2] * x.shape[3])).to(grad.dtype)[..., None, None]
+        return grad_x, grad_weight, grad_bias, None
+ 
+ 
+def fp32_gate(s, weight, bias, act):
+    """act(fc(s)) outside autocast, in the dtype of the pooled vector s."""
+    with torch.autocast(s.device.type, enabled=False):
+        return act(F.linear(s, weight.to(s.dtype), None if bias is None else bias.to(s.dtype)))
+ 
+ 
 class EffectiveSELayer(nn.Module):
     def __init__(self, channels, act='hardsigmoid'):
         super(EffectiveSELayer, self).__init__()
         self.fc = nn.Conv2d(channels, channels, kernel_size=1, padding=0)
-        self.act = nn.Hardsigmoid(inplace=True)
+        self.act = ACTIVATIONS[act.lower()]() if isinstance(act, str) else act
  
     def forward(self, x):
-        x_se = x.mean((2, 3), keepdim=True)
-        x_se = self.fc(x_se)
-        return x * self.act(x_se)
\ No newline at end of file
+        if torch.is_grad_enabled() and (x.requires_grad or self.fc.weight.requires_grad):
+            return EffectiveSEFunction.apply(x, self.fc.weight.flatten(1), self.fc.bias, self.act)
+        # inference: the plain module ops, the autograd function only pays off in training (fewer saved tensors
+        # and one fused backward); its fp32 gate and extra casts make the forward alone slower
+        return x * self.act(self.fc(x.mean((2, 3), keepdim=True)))
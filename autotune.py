@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import yaml
+
+from utils import MODEL_CFG
+
+TRAINER_KEYS = ('threads', 'interop_threads', 'workers', 'channels_last', 'bf16')  # config['trainer'] keys
+
+
+def max_rss():
+    """Peak resident set size of this process in bytes."""
+    try:
+        import resource
+    except ImportError:  # Windows: peak working set, current RSS where psutil has no peak
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform == 'darwin' else r * 1024
+
+
+def synthetic_batch(batch, imgsz, boxes=8, nc=80, seed=0):
+    """A training batch in the DetectionTrainer.preprocess_batch format with random images and boxes."""
+    g = torch.Generator().manual_seed(seed)
+    n = batch * boxes
+    xy = torch.rand(n, 2, generator=g) * 0.8 + 0.1
+    wh = torch.rand(n, 2, generator=g) * 0.15 + 0.02
+    return {'img': torch.rand(batch, 3, imgsz, imgsz, generator=g),
+            'batch_idx': torch.arange(batch).repeat_interleave(boxes).float(),
+            'cls': torch.randint(0, nc, (n, 1), generator=g).float(),
+            'bboxes': torch.cat((xy, wh), 1)}
+
+
+def _probe_train(cfg, scale, imgsz, batch, threads, interop_threads, channels_last, bf16, steps):
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop_threads)
+    from ultralytics.cfg import get_cfg
+
+    from ultralytics.utils.torch_utils import autocast
+
+    from train_settings import bf16_autocast
+    from utils import build_model
+
+    model = build_model(cfg, scale).train()
+    model.args = get_cfg()  # loss gains
+    fmt = torch.channels_last if channels_last else torch.contiguous_format
+    model.to(memory_format=fmt)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+    data = synthetic_batch(batch, imgsz, nc=model.model[-1].nc)
+    data['img'] = data['img'].contiguous(memory_format=fmt)
+    if bf16:
+        bf16_autocast(model)  # exactly as TrainSettingsMixin sets it up
+
+    def step():
+        with autocast(False, device='cpu'):  # the context the Ultralytics training step runs the model in on CPU
+            loss, _ = model(data)
+        loss.sum().backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    step()  # warmup: allocator, criterion, kernels
+    t = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return batch * steps / (time.perf_counter() - t), max_rss()
+
+
+def _probe_loader(data, imgsz, batch, workers, cache, fraction, batches):
+    from ultralytics.cfg import get_cfg
+    from ultralytics.data import build_dataloader, build_yolo_dataset
+    from ultralytics.data.utils import check_det_dataset
+
+    from fog_augment import RandomFog, add_fog
+
+    rss0 = max_rss()
+    info = check_det_dataset(data)
+    args = get_cfg(overrides={'imgsz': imgsz, 'cache': cache, 'fraction': fraction})
+    dataset = build_yolo_dataset(args, info['train'], batch, info, mode='train', fraction=fraction)
+    add_fog(dataset, RandomFog())  # as FogDetectionTrainer trains by default
+    cache_bytes = (max_rss() - rss0) / fraction if cache else 0  # extrapolated to the whole training set
+    loader = build_dataloader(dataset, batch, workers, shuffle=True, pin_memory=False, device='cpu')
+    it = (b for _ in iter(int, 1) for b in loader)  # InfiniteDataLoader iterators stop after one epoch
+    next(it)  # worker start-up
+    t = time.perf_counter()
+    n = 0
+    for _ in range(batches):
+        n += len(next(it)['img'])
+    return n / (time.perf_counter() - t), cache_bytes
+
+
+def run_probe(fn, *args):
+    """Run a probe in a fresh spawned process (clean thread pools and peak RSS); None if it crashes."""
+    try:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            return pool.submit(fn, *args).result()
+    except Exception as e:  # out of memory kills the worker: BrokenProcessPool, or a RuntimeError from torch
+        print(f'  probe failed: {type(e).__name__}: {e}')
+        return None
+
+
+def thread_candidates(cores):
+    values = {cores, max(1, cores // 2), max(1, cores * 3 // 4)}
+    return sorted(values, reverse=True)
+
+
+class AutoTuner:
+    """Short timed probes over the CPU training configuration, searched one dimension at a time.
+
+    1. intra-op / inter-op threads, 2. channels_last x bf16, 3. batch size (growing while it fits the memory budget
+    and improves throughput), 4. dataloader workers and RAM cache against the model's images/s (with data only).
+    Every probe runs in its own process, so thread settings and peak RSS are those of that configuration alone.
+    """
+
+    def __init__(self, cfg=MODEL_CFG, scale='n', imgsz=640, data=None, budget=None, steps=3, fraction=0.1,
+                 batches=20, batch_sizes=(8, 16, 32, 64, 128), workers=None):
+        import psutil
+
+        self.cfg, self.scale, self.imgsz, self.data = cfg, scale, imgsz, data
+        self.budget = budget or int(psutil.virtual_memory().available * 0.8)
+        self.steps, self.fraction, self.batches = steps, fraction, batches
+        self.batch_sizes = batch_sizes
+        self.cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        self.workers = workers or sorted({0, 2, 4, 8, self.cores} & set(range(self.cores + 1)))
+        self.results = []
+
+    def train_probe(self, batch, threads, interop, channels_last, bf16):
+        r = run_probe(_probe_train, self.cfg, self.scale, self.imgsz, batch, threads, interop, channels_last, bf16,
+                      self.steps)
+        ips, rss = r if r else (0.0, float('inf'))
+        fits = rss <= self.budget
+        self.results.append({'batch': batch, 'threads': threads, 'interop_threads': interop,
+                             'channels_last': channels_last, 'bf16': bf16, 'images_per_s': ips, 'peak_rss': rss})
+        print(f'  batch {batch:4d} threads {threads:3d}/{interop} channels_last {channels_last!s:5s} '
+              f'bf16 {bf16!s:5s}: {ips:7.2f} img/s, peak RSS {rss / 2 ** 30:6.2f} GiB{"" if fits else " (over budget)"}')
+        return ips if fits else 0.0
+
+    def tune(self):
+        best = {'batch': self.batch_sizes[0], 'threads': self.cores, 'interop_threads': 1,
+                'channels_last': False, 'bf16': False}
+
+        def probe(**kw):
+            c = {**best, **kw}
+            return self.train_probe(c['batch'], c['threads'], c['interop_threads'], c['channels_last'], c['bf16'])
+
+        print(f'threads ({self.cores} cores):')
+        scores = {(t, i): probe(threads=t, interop_threads=i) for t in thread_candidates(self.cores) for i in (1, 2)}
+        best['threads'], best['interop_threads'] = max(scores, key=scores.get)
+
+        print('layout / precision:')
+        scores = {(cl, bf): probe(channels_last=cl, bf16=bf) for cl in (False, True) for bf in (False, True)}
+        best['channels_last'], best['bf16'] = max(scores, key=scores.get)
+        speed = scores[best['channels_last'], best['bf16']]
+        if not speed:
+            raise SystemExit(f'no configuration at batch {best["batch"]} fits in {self.budget / 2 ** 30:.1f} GiB')
+
+        print(f'batch size (budget {self.budget / 2 ** 30:.1f} GiB):')
+        for batch in self.batch_sizes[1:]:
+            s = probe(batch=batch)
+            if s < speed * 1.03:  # over budget, or no longer worth the memory
+                break
+            best['batch'], speed = batch, s
+
+        workers = min(8, self.cores)  # without --data: the Ultralytics default, refined by tune_loader
+        config = {'train': {'batch': best['batch'], 'imgsz': self.imgsz, 'workers': workers, 'cache': False,
+                            'amp': False, 'device': 'cpu'},
+                  'trainer': {k: best[k] for k in ('threads', 'interop_threads', 'channels_last', 'bf16')},
+                  'probe': {'images_per_s': round(speed, 3), 'cores': self.cores,
+                            'machine': f'{platform.machine()} {platform.processor()}'.strip(),
+                            'torch': str(torch.__version__), 'date': time.strftime('%Y-%m-%d')}}
+        config['trainer']['workers'] = config['train']['workers']
+        if self.data:
+            self.tune_loader(config, speed)
+        return config
+
+    def tune_loader(self, config, model_speed):
+        """Fewest workers whose loader keeps up with the model, and RAM cache if it helps and fits the budget."""
+        print(f'dataloader (model {model_speed:.1f} img/s):')
+        batch = config['train']['batch']
+        peak = max(r['peak_rss'] for r in self.results if r['batch'] == batch and r['images_per_s'] > 0)
+        choice = None
+        for cache in (False, 'ram'):
+            for workers in self.workers:
+                r = run_probe(_probe_loader, self.data, self.imgsz, batch, workers, cache, self.fraction,
+                              self.batches)
+                if r is None:
+                    continue
+                ips, cache_bytes = r
+                fits = peak + cache_bytes * 1.1 <= self.budget
+                print(f'  workers {workers:3d} cache {cache!s:5s}: {ips:7.1f} img/s'
+                      + (f', cache {cache_bytes / 2 ** 30:.2f} GiB' if cache else '') + ('' if fits else ' (over budget)'))
+                if fits and (choice is None or (choice[0] < model_speed and ips > choice[0])):
+                    choice = (ips, workers, cache)
+                if fits and ips >= model_speed:
+                    break
+            if choice and choice[0] >= model_speed:
+                break
+        if choice:
+            config['train']['workers'] = config['trainer']['workers'] = choice[1]
+            config['train']['cache'] = choice[2]
+            config['probe']['loader_images_per_s'] = round(choice[0], 3)
+
+
+def apply(path):
+    """The model.train kwargs of an autotune config, with the TrainSettingsMixin settings of its trainer section.
+
+    The trainer workers become cpu_workers, the worker count kept on CPU where Ultralytics would force 0.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    kwargs = dict(config['train'])
+    for k in TRAINER_KEYS:
+        if k in config.get('trainer', {}):
+            kwargs['cpu_workers' if k == 'workers' else k] = config['trainer'][k]
+    return kwargs
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Auto-tune the CPU training configuration of train.py')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML')
+    parser.add_argument('--scale', default='n', help='model scale')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--data', default=None, help='dataset YAML, enables the dataloader workers / cache probes')
+    parser.add_argument('--budget', type=float, default=None, help='memory budget in GiB, default 80%% of free RAM')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help='dataloader worker counts to try')
+    parser.add_argument('--steps', type=int, default=3, help='timed training steps per probe')
+    parser.add_argument('--fraction', type=float, default=0.1, help='dataset fraction loaded by dataloader probes')
+    parser.add_argument('--batches', type=int, default=20, help='timed batches per dataloader probe')
+    parser.add_argument('--output', default='autotune.yaml', help='training config to write')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    tuner = AutoTuner(opt.cfg, opt.scale, opt.imgsz, opt.data, opt.budget and int(opt.budget * 2 ** 30), opt.steps,
+                      opt.fraction, opt.batches, tuple(opt.batch_sizes), opt.workers)
+    config = tuner.tune()
+    with open(opt.output, 'w', encoding='utf-8') as f:
+        f.write('# written by autotune.py, use with train.py: model.train(**autotune.apply(path), ...)\n')
+        yaml.safe_dump(config, f, sort_keys=False)
+    print(f"wrote {opt.output}: {config['train']} {config['trainer']}")
@@ -0,0 +1,79 @@
+"""Activation checkpointing of C3k2 / C3k2_OREPA blocks: peak memory vs step time of a full training step.
+
+Checks that checkpointing leaves the gradients and the BatchNorm running statistics unchanged, then times a
+forward+backward of the whole model and replays its CPU allocations for the peak memory, for several sets of
+checkpointed layers.
+
+Usage:
+    python benchmarks/bench_checkpoint.py --scale n --imgsz 320 --batch 8
+"""
+
+import copy
+import argparse
+
+import torch
+
+from common import build_model, fmt_bytes, fmt_ms, peak_memory, timeit
+from utils import flatten_outputs
+from C3k2_OREPA import set_checkpoint
+
+CASES = {'none': False, 'backbone C3k2': [2, 4, 6, 8], 'head C3k2_OREPA': [13, 16, 19, 22], 'all': True}
+
+
+def loss_fn(out):
+    return sum((t.float() ** 2).mean() for t in flatten_outputs(out))
+
+
+def check_equivalence(model, imgsz, atol=1e-4):
+    x = torch.rand(2, 3, imgsz, imgsz)
+    results = []
+    for layers in (False, True):
+        torch.manual_seed(0)
+        m = copy.deepcopy(model).train()
+        set_checkpoint(m, layers)
+        loss_fn(m(x)).backward()
+        grads = [p.grad for p in m.parameters() if p.grad is not None]
+        stats = [b for n, b in m.named_buffers() if 'running' in n or 'num_batches' in n]
+        results.append((grads, stats))
+    err = max((a.float() - b.float()).abs().max().item() / max(b.float().abs().max().item(), 1)
+              for part in (0, 1) for a, b in zip(results[0][part], results[1][part]))
+    print(f'checkpointed vs plain: max relative diff of gradients and BN statistics {err:.2e}')
+    if err > atol:
+        raise SystemExit('activation checkpointing changes the training step')
+
+
+def bench(model, imgsz, batch, repeat):
+    x = torch.rand(batch, 3, imgsz, imgsz)
+    base = None
+    for name, layers in CASES.items():
+        m = copy.deepcopy(model).train()
+        enabled = set_checkpoint(m, layers)
+
+        def step():
+            m.zero_grad(set_to_none=True)
+            loss_fn(m(x)).backward()
+
+        t, peak = min(timeit(step, repeat, warmup=1)), peak_memory(step)
+        base = base or (t, peak)
+        print(f'{name:16s} {str(enabled):30s} peak {fmt_bytes(peak)} ({peak / base[1] * 100:5.1f}%) | '
+              f'step {fmt_ms(t)} ({t / base[0] * 100:5.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', default='n')
+    parser.add_argument('--imgsz', type=int, default=320)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    opt = parser.parse_args()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    model = build_model(scale=opt.scale)
+    check_equivalence(model, 128)
+    bench(model, opt.imgsz, opt.batch, opt.repeat)
+
+
+if __name__ == '__main__':
+    main()
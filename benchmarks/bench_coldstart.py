@@ -0,0 +1,127 @@
+"""Cold start: process start to first inference for each way of shipping the model.
+
+Every path runs in a fresh interpreter and is timed from just before the process is spawned to
+  - imports: torch, Ultralytics and the repo modules imported,
+  - ready:   the model loaded in its fused deploy form,
+  - first:   the first inference forward returned,
+with the peak RSS of the process. The paths all ship the same randomly initialized --cfg model:
+  train       the training checkpoint ({'model': module}), reparameterized after loading
+  pickled     the reparameterized module pickled by reparam.py --save
+  fused       the weights-only checkpoint of reparam.py --save-fused, memory-mapped into a deploy-built model
+  fused-copy  the same file read into memory, load_fused(mmap=False)
+The first inference of every path must give the same output, the script exits with an error otherwise.
+
+Usage:
+    python benchmarks/bench_coldstart.py --scale s --repeat 5
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import torch
+
+from common import build_model
+from utils import MODEL_CFG
+
+PATHS = ('train', 'pickled', 'fused', 'fused-copy')
+
+
+def peak_rss():
+    """Peak RSS of this process; VmHWM, since ru_maxrss carries the parent's peak over fork + exec on Linux."""
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM'))
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(kind, path, imgsz):
+    """The measured process: load path the way kind ships it and run one forward, print the milestones as JSON."""
+    from reparam import load_fused, reparameterize
+    from utils import load_model
+
+    imported = time.time()
+    if kind.startswith('fused'):
+        model = load_fused(path, mmap=kind == 'fused')
+    else:
+        model = reparameterize(load_model(path))
+    ready = time.time()
+    with torch.inference_mode():
+        y = model(torch.zeros(1, 3, imgsz, imgsz))
+    first = time.time()
+    y = y[0] if isinstance(y, (list, tuple)) else y
+    print(json.dumps({'imports': imported, 'ready': ready, 'first': first, 'peak_rss': peak_rss(),
+                      'checksum': y.double().abs().sum().item()}))
+
+
+def write_checkpoints(cfg, scale, folder):
+    """The files of every path, from one model; returns {path: file}."""
+    from reparam import reparameterize, save_fused
+
+    model = build_model(cfg, scale).eval()
+    files = {kind: os.path.join(folder, f'{kind}.pt') for kind in ('train', 'pickled', 'fused')}
+    torch.save({'model': model}, files['train'])
+    reparameterize(model)
+    torch.save({'model': model}, files['pickled'])
+    save_fused(model, files['fused'])
+    files['fused-copy'] = files['fused']
+    return files
+
+
+def spawn(kind, path, imgsz, threads):
+    """Milestones of one cold start in seconds from the spawn, the exit included."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', kind, path, '--imgsz', str(imgsz)]
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads)) if threads else None
+    start = time.time()
+    out = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    end = time.time()
+    if out.returncode:
+        raise SystemExit(f'{kind} failed:\n{out.stderr}')
+    r = json.loads(out.stdout.strip().splitlines()[-1])
+    return {'imports': r['imports'] - start, 'ready': r['ready'] - start, 'first': r['first'] - start,
+            'exit': end - start, 'peak_rss': r['peak_rss'], 'checksum': r['checksum']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML')
+    parser.add_argument('--scale', default='n', help='model scale')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--repeat', type=int, default=5, help='cold starts per path, the median is reported')
+    parser.add_argument('--threads', type=int, default=None, help='OMP_NUM_THREADS of the measured processes')
+    parser.add_argument('--child', nargs=2, default=None, help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+    if opt.child:
+        return child(*opt.child, opt.imgsz)
+
+    with tempfile.TemporaryDirectory() as folder:
+        files = write_checkpoints(opt.cfg, opt.scale, folder)
+        runs = {kind: [] for kind in PATHS}
+        for _ in range(opt.repeat):
+            for kind in PATHS:  # interleaved, so drift of the machine hits every path alike
+                runs[kind].append(spawn(kind, files[kind], opt.imgsz, opt.threads))
+        sizes = {kind: os.path.getsize(files[kind]) for kind in PATHS}
+
+    print(f"{'':11s} {'file MB':>8s} {'imports s':>10s} {'ready s':>8s} {'first s':>8s} {'exit s':>8s} {'RSS MB':>8s}")
+    for kind in PATHS:
+        m = {k: statistics.median(r[k] for r in runs[kind]) for k in ('imports', 'ready', 'first', 'exit', 'peak_rss')}
+        print(f"{kind:11s} {sizes[kind] / 2 ** 20:8.2f} {m['imports']:10.3f} {m['ready']:8.3f} {m['first']:8.3f} "
+              f"{m['exit']:8.3f} {m['peak_rss'] / 2 ** 20:8.1f}")
+    reference = runs['pickled'][0]['checksum']
+    failures = [kind for kind in PATHS for r in runs[kind]
+                if abs(r['checksum'] - reference) > 1e-5 * max(abs(reference), 1.0)]
+    if failures:
+        raise SystemExit(f'first inference differs from the pickled deploy model: {", ".join(sorted(set(failures)))}')
+    print('every path gives the same first inference')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Zero-copy concat buffers of the C2f-family blocks: full-model CPU inference latency and allocator traffic.
+
+Runs the whole yolo11_DSConv+ese+orepa.yaml model in inference mode with the concat buffers of every C3k2 /
+C3k2_OREPA block disabled (cat of the chunk list) and enabled, for the training-form and the reparameterized model,
+and reports latency, the number and bytes of tensor allocations per forward and the peak memory.
+
+Usage:
+    python benchmarks/bench_concat.py --scale n --imgsz 640
+"""
+
+import copy
+import argparse
+import statistics
+
+import torch
+
+from common import allocation_stats, build_model, fmt_bytes, fmt_ms, peak_memory, timeit
+from utils import flatten_outputs
+from C3k2_OREPA import C2f
+from reparam import reparameterize
+
+
+def set_buffers(model, n):
+    for m in model.modules():
+        if isinstance(m, C2f):
+            m.concat_buffers = n
+    return model
+
+
+@torch.inference_mode()
+def bench(name, model, x, repeat):
+    results = {}
+    for label, n in (('cat', 0), ('buffer', C2f.concat_buffers)):
+        set_buffers(model, n)
+        out = flatten_outputs(model(x))
+        t = timeit(lambda: model(x), repeat)
+        count, nbytes = allocation_stats(lambda: model(x))
+        results[label] = out
+        print(f'{name:8s} {label:6s} median {fmt_ms(statistics.median(t))} min {fmt_ms(min(t))} | '
+              f'{count:4d} allocations {fmt_bytes(nbytes)} | peak {fmt_bytes(peak_memory(lambda: model(x)))}')
+    err = max((a - b).abs().max().item() for a, b in zip(results['cat'], results['buffer']))
+    if err > 0:
+        raise SystemExit(f'{name}: buffered forward differs from the cat forward by {err:.2e}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', default='n')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=20)
+    opt = parser.parse_args()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    torch.manual_seed(0)
+    model = build_model(scale=opt.scale).eval()
+    x = torch.rand(opt.batch, 3, opt.imgsz, opt.imgsz)
+    bench('train', model, x, opt.repeat)
+    bench('fused', reparameterize(copy.deepcopy(model)), x, opt.repeat)
+
+
+if __name__ == '__main__':
+    main()
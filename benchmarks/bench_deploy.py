@@ -0,0 +1,96 @@
+"""Deploy paths of OREPA_LargeConv and OREPA_3x3_RepVGG: equivalence and latency across kernel sizes.
+
+For every kernel size checks that switch_to_deploy() and a module built with deploy=True reproduce the training-form
+output, then times one eval forward with the kernel generated every call, with the cached kernel and with the fused
+conv.
+
+Usage:
+    python benchmarks/bench_deploy.py --threads 4
+"""
+
+import argparse
+
+import torch
+
+from common import fmt_ms, timeit
+from C3k2_OREPA import OREPA_3x3_RepVGG, OREPA_LargeConv
+
+
+def randomize(module):
+    """Random branch vectors and BN statistics, so that every branch and the BN fold are exercised."""
+    with torch.no_grad():
+        for name, p in module.named_parameters():
+            if name.endswith('vector'):
+                p.normal_(0.5, 0.2)
+            elif name.endswith('idconv1'):
+                p.normal_(0, 0.1)
+        for m in module.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2.0)
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.uniform_(-0.2, 0.2)
+    return module.eval()
+
+
+@torch.no_grad()
+def check_deploy(cls, c1, c2, k, size=32, rtol=1e-4):
+    """switch_to_deploy() and deploy=True construction both match the training form."""
+    torch.manual_seed(0)
+    m = randomize(cls(c1, c2, k))
+    x = torch.randn(2, c1, size, size)
+    ref = m(x)
+    m.switch_to_deploy()
+    m.switch_to_deploy()  # idempotent
+    out = m(x)
+    deployed = cls(c1, c2, k, deploy=True).eval()
+    deployed.load_state_dict(m.state_dict())
+    scale = ref.abs().max().item()
+    err = max((out - ref).abs().max().item(), (deployed(x) - ref).abs().max().item()) / scale
+    if err > rtol or len(list(m.parameters())) != 2:
+        raise SystemExit(f'{cls.__name__} k={k}: deploy form does not match the training form ({err:.2e})')
+    return err
+
+
+def bench(cls, c1, c2, k, size, batch, repeat):
+    torch.manual_seed(0)
+    m = randomize(cls(c1, c2, k))
+    x = torch.randn(batch, c1, size, size)
+
+    def generated():
+        with torch.enable_grad():  # parameters requiring grad bypass the kernel cache
+            m(x)
+
+    def cached():
+        with torch.no_grad():
+            m(x)
+
+    t_gen, t_cached = min(timeit(generated, repeat)), min(timeit(cached, repeat))
+    m.switch_to_deploy()
+    t_fused = min(timeit(cached, repeat))
+    print(f'{cls.__name__}({c1}, {c2}, k={k:2d}) {size}x{size} b{batch}: generated {fmt_ms(t_gen)} | '
+          f'cached {fmt_ms(t_cached)} | fused {fmt_ms(t_fused)} | x{t_gen / t_fused:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--size', type=int, default=40, help='feature map size (P5 at imgsz 1280, P4 at 640)')
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10)
+    opt = parser.parse_args()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    cases = [(OREPA_3x3_RepVGG, k) for k in (3, 5, 7)] + [(OREPA_LargeConv, k) for k in (5, 7, 9, 11, 13)]
+    for cls, k in cases:
+        err = check_deploy(cls, 16, 32, k)
+        print(f'{cls.__name__} k={k}: deploy matches training form, max relative error {err:.2e}')
+    c = opt.channels
+    for cls, k in cases:
+        bench(cls, c, c, k, opt.size, opt.batch, opt.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Block-quantized DSConv against float: weight memory, output error and CPU latency.
+
+Measures every DSConv2D of the model at the given scale with the input it sees at imgsz, for each bit width: bytes of
+the float weight vs the packed integers + alpha, relative output error against the float kernel and the latency of the
+float conv, the quantized eval forward (cached dequantized kernel) and the compressed layer. Finally compares the
+fp16 checkpoint size and the whole-model output of the compressed model with the float one.
+
+Usage:
+    python benchmarks/bench_dsconv.py --scale n --bits 8 4
+"""
+
+import io
+import copy
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from common import build_model, fmt_bytes, fmt_ms, timeit
+from utils import flatten_outputs
+from DSConv import DSConv, compress_model
+
+
+def state_bytes(module):
+    return sum(t.numel() * t.element_size() for t in (*module.parameters(), *module.buffers()))
+
+
+def checkpoint_bytes(model):
+    buffer = io.BytesIO()
+    torch.save({'model': copy.deepcopy(model).half()}, buffer)
+    return buffer.tell()
+
+
+def relative_error(out, ref):
+    """Worst error over all output tensors, each relative to its largest reference magnitude."""
+    return max(((a - b).abs().max() / b.abs().max()).item() for a, b in zip(flatten_outputs(out), flatten_outputs(ref)))
+
+
+def set_bits(model, bits):
+    for m in model.modules():
+        if isinstance(m, DSConv):
+            m.bits = bits
+    return model
+
+
+def layer_inputs(model, imgsz):
+    """Input tensor of every DSConv of model for one random image."""
+    inputs, hooks = {}, []
+    for name, m in model.named_modules():
+        if isinstance(m, DSConv):
+            hooks.append(m.register_forward_hook(lambda m, x, y, name=name: inputs.__setitem__(name, x[0])))
+    with torch.no_grad():
+        model(torch.rand(1, 3, imgsz, imgsz))
+    for h in hooks:
+        h.remove()
+    return inputs
+
+
+@torch.no_grad()
+def bench_layers(model, imgsz, bits_list, repeat):
+    inputs = layer_inputs(model, imgsz)
+    for name, m in model.named_modules():
+        if not isinstance(m, DSConv):
+            continue
+        x = inputs[name]
+        w = m.weight.detach().clone()
+        args = (m.bias, m.stride, m.padding, m.dilation, m.groups)
+        y_float = F.conv2d(x, w, *args)
+        t_float = min(timeit(lambda: F.conv2d(x, w, *args), repeat))
+        print(f'{name:12s} {m.in_channels:4d}->{m.out_channels:<4d} {x.shape[-1]:4d}px float {fmt_bytes(w.numel() * 4)} '
+              f'{fmt_ms(t_float)}')
+        for bits in bits_list:
+            q = copy.deepcopy(m).eval()
+            q.bits = bits
+            t_quant = min(timeit(lambda: q(x), repeat))
+            q.compress()
+            y = q(x)
+            t_comp = min(timeit(lambda: q(x), repeat))
+            err = ((y - y_float).abs().max() / y_float.abs().max()).item()
+            print(f'{"":12s} {bits}-bit {fmt_bytes(state_bytes(q)):>10s} x{w.numel() * 4 / state_bytes(q):4.1f} smaller | '
+                  f'rel err {err:.2e} | quantized {fmt_ms(t_quant)} compressed {fmt_ms(t_comp)}')
+
+
+@torch.no_grad()
+def bench_model(model, imgsz, bits_list, batch=2):
+    x = torch.rand(batch, 3, imgsz, imgsz)
+    ref = set_bits(copy.deepcopy(model), None).eval()
+    y_float = ref(x)
+    print(f'fp16 checkpoint: float {fmt_bytes(checkpoint_bytes(ref))}')
+    for bits in bits_list:
+        q = compress_model(set_bits(copy.deepcopy(model), bits)).eval()
+        err = relative_error(q(x), y_float)
+        print(f'{"":16s} {bits}-bit {fmt_bytes(checkpoint_bytes(q))} | worst model output rel err {err:.2e}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', default='n')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--bits', type=int, nargs='+', default=[8, 4])
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    opt = parser.parse_args()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    torch.manual_seed(0)
+    model = build_model(scale=opt.scale).eval()
+    bench_layers(model, opt.imgsz, opt.bits, opt.repeat)
+    bench_model(model, opt.imgsz, opt.bits)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""EffectiveSELayer: fused autograd function vs the original module, training memory and inference latency.
+
+Checks outputs and gradients against the original implementation, then reports the bytes autograd saves for backward,
+peak CPU memory and time of forward+backward on the P5 feature map, and inference latency for contiguous and
+channels_last inputs, where EffectiveSELayer runs the plain module ops instead of the autograd function.
+
+Usage:
+    python benchmarks/bench_ese.py --channels 1024 --batch 64
+"""
+
+import argparse
+
+import torch
+import torch.nn as nn
+
+from common import fmt_bytes, fmt_ms, peak_memory, saved_tensor_bytes, timeit
+from ESE import EffectiveSELayer
+
+
+class EffectiveSELayerReference(nn.Module):
+    """The original implementation."""
+
+    def __init__(self, channels):
+        super().__init__()
+        self.fc = nn.Conv2d(channels, channels, kernel_size=1, padding=0)
+        self.act = nn.Hardsigmoid(inplace=True)
+
+    def forward(self, x):
+        x_se = x.mean((2, 3), keepdim=True)
+        x_se = self.fc(x_se)
+        return x * self.act(x_se)
+
+
+def pair(c):
+    torch.manual_seed(0)
+    ref = EffectiveSELayerReference(c)
+    new = EffectiveSELayer(c)
+    new.load_state_dict(ref.state_dict())
+    return ref, new
+
+
+def check_equivalence(c=64, atol=1e-5):
+    ref, new = pair(c)
+    for act in ('hardsigmoid', 'sigmoid', 'silu'):
+        new.act = EffectiveSELayer(c, act).act
+        ref.act = EffectiveSELayer(c, act).act
+        x = torch.randn(2, c, 7, 9, requires_grad=True)
+        upstream = torch.randn(2, c, 7, 9)
+        outs = []
+        for m in (ref, new):
+            y = m(x)
+            grads = torch.autograd.grad((y * upstream).sum(), (x, m.fc.weight, m.fc.bias))
+            outs.append((y, *grads))
+        err = max((a - b).abs().max().item() for a, b in zip(*outs))
+        with torch.no_grad():
+            err = max(err, (ref(x) - new(x)).abs().max().item())
+        print(f'{act}: max abs diff output/gradients/inference {err:.2e}')
+        if err > atol:
+            raise SystemExit('fused EffectiveSELayer does not match the reference')
+
+
+def bench_train(c, size, batch, repeat):
+    ref, new = pair(c)
+    x = torch.randn(batch, c, size, size, requires_grad=True)
+
+    for name, m in (('reference', ref), ('fused', new)):
+        def step():
+            m.zero_grad(set_to_none=True)
+            x.grad = None
+            m(x).sum().backward()
+
+        saved = saved_tensor_bytes(lambda: m(x))
+        print(f'{name:9s} train {c}x{size}x{size} b{batch}: saved {fmt_bytes(saved)} (input {fmt_bytes(x.nbytes)}) | '
+              f'peak {fmt_bytes(peak_memory(step))} | fwd+bwd {fmt_ms(min(timeit(step, repeat)))}')
+
+
+@torch.no_grad()
+def bench_infer(c, size, batch, repeat):
+    ref, new = pair(c)
+    for fmt in (torch.contiguous_format, torch.channels_last):
+        x = torch.randn(batch, c, size, size).contiguous(memory_format=fmt)
+        m_ref, m_new = ref.to(memory_format=fmt), new.to(memory_format=fmt)
+        t_ref, t_new = min(timeit(lambda: m_ref(x), repeat)), min(timeit(lambda: m_new(x), repeat))
+        layout = 'channels_last' if fmt is torch.channels_last else 'contiguous'
+        keeps = new(x).is_contiguous(memory_format=fmt)
+        print(f'infer {layout:13s} b{batch}: reference {fmt_ms(t_ref)} | module {fmt_ms(t_new)} | x{t_ref / t_new:.2f} '
+              f'| output keeps layout: {keeps}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=1024)
+    parser.add_argument('--size', type=int, default=20, help='P5 at imgsz 640')
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    opt = parser.parse_args()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    check_equivalence()
+    bench_train(opt.channels, opt.size, opt.batch, opt.repeat)
+    bench_infer(opt.channels, opt.size, 1, 10 * opt.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark the vectorized fog synthesis in fog.py against the original per-pixel loop.
+
+Usage:
+    python benchmarks/bench_fog.py --size 480 640
+    python benchmarks/bench_fog.py --image path/to/img.jpg
+    python benchmarks/bench_fog.py --image path/to/img.jpg --severities 0.02 0.5 0.05 0.7 0.1 0.8
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fog  # noqa: E402
+
+
+def fog_loop(img, A=0.5, beta=0.02):
+    """Original fog.processImage kernel: per-pixel Python loop, returns what cv2.imwrite would have stored."""
+    img_f = img / 255.0
+    (row, col, chs) = img.shape
+    size = math.sqrt(max(row, col))
+    center = (row // 2, col // 2)
+    for j in range(row):
+        for l in range(col):
+            d = -0.02 * math.sqrt((j - center[0]) ** 2 + (l - center[1]) ** 2) + size
+            td = math.exp(-beta * d)
+            img_f[j][l][:] = img_f[j][l][:] * td + A * (1 - td)
+    # cv2.imwrite converts float images with saturate_cast (round to nearest, clip to [0, 255])
+    return np.clip(np.rint(img_f * 255), 0, 255).astype(np.uint8)
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t)
+    return out, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', type=str, default=None, help='image to fog (default: random image of --size)')
+    parser.add_argument('--size', type=int, nargs=2, default=(480, 640), metavar=('H', 'W'))
+    parser.add_argument('--repeat', type=int, default=10, help='repeats for the vectorized path')
+    parser.add_argument('--A', type=float, default=0.5)
+    parser.add_argument('--beta', type=float, default=0.02)
+    parser.add_argument('--severities', type=float, nargs='+', default=None, metavar='BETA A',
+                        help='also time multi-severity output: one decode vs one decode per (beta, A) pair')
+    opt = parser.parse_args()
+
+    if opt.image:
+        img = cv2.imread(opt.image)
+        if img is None:
+            raise SystemExit(f'cannot read {opt.image}')
+    else:
+        img = np.random.default_rng(0).integers(0, 256, (*opt.size, 3), dtype=np.uint8)
+    h, w = img.shape[:2]
+
+    ref, t_loop = timeit(lambda: fog_loop(img, opt.A, opt.beta), 1)
+
+    fog._TD_CACHE.clear()
+    _, t_cold = timeit(lambda: fog.fogImage(img, opt.beta, opt.A), 1)
+    out, t_warm = timeit(lambda: fog.fogImage(img, opt.beta, opt.A), opt.repeat)
+
+    diff = np.abs(out.astype(np.int16) - ref.astype(np.int16))
+    print(f'image {h}x{w}')
+    print(f'loop        {t_loop * 1e3:10.1f} ms')
+    print(f'vectorized  {t_cold * 1e3:10.1f} ms (cold cache)  {t_warm * 1e3:8.1f} ms (cached map)  '
+          f'speedup x{t_loop / t_warm:.0f}')
+    print(f'max abs diff {diff.max()}  mismatched pixels {np.count_nonzero(diff)} / {diff.size}')
+    if diff.max() > 1:
+        raise SystemExit('vectorized output differs from the reference loop by more than 1 level')
+
+    if opt.severities:
+        bench_severities(img, list(zip(opt.severities[::2], opt.severities[1::2])), opt.repeat)
+
+
+def bench_severities(img, severities, repeat):
+    """Time N severity levels as N decode/fog/encode passes vs fog._fogBytes (one decode, shared distance map)."""
+    ok, data = cv2.imencode('.jpg', img)
+    data = data.tobytes()
+
+    def separate():
+        for beta, A in severities:
+            fog._fogBytes(data, '.jpg', [(beta, A)])
+
+    fog._TD_CACHE.clear()
+    fog.distanceMap.cache_clear()
+    _, t_sep = timeit(separate, repeat)
+    fog._TD_CACHE.clear()
+    fog.distanceMap.cache_clear()
+    _, t_multi = timeit(lambda: fog._fogBytes(data, '.jpg', severities), repeat)
+    print(f'{len(severities)} severities: separate passes {t_sep * 1e3:8.1f} ms  single decode {t_multi * 1e3:8.1f} ms  '
+          f'x{t_sep / t_multi:.2f}')
+
+
+if __name__ == '__main__':
+    main()
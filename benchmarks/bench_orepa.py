@@ -0,0 +1,165 @@
+"""Microbenchmark of OREPA kernel generation inside C3k2_OREPA blocks.
+
+Compares the original per-branch weight_gen, the fused single-pass kernel with a regular autograd graph and the
+OREPAWeightGen function with analytic gradients. Checks that all produce the same kernel and the same gradients, then
+reports the bytes autograd saves for kernel generation, forward+backward time and peak CPU memory per C3k2_OREPA block
+for the channel widths of the yolo11_DSConv+ese+orepa.yaml head.
+
+Usage:
+    python benchmarks/bench_orepa.py --threads 4
+"""
+
+import argparse
+from contextlib import contextmanager
+
+import torch
+
+from common import fmt_bytes, fmt_ms, peak_memory, saved_tensor_bytes, timeit
+from C3k2_OREPA import OREPA, C3k2_OREPA, transVI_multiscale
+
+
+def weight_gen_reference(self):
+    """The original OREPA.weight_gen: every branch expanded and scaled separately, then summed."""
+    weight_orepa_origin = torch.einsum('oihw,o->oihw', self.weight_orepa_origin, self.vector[0, :])
+    weight_orepa_avg = torch.einsum('oihw,hw->oihw', self.weight_orepa_avg_conv, self.weight_orepa_avg_avg)
+    weight_orepa_avg = torch.einsum(
+        'oihw,o->oihw',
+        torch.einsum('oi,hw->oihw', self.weight_orepa_avg_conv.squeeze(3).squeeze(2), self.weight_orepa_avg_avg),
+        self.vector[1, :])
+    weight_orepa_pfir = torch.einsum(
+        'oihw,o->oihw',
+        torch.einsum('oi,ohw->oihw', self.weight_orepa_pfir_conv.squeeze(3).squeeze(2), self.weight_orepa_prior),
+        self.vector[2, :])
+    if hasattr(self, 'weight_orepa_1x1_kxk_idconv1'):
+        conv1 = (self.weight_orepa_1x1_kxk_idconv1 + self.id_tensor).squeeze(3).squeeze(2)
+    else:
+        conv1 = self.weight_orepa_1x1_kxk_conv1.squeeze(3).squeeze(2)
+    conv2 = self.weight_orepa_1x1_kxk_conv2
+    if self.groups > 1:
+        g = self.groups
+        t, ig = conv1.size()
+        o, tg, h, w = conv2.size()
+        weight_orepa_1x1_kxk = torch.einsum('gti,gothw->goihw', conv1.view(g, int(t / g), ig),
+                                            conv2.view(g, int(o / g), tg, h, w)).reshape(o, ig, h, w)
+    else:
+        weight_orepa_1x1_kxk = torch.einsum('ti,othw->oihw', conv1, conv2)
+    weight_orepa_1x1_kxk = torch.einsum('oihw,o->oihw', weight_orepa_1x1_kxk, self.vector[3, :])
+    weight_orepa_1x1 = torch.einsum('oihw,o->oihw', transVI_multiscale(self.weight_orepa_1x1, self.kernel_size),
+                                    self.vector[4, :])
+    weight_orepa_gconv = self.dwsc2full(self.weight_orepa_gconv_dw, self.weight_orepa_gconv_pw, self.in_channels,
+                                        self.groups)
+    weight_orepa_gconv = torch.einsum('oihw,o->oihw', weight_orepa_gconv, self.vector[5, :])
+    return (weight_orepa_origin + weight_orepa_avg + weight_orepa_1x1 + weight_orepa_1x1_kxk + weight_orepa_pfir +
+            weight_orepa_gconv)
+
+
+@contextmanager
+def swap_weight_gen(fn):
+    current = OREPA.weight_gen
+    OREPA.weight_gen = fn
+    try:
+        yield
+    finally:
+        OREPA.weight_gen = current
+
+
+def reference_weight_gen():
+    """Use the original per-branch weight_gen."""
+    return swap_weight_gen(weight_gen_reference)
+
+
+def graph_weight_gen():
+    """Use the fused kernel generation with a regular autograd graph instead of OREPAWeightGen."""
+    return swap_weight_gen(OREPA._weight_gen)
+
+
+VARIANTS = (('reference', reference_weight_gen), ('fused graph', graph_weight_gen),
+            ('analytic', lambda: swap_weight_gen(OREPA.weight_gen)))
+
+
+def randomize(module):
+    """Move OREPA's branch vectors off their init so that every branch contributes to kernel and gradients."""
+    with torch.no_grad():
+        for m in module.modules():
+            if isinstance(m, OREPA):
+                m.vector.normal_(0.5, 0.2)
+                m.weight_orepa_1x1_kxk_idconv1.normal_(0, 0.1)
+
+
+def check_equivalence(groups=(1, 2), atol=1e-5):
+    """Every variant agrees with the reference on the kernel and on all parameter gradients."""
+    for g in groups:
+        torch.manual_seed(0)
+        m = OREPA(32, 64, 3, groups=g)
+        randomize(m)
+        params = [p for n, p in m.named_parameters() if not n.startswith('bn.')]
+        upstream = torch.randn(m.out_channels, m.in_channels // g, 3, 3)
+
+        results = []
+        for _, variant in VARIANTS:
+            with variant():
+                w = m.weight_gen()
+            results.append([w, *torch.autograd.grad((w * upstream).sum(), params)])
+        for (name, _), result in zip(VARIANTS[1:], results[1:]):
+            err = max((a - b).abs().max().item() for a, b in zip(result, results[0]))
+            print(f'groups={g} {name}: max abs diff kernel/gradients {err:.2e}')
+            if err > atol:
+                raise SystemExit(f'{name} weight_gen does not match the reference')
+
+
+def bench_weight_gen(channels, repeat):
+    """Kernel generation alone, forward + backward, for a c -> c 3x3 OREPA."""
+    for c in channels:
+        torch.manual_seed(0)
+        m = OREPA(c, c, 3)
+        randomize(m)
+
+        def step():
+            m.zero_grad(set_to_none=True)
+            m.weight_gen().sum().backward()
+
+        line = []
+        for name, variant in VARIANTS:
+            with variant():
+                line.append(f'{name} {fmt_ms(min(timeit(step, repeat)))} saves {fmt_bytes(saved_tensor_bytes(m.weight_gen))}')
+        print(f'OREPA({c:4d}, {c:4d}) weight_gen fwd+bwd: ' + ' | '.join(line))
+
+
+def bench_block(c1, c2, size, batch, repeat):
+    torch.manual_seed(0)
+    block = C3k2_OREPA(c1, c2, n=1).train()
+    randomize(block)
+    x = torch.randn(batch, c1, size, size)
+
+    def step():
+        block.zero_grad(set_to_none=True)
+        block(x).sum().backward()
+
+    line = []
+    for name, variant in VARIANTS:
+        with variant():
+            t, m = min(timeit(step, repeat)), peak_memory(step)
+        line.append(f'{name} {fmt_ms(t)} {fmt_bytes(m)}')
+    print(f'C3k2_OREPA({c1:4d}, {c2:4d}) {size:3d}x{size:<3d} b{batch}: ' + ' | '.join(line))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=0.25, help='width multiple of the model scale (n=0.25)')
+    opt = parser.parse_args()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+
+    check_equivalence()
+    bench_weight_gen((32, 64, 128, 256), 4 * opt.repeat)
+    # head C3k2_OREPA layers 13, 16, 19 at imgsz 640 (c1 is the concat width, c2 the layer output)
+    w = opt.scale
+    for c1, c2, size in ((1536, 512, 40), (1024, 256, 80), (768, 512, 40)):
+        bench_block(int(c1 * w), int(c2 * w), size, opt.batch, opt.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""bf16 autocast and channels_last on the custom modules: numerical drift, layout and latency.
+
+For OREPA, DSConv2D, EffectiveSELayer, C3k2_OREPA and the whole model, checks against the fp32 NCHW reference that
+  - fp32 channels_last matches to float rounding,
+  - bf16 autocast stays within --rtol relative L2 error on outputs and --grad-rtol on the input gradient and on all
+    parameter gradients together (train mode),
+  - every custom module keeps channels_last feature maps channels_last,
+  - the reparameterized kernel generated under autocast is exactly the fp32 one (generation never runs in bf16),
+and that the bf16 setting of FogDetectionTrainer really runs the training convolutions in bf16 (one short training
+run on a synthetic dataset), and exits with an error if one does not. In train mode batch-statistics BatchNorm amplifies bf16 rounding through the
+depth of any randomly initialized YOLO, so the whole model is bounded by the drift of the stock yolo11n.yaml (+25%)
+rather than by --rtol. Then reports latency for fp32 / bf16 x NCHW / channels_last; bf16 is only faster on CPUs
+with native bf16 matmul (AVX512-BF16 / AMX), elsewhere it is emulated.
+
+Usage:
+    python benchmarks/bench_precision.py --size 64 --batch 4
+"""
+
+import os
+import argparse
+import tempfile
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+import torch
+
+from common import build_model, fmt_ms, timeit
+from utils import MODEL_CFG
+from C3k2_OREPA import C3k2_OREPA, OREPA
+from DSConv import DSConv, DSConv2D
+from ESE import EffectiveSELayer
+
+MODULES = {
+    'orepa': lambda c: OREPA(c, c, 3),
+    'dsconv2d': lambda c: DSConv2D(c, c, 3),
+    'effective_se': lambda c: EffectiveSELayer(c),
+    'c3k2_orepa': lambda c: C3k2_OREPA(c, c, 1, True),
+}
+CUSTOM = (OREPA, DSConv, DSConv2D, EffectiveSELayer, C3k2_OREPA)
+
+
+def precision(bf16):
+    return torch.autocast('cpu', dtype=torch.bfloat16) if bf16 else nullcontext()
+
+
+def rel_err(a, b):
+    return ((a.float() - b.float()).norm() / b.float().norm().clamp(min=1e-12)).item()
+
+
+def outputs(y):
+    """The tensor(s) of a module / model output; eval Detect returns (y, raw head maps)."""
+    if isinstance(y, (list, tuple)):
+        return [t for v in y for t in outputs(v)]
+    if isinstance(y, dict):
+        return [t for v in y.values() for t in outputs(v)]
+    return [y] if torch.is_tensor(y) else []
+
+
+def run(m, x, fmt, bf16, train):
+    """Outputs, (train mode) input and flattened parameter gradients, and the custom modules that returned a non
+    channels_last feature map for a channels_last input, of m on x in the given layout and precision."""
+    x = x.detach().to(torch.bfloat16 if bf16 else x.dtype)  # as a preceding autocast layer would hand it over
+    x = x.contiguous(memory_format=fmt).requires_grad_(train)
+    lost = []
+
+    def hook(module, args, out):
+        if fmt is torch.channels_last and any(t.dim() == 4 and not t.is_contiguous(memory_format=fmt)
+                                              for t in outputs(out)):
+            lost.append(type(module).__name__)
+
+    hooks = [c.register_forward_hook(hook) for c in m.modules() if isinstance(c, CUSTOM)]
+    m.zero_grad(set_to_none=True)
+    try:
+        with torch.set_grad_enabled(train), precision(bf16):
+            ys = outputs(m(x))
+    finally:
+        for h in hooks:
+            h.remove()
+    grads = []
+    if train:
+        sum(y.float().square().mean() for y in ys).backward()  # a loss that reaches every output element
+        grads = [x.grad, torch.cat([p.grad.flatten() for p in m.parameters() if p.grad is not None])]
+    return ys, grads, sorted(set(lost))
+
+
+def drift(m, x, train):
+    """{label: (output error, gradient error, modules losing channels_last)} against fp32 NCHW."""
+    m.train(train)
+    ref, ref_grads, _ = run(m, x, torch.contiguous_format, False, train)
+    result = {}
+    for fmt, bf16 in ((torch.channels_last, False), (torch.contiguous_format, True), (torch.channels_last, True)):
+        ys, grads, lost = run(m, x, fmt, bf16, train)
+        label = f"{'bf16' if bf16 else 'fp32'} {'channels_last' if fmt is torch.channels_last else 'NCHW'}"
+        result[label] = (max(rel_err(a, b) for a, b in zip(ys, ref)),
+                         max((rel_err(a, b) for a, b in zip(grads, ref_grads)), default=0.0), lost)
+    return result
+
+
+def check(name, m, x, train, rtol, grad_rtol, layout_tol=1e-4, reference=None):
+    """Print the drift of m and return the bound violations; reference: drift() of a model whose drift is the bound."""
+    failures = []
+    for label, (err, gerr, lost) in drift(m, x, train).items():
+        tol, gtol = (rtol, grad_rtol) if label.startswith('bf16') else (layout_tol, layout_tol)
+        if reference:
+            tol, gtol = max(tol, reference[label][0] * 1.25), max(gtol, reference[label][1] * 1.25)
+        print(f'{name:14s} {"train" if train else "eval ":5s} {label:18s}: output {err:.2e}'
+              + (f' | grads {gerr:.2e}' if train else '') + (f' | layout lost in {", ".join(lost)}' if lost else ''))
+        if err > tol or gerr > gtol:
+            failures.append(f'{name} {label}: drift {err:.2e} / {gerr:.2e} over {tol:.1e} / {gtol:.1e}')
+        if lost:
+            failures.append(f'{name} {label}: {", ".join(lost)} output is not channels_last')
+    return failures
+
+
+def check_kernels(model):
+    """Reparameterized kernels generated under bf16 autocast are bit-identical to fp32 generation (before the cast)."""
+    failures = []
+    for name, m in model.named_modules():
+        if hasattr(m, 'weight_gen') and hasattr(m, 'get_weight'):
+            with torch.no_grad():
+                ref = m.weight_gen()
+                with torch.autocast('cpu', dtype=torch.bfloat16):
+                    m._weight_cache = None
+                    cast = m.get_weight()
+                m._weight_cache = None
+            if cast.dtype != torch.bfloat16 or not torch.equal(cast, ref.to(torch.bfloat16)):
+                failures.append(f'{name}: kernel generated under autocast differs from the fp32 kernel')
+    return failures
+
+
+def synthetic_dataset(folder, n=4, imgsz=64):
+    """n random images with one random box each, as a YOLO dataset YAML in folder; returns the YAML path."""
+    rng = np.random.default_rng(0)
+    for d in ('images', 'labels'):
+        os.makedirs(os.path.join(folder, d), exist_ok=True)
+    for i in range(n):
+        cv2.imwrite(os.path.join(folder, 'images', f'{i}.jpg'), rng.integers(0, 255, (imgsz, imgsz, 3), np.uint8))
+        with open(os.path.join(folder, 'labels', f'{i}.txt'), 'w') as f:
+            f.write(f'0 {rng.uniform(0.3, 0.7):.3f} {rng.uniform(0.3, 0.7):.3f} 0.2 0.2\n')
+    path = os.path.join(folder, 'data.yaml')
+    with open(path, 'w') as f:
+        f.write(f'path: {folder}\ntrain: images\nval: images\nnames: {{0: object}}\n')
+    return path
+
+
+def check_trainer_bf16(imgsz=64):
+    """Train FogDetectionTrainer with bf16 for one epoch and check the dtype of the first convolution's output.
+
+    Ultralytics runs forward + loss inside autocast(amp, device='cpu'), disabled on CPU, so an autocast entered
+    outside the model call would be switched off there.
+    """
+    from fog_augment import FogDetectionTrainer
+
+    dtypes = set()
+
+    def watch(trainer):
+        conv = next(m for m in trainer.model.modules() if isinstance(m, torch.nn.Conv2d))
+        conv.register_forward_hook(lambda m, args, y: dtypes.add(y.dtype) if m.training else None)
+
+    with tempfile.TemporaryDirectory() as folder:
+        args = dict(model=MODEL_CFG, data=synthetic_dataset(folder, imgsz=imgsz), epochs=1, imgsz=imgsz,
+                    batch=2, device='cpu', workers=0, val=False, plots=False, amp=False, project=folder,
+                    name='train', exist_ok=True, verbose=False)
+        trainer = FogDetectionTrainer(overrides={**args, 'fog': None, 'bf16': True})
+        trainer.add_callback('on_pretrain_routine_end', watch)
+        trainer.train()
+    print(f'FogDetectionTrainer bf16: training conv outputs {", ".join(sorted(map(str, dtypes)))}')
+    return [] if dtypes == {torch.bfloat16} else [f'FogDetectionTrainer bf16 trains in {dtypes}, not bfloat16']
+
+
+@torch.no_grad()
+def bench(name, m, x, repeat):
+    m.eval()
+    times = []
+    for fmt in (torch.contiguous_format, torch.channels_last):
+        xf = x.contiguous(memory_format=fmt)
+        for bf16 in (False, True):
+            with precision(bf16):
+                times.append(fmt_ms(min(timeit(lambda: m(xf), repeat))))
+    print(f'{name:14s} NCHW fp32 {times[0]} bf16 {times[1]} | channels_last fp32 {times[2]} bf16 {times[3]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--size', type=int, default=40, help='feature map size of the module checks')
+    parser.add_argument('--imgsz', type=int, default=160, help='image size of the whole-model check')
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--scale', default='n', help='model scale')
+    parser.add_argument('--rtol', type=float, default=2e-2, help='bf16 bound on the relative L2 error of outputs')
+    parser.add_argument('--grad-rtol', type=float, default=5e-2, help='bf16 bound on the relative error of grads')
+    parser.add_argument('--repeat', type=int, default=10)
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    cases = {k: (f(opt.channels), torch.randn(opt.batch, opt.channels, opt.size, opt.size)) for k, f in MODULES.items()}
+    cases['model'] = (build_model(scale=opt.scale), torch.rand(opt.batch, 3, opt.imgsz, opt.imgsz))
+
+    stock = build_model(f'yolo11{opt.scale}.yaml', opt.scale)
+    failures = []
+    for name, (m, x) in cases.items():
+        for train in (True, False):
+            torch.manual_seed(0)
+            reference = drift(stock, x, True) if name == 'model' and train else None
+            failures += check(name, m, x, train, opt.rtol, opt.grad_rtol, reference=reference)
+    failures += check_kernels(cases['model'][0].eval())
+    failures += check_trainer_bf16()
+    if failures:
+        raise SystemExit('\n'.join(failures))
+    print('all drift, layout and kernel checks passed\n')
+
+    for name, (m, x) in cases.items():
+        bench(name, m, x, opt.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Load generator for serve.py: closed-loop or fixed-rate HTTP clients on one machine.
+
+Sends JPEG images to POST /predict and reports client-side throughput and latency percentiles, the number of 503
+(backpressure) answers and the server's own metrics (queue wait, forward time, mean batch size). With --spawn the
+server is started with the given arguments, so batching configurations can be compared in one command.
+
+Usage:
+    python serve.py --max-batch 8 --max-wait 5 &
+    python benchmarks/bench_serve.py --concurrency 16 --duration 20
+    python benchmarks/bench_serve.py --spawn "--max-batch 1" "--max-batch 8 --max-wait 5" --concurrency 16
+"""
+
+import sys
+import json
+import time
+import shlex
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+import cv2
+import numpy as np
+
+from common import ROOT
+
+
+async def request(host, port, method, path, body=b'', connection=None):
+    """One HTTP/1.1 request over a kept-alive (reader, writer) connection, returns (status, json body, connection)."""
+    if connection is None:
+        connection = await asyncio.open_connection(host, port)
+    reader, writer = connection
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (h := await reader.readline()) not in (b'\r\n', b''):
+        k, _, v = h.decode('latin-1').partition(':')
+        headers[k.strip().lower()] = v.strip()
+    payload = json.loads(await reader.readexactly(int(headers['content-length'])))
+    return status, payload, connection
+
+
+class Stats:
+    def __init__(self):
+        self.latency, self.rejected, self.errors = [], 0, 0
+
+    def record(self, status, seconds):
+        if status == 200:
+            self.latency.append(seconds)
+        elif status == 503:
+            self.rejected += 1
+        else:
+            self.errors += 1
+
+
+async def closed_loop(host, port, image, concurrency, duration, stats):
+    """concurrency clients that each send the next request as soon as the previous one is answered."""
+    end = time.perf_counter() + duration
+
+    async def client():
+        connection = None
+        while time.perf_counter() < end:
+            t = time.perf_counter()
+            status, _, connection = await request(host, port, 'POST', '/predict', image, connection)
+            stats.record(status, time.perf_counter() - t)
+            if status == 503:
+                await asyncio.sleep(0.01)  # back off on backpressure
+        connection[1].close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+async def open_loop(host, port, image, rate, duration, stats):
+    """Poisson arrivals at rate requests/s regardless of how fast the server answers."""
+    rng = np.random.default_rng(0)
+    end, tasks = time.perf_counter() + duration, []
+
+    async def one():
+        t = time.perf_counter()
+        status, _, connection = await request(host, port, 'POST', '/predict', image)
+        stats.record(status, time.perf_counter() - t)
+        connection[1].close()
+
+    while time.perf_counter() < end:
+        tasks.append(asyncio.create_task(one()))
+        await asyncio.sleep(rng.exponential(1 / rate))
+    await asyncio.gather(*tasks)
+
+
+async def run(opt, image):
+    stats = Stats()
+    start = time.perf_counter()
+    if opt.rate:
+        await open_loop(opt.host, opt.port, image, opt.rate, opt.duration, stats)
+    else:
+        await closed_loop(opt.host, opt.port, image, opt.concurrency, opt.duration, stats)
+    elapsed = time.perf_counter() - start
+    _, server, connection = await request(opt.host, opt.port, 'GET', '/metrics')
+    connection[1].close()
+    lat = sorted(stats.latency)
+    q = statistics.quantiles(lat, n=100, method='inclusive') if len(lat) > 1 else [lat[0] if lat else 0.0] * 99
+    print(f'  client: {len(lat) / elapsed:7.1f} img/s | latency p50 {q[49] * 1e3:7.1f} ms p90 {q[89] * 1e3:7.1f} ms '
+          f'p99 {q[98] * 1e3:7.1f} ms | {stats.rejected} rejected (503), {stats.errors} errors')
+    print(f"  server: mean batch {server['mean_batch']:.2f} | queue wait p50 {server['queue_wait_ms']['p50']:.1f} ms | "
+          f"forward p50 {server['forward_ms']['p50']:.1f} ms")
+
+
+async def wait_healthy(host, port, timeout=300):
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        try:
+            status, _, connection = await request(host, port, 'GET', '/health')
+            connection[1].close()
+            if status == 200:
+                return
+        except OSError:
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f'server on {host}:{port} did not come up')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--image', default=None, help='image to send, a random 640x480 JPEG if omitted')
+    parser.add_argument('--concurrency', type=int, default=16, help='closed-loop clients')
+    parser.add_argument('--rate', type=float, default=None, help='open-loop requests/s instead of closed loop')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per run')
+    parser.add_argument('--spawn', nargs='+', default=None, metavar='SERVER_ARGS',
+                        help='start serve.py with each argument string in turn and benchmark it')
+    opt = parser.parse_args()
+
+    if opt.image:
+        with open(opt.image, 'rb') as f:
+            image = f.read()
+    else:
+        noise = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        image = cv2.imencode('.jpg', noise)[1].tobytes()
+
+    for server_args in opt.spawn or [None]:
+        proc = None
+        if server_args is not None:
+            cmd = [sys.executable, 'serve.py', '--host', opt.host, '--port', str(opt.port), *shlex.split(server_args)]
+            proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_healthy(opt.host, opt.port))
+            print(f"server {server_args or f'{opt.host}:{opt.port}'}:")
+            asyncio.run(run(opt, image))
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == '__main__':
+    main()
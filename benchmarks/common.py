@@ -0,0 +1,36 @@
+"""Shared helpers for the benchmark scripts: repo import path, timing and CPU memory accounting."""
+
+import os
+import sys
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from utils import allocation_stats, build_model, count_params, peak_memory, timeit  # noqa: E402,F401
+
+
+def saved_tensor_bytes(fn):
+    """Bytes of tensors autograd saves for backward while fn runs (activation memory held until backward)."""
+    seen, total = set(), [0]
+
+    def pack(t):
+        key = (t.untyped_storage().data_ptr(), t.untyped_storage().nbytes())
+        if key not in seen:
+            seen.add(key)
+            total[0] += key[1]
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn()
+    return total[0]
+
+
+def fmt_bytes(n):
+    return f'{n / 2 ** 20:8.2f} MiB'
+
+
+def fmt_ms(seconds):
+    return f'{seconds * 1e3:8.2f} ms'
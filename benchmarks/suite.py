@@ -0,0 +1,275 @@
+"""CPU benchmark suite of the custom blocks and the full model, with JSON results and regression checks.
+
+Every case runs in a fresh process with fixed thread settings and reports latency percentiles, throughput, peak RSS
+growth and the number / bytes of tensor allocations of one call. Train-mode cases time forward + backward, eval-mode
+cases an inference-mode forward.
+
+Results are written as JSON and can be compared against a baseline (benchmarks/baselines/cpu.json by default); a
+case regresses when a metric grows by more than its threshold, and the script then exits with status 1. Allocation
+metrics are always gated. Latency and peak RSS are gated when the baseline was recorded in the same environment
+(torch, cores, threads) and only reported otherwise; --no-gate-latency reports them without gating, for shared
+machines whose run-to-run noise exceeds the thresholds. --threads never exceeds the available cores, oversubscribed
+threads measure the scheduler.
+
+Usage:
+    python benchmarks/suite.py --out results.json                      # run everything
+    python benchmarks/suite.py -k orepa dsconv --compare               # subset, compare with the baseline
+    python benchmarks/suite.py --compare --threshold p50_ms=0.05 allocations=0
+    python benchmarks/suite.py --save-baseline                         # refresh benchmarks/baselines/cpu.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from common import ROOT, allocation_stats, build_model, timeit
+
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baselines', 'cpu.json')
+THRESHOLDS = {'p50_ms': 0.10, 'p90_ms': 0.15, 'peak_rss_bytes': 0.20, 'allocations': 0.05, 'allocated_bytes': 0.05}
+NOISE = {'p50_ms': 0.5, 'p90_ms': 1.0, 'peak_rss_bytes': 4 * 2 ** 20}  # absolute growth always tolerated
+GATED = ('allocations', 'allocated_bytes')  # deterministic per call, gated in any environment
+SCALES = 'nsmlx'
+
+
+def _orepa(deploy):
+    from C3k2_OREPA import OREPA
+    m = OREPA(64, 64, 3)
+    if deploy:
+        m.switch_to_deploy()
+    return m, (1, 64, 80, 80)
+
+
+def _repvgg(deploy):
+    from C3k2_OREPA import OREPA_3x3_RepVGG
+    m = OREPA_3x3_RepVGG(64, 64, 3)
+    if deploy:
+        m.switch_to_deploy()
+    return m, (1, 64, 80, 80)
+
+
+def _conv(cls):
+    if cls == 'dsconv':
+        from DSConv import DSConv2D as cls
+    else:
+        from ultralytics.nn.modules.conv import Conv as cls
+    return cls(64, 128, 3, 2), (1, 64, 160, 160)
+
+
+def _attention(cls):
+    if cls == 'ese':
+        from ESE import EffectiveSELayer
+        m = EffectiveSELayer(256)
+    else:
+        from C3k2_OREPA import SEAttention
+        m = SEAttention(256)
+    return m, (1, 256, 20, 20)
+
+
+def _csp(cls):
+    from C3k2_OREPA import C3k2, C3k2_OREPA
+    return {'c3k2': C3k2, 'c3k2_orepa': C3k2_OREPA}[cls](128, 128, 2, False), (1, 128, 40, 40)
+
+
+def _model(scale):
+    return build_model(scale=scale), (1, 3, 640, 640)
+
+
+# name -> (factory, argument, mode); factories return (module, input shape)
+CASES = {'orepa/train': (_orepa, False, 'train'),
+         'orepa/eval': (_orepa, False, 'eval'),
+         'orepa/deploy': (_orepa, True, 'eval'),
+         'orepa_3x3_repvgg/train': (_repvgg, False, 'train'),
+         'orepa_3x3_repvgg/eval': (_repvgg, False, 'eval'),
+         'orepa_3x3_repvgg/deploy': (_repvgg, True, 'eval'),
+         'conv/eval': (_conv, 'conv', 'eval'),
+         'dsconv2d/eval': (_conv, 'dsconv', 'eval'),
+         'conv/train': (_conv, 'conv', 'train'),
+         'dsconv2d/train': (_conv, 'dsconv', 'train'),
+         'se_attention/eval': (_attention, 'se', 'eval'),
+         'effective_se/eval': (_attention, 'ese', 'eval'),
+         'c3k2/eval': (_csp, 'c3k2', 'eval'),
+         'c3k2_orepa/eval': (_csp, 'c3k2_orepa', 'eval'),
+         'c3k2/train': (_csp, 'c3k2', 'train'),
+         'c3k2_orepa/train': (_csp, 'c3k2_orepa', 'train'),
+         **{f'model_{s}/eval': (_model, s, 'eval') for s in SCALES}}
+
+
+def rss():
+    import psutil
+    return psutil.Process().memory_info().rss
+
+
+def max_rss():
+    try:
+        import resource
+    except ImportError:  # Windows: peak working set, current RSS where psutil has no peak
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform == 'darwin' else r * 1024  # bytes on macOS, KiB on Linux
+
+
+def run_case(name, threads, repeat, warmup):
+    """Build and measure one case; runs in its own process so that peak RSS belongs to this case alone."""
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    torch.manual_seed(0)
+    factory, arg, mode = CASES[name]
+    module, shape = factory(arg)
+    x = torch.rand(shape)
+    if mode == 'train':
+        module.train()
+
+        def step():
+            module.zero_grad(set_to_none=True)
+            module(x).sum().backward()
+    else:
+        module.eval()
+
+        def step():
+            with torch.inference_mode():
+                module(x)
+
+    rss0 = rss()
+    t = sorted(timeit(step, repeat, warmup))
+    peak = max_rss() - rss0
+    allocations, allocated = allocation_stats(step)
+    q = statistics.quantiles(t, n=100, method='inclusive')
+    return {'mode': mode, 'input': list(shape),
+            'p50_ms': q[49] * 1e3, 'p90_ms': q[89] * 1e3, 'p99_ms': q[98] * 1e3,
+            'mean_ms': statistics.fmean(t) * 1e3, 'min_ms': t[0] * 1e3,
+            'throughput': shape[0] / q[49],  # samples per second at the median
+            'peak_rss_bytes': max(peak, 0), 'allocations': allocations, 'allocated_bytes': allocated}
+
+
+def cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def environment(threads):
+    return {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor() or platform.machine(), 'cpu_count': cores(),
+            'threads': threads, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def same_environment(env, base_env):
+    return all(env[k] == base_env[k] for k in ('torch', 'cpu_count', 'threads'))
+
+
+def run(names, threads=4, repeat=20, warmup=3):
+    """Run the named cases, each in a fresh spawned process, and return the JSON-able results document."""
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for name in names:
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            results[name] = r = pool.submit(run_case, name, threads, repeat, warmup).result()
+        print(f"{name:26s} p50 {r['p50_ms']:9.2f} ms  p90 {r['p90_ms']:9.2f} ms  p99 {r['p99_ms']:9.2f} ms  "
+              f"{r['throughput']:9.1f}/s  rss +{r['peak_rss_bytes'] / 2 ** 20:7.1f} MiB  "
+              f"{r['allocations']:5d} allocs {r['allocated_bytes'] / 2 ** 20:8.1f} MiB", flush=True)
+    return {'environment': environment(threads), 'results': results}
+
+
+def compare(current, baseline, thresholds):
+    """Regressions of current against baseline as (case, metric, baseline value, current value, relative change)."""
+    regressions = []
+    for name, r in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric, limit in thresholds.items():
+            b, c = base.get(metric), r.get(metric)
+            if b is None or c is None:
+                continue
+            change = (c - b) / b if b else float(c > 0)
+            if change > limit and c - b > NOISE.get(metric, 0):
+                regressions.append((name, metric, b, c, change))
+    return regressions
+
+
+def parse_thresholds(items):
+    thresholds = dict(THRESHOLDS)
+    for item in items or ():
+        metric, _, value = item.partition('=')
+        if metric not in THRESHOLDS:
+            raise SystemExit(f'unknown threshold metric {metric!r}, expected one of {", ".join(THRESHOLDS)}')
+        thresholds[metric] = float(value)
+    return thresholds
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', nargs='+', default=None, help='only run cases whose name contains one of these')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--threads', type=int, default=min(4, cores()),
+                        help='torch intra-op threads (inter-op is fixed to 1), at most the available cores')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per case')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--out', default=None, help='write the results JSON here')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline JSON for --compare / --save-baseline')
+    parser.add_argument('--compare', action='store_true', help='compare with --baseline, exit 1 on regression')
+    parser.add_argument('--threshold', nargs='+', metavar='METRIC=FRACTION',
+                        help=f'allowed relative growth per metric, defaults {THRESHOLDS}')
+    parser.add_argument('--no-gate-latency', action='store_true',
+                        help='only report latency / peak RSS regressions, which are otherwise gated when the '
+                             'environment matches the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    opt = parseArgs(argv)
+    names = [n for n in CASES if not opt.k or any(k in n for k in opt.k)]
+    if opt.list:
+        print('\n'.join(names))
+        return
+    thresholds = parse_thresholds(opt.threshold)
+    if opt.threads > cores():
+        raise SystemExit(f'--threads {opt.threads} oversubscribes the {cores()} available cores')
+    current = run(names, opt.threads, opt.repeat, opt.warmup)
+    outputs = ([opt.out] if opt.out else []) + ([opt.baseline] if opt.save_baseline else [])
+    for path in outputs:
+        if opt.save_baseline and path == opt.baseline and os.path.exists(path) and opt.k:
+            with open(path, 'r', encoding='utf-8') as f:  # partial run: update only the measured cases
+                doc = json.load(f)
+            doc['results'].update(current['results'])
+            doc['environment'] = current['environment']
+        else:
+            doc = current
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(doc, f, indent=1)
+        print(f'wrote {path}')
+
+    if opt.compare:
+        with open(opt.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        env, base_env = current['environment'], baseline['environment']
+        for key in ('torch', 'threads', 'cpu_count'):
+            if env[key] != base_env[key]:
+                print(f'warning: {key} differs from the baseline ({env[key]} vs {base_env[key]})')
+        gate_latency = not opt.no_gate_latency and same_environment(env, base_env)
+        if not opt.no_gate_latency and not gate_latency:
+            print('latency is not gated: the baseline was recorded in another environment')
+        regressions = []
+        for name, metric, b, c, change in compare(current, baseline, thresholds):
+            gated = metric in GATED or gate_latency
+            print(f'{"REGRESSION" if gated else "note"} {name} {metric}: {b:.4g} -> {c:.4g} '
+                  f'(+{change:.1%}, limit +{thresholds[metric]:.0%})')
+            regressions += [name] if gated else []
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {opt.baseline}')
+
+
+if __name__ == '__main__':
+    main()
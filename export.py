@@ -0,0 +1,214 @@
+import os
+import copy
+import json
+import time
+import argparse
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from ultralytics.nn.modules.head import Detect
+
+from C3k2_OREPA import C2f
+from reparam import randomize_stats, relative_error, reparameterize
+from utils import MODEL_CFG, build_model, flatten_outputs, load_model
+
+FORMATS = ('torchscript', 'onnx')
+SUFFIX = {'torchscript': '.torchscript', 'onnx': '.onnx', 'eager': '.pt'}
+
+
+@torch.no_grad()
+def prepare(model):
+    """Deploy copy of model: reparameterized, frozen, and with Detect returning only its (B, 4 + nc, anchors) tensor.
+
+    After reparameterize() no OREPA kernel generation, DSConv quantizer or BN remains, every conv is a plain
+    nn.Conv2d, so tracing records a static graph of aten convolutions. C2f-family blocks use forward_split (cleaner
+    ONNX graph, the concat buffers are bypassed while tracing anyway).
+    """
+    model = reparameterize(copy.deepcopy(model)).float().requires_grad_(False)
+    for m in model.modules():
+        if isinstance(m, Detect):
+            m.export, m.format, m.dynamic, m.shape = True, 'torchscript', False, None
+        elif isinstance(m, C2f):
+            m.forward = m.forward_split
+    return model
+
+
+def metadata(model, imgsz, batch, dynamic_batch=False):
+    return {'imgsz': [imgsz, imgsz], 'batch': batch, 'dynamic': dynamic_batch, 'stride': int(model.stride.max()),
+            'names': getattr(model, 'names', None), 'task': 'detect'}
+
+
+@torch.no_grad()
+def export_torchscript(model, x, f):
+    """Trace model at the static input x, freeze it (parameters become graph constants) and save it to f."""
+    ts = torch.jit.freeze(torch.jit.trace(model, x, strict=False))
+    meta = metadata(model, x.shape[-1], x.shape[0])
+    torch.jit.save(ts, f, _extra_files={'config.txt': json.dumps(meta)})  # read back by ultralytics AutoBackend
+    return f
+
+
+@torch.no_grad()
+def export_onnx(model, x, f, opset=17, dynamic_batch=False, simplify=True):
+    """Export model at the input x to ONNX with constant folding; needs the onnx package.
+
+    With dynamic_batch the batch axis of input and output is symbolic, the image size stays static.
+    """
+    import onnx
+
+    dynamic = {'images': {0: 'batch'}, 'output0': {0: 'batch'}} if dynamic_batch else None
+    torch.onnx.export(model, x, f, dynamo=False, opset_version=opset, do_constant_folding=True,
+                      input_names=['images'], output_names=['output0'], dynamic_axes=dynamic)
+    proto = onnx.load(f)
+    if simplify:
+        try:
+            import onnxslim
+            proto = onnxslim.slim(proto)
+        except ImportError:
+            pass
+    for k, v in metadata(model, x.shape[-1], x.shape[0], dynamic_batch).items():
+        proto.metadata_props.add(key=k, value=json.dumps(v))
+    onnx.checker.check_model(proto)
+    onnx.save(proto, f)
+    return f
+
+
+def load_artifact(f):
+    """Callable inference function of an exported artifact: TorchScript, ONNX (via onnxruntime) or eager .pt."""
+    if f.endswith(SUFFIX['onnx']):
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(f, providers=['CPUExecutionProvider'])
+        name = session.get_inputs()[0].name
+        return lambda x: torch.from_numpy(session.run(None, {name: x.numpy()})[0])
+    if f.endswith(SUFFIX['torchscript']):
+        return torch.jit.load(f, map_location='cpu')
+    model = load_model(f)
+    return lambda x: model(x)[0]
+
+
+@torch.no_grad()
+def check_equivalence(reference, f, imgsz, batch=1, n=2, rtol=1e-3, seed=0):
+    """Worst error of the artifact f against the eager reference model, per output channel as in reparam.verify().
+
+    batch may be a list of batch sizes, each is checked n times (a dynamic-batch artifact at other sizes than the
+    traced one). A randomly initialized reference needs reparam.randomize_stats() before the export.
+    """
+    g = torch.Generator().manual_seed(seed)
+    run = load_artifact(f)
+    reference.eval()
+    worst = 0.0
+    for size in ([batch] if isinstance(batch, int) else batch):
+        for _ in range(n):
+            x = torch.rand(size, 3, imgsz, imgsz, generator=g)
+            worst = max(worst, relative_error(flatten_outputs(reference(x))[0], run(x)))
+    if worst > rtol:
+        raise AssertionError(f'{f} deviates from the eager model: relative error {worst:.2e} > {rtol:.0e}')
+    return worst
+
+
+def _bench_artifact(f, imgsz, batch, repeat, threads):
+    torch.set_num_threads(threads)
+    x = torch.rand(batch, 3, imgsz, imgsz)
+    t = time.perf_counter()
+    run = load_artifact(f)
+    load = time.perf_counter() - t
+    with torch.inference_mode():
+        t = time.perf_counter()
+        run(x)
+        first = time.perf_counter() - t
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            run(x)
+            times.append(time.perf_counter() - t)
+    return load, first, statistics.median(times)
+
+
+def bench_artifact(f, imgsz, batch=1, repeat=10, threads=None):
+    """Load time, first-inference and steady-state median latency of f, measured in a fresh process (cold start)."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_bench_artifact, f, imgsz, batch, repeat, threads or torch.get_num_threads()).result()
+
+
+def export(model, stem, imgsz=(640,), batch=1, formats=FORMATS, rtol=1e-3, bench=True, repeat=10, threads=None,
+           dynamic_batch=False):
+    """Export model for every input size in imgsz (one static-shape artifact per size) and every format.
+
+    Each artifact is checked against the eager model and, with bench, timed for load + first inference next to the
+    eager fused checkpoint. dynamic_batch makes the ONNX batch axis symbolic (TorchScript stays traced at batch), it
+    is checked at batch and batch + 1. Returns {(format, imgsz): path}.
+    """
+    model = model.eval()
+    deploy = prepare(model)
+    os.makedirs(os.path.dirname(os.path.abspath(stem)), exist_ok=True)
+    artifacts = {}
+    for size in imgsz:
+        x = torch.zeros(batch, 3, size, size)
+        with torch.no_grad():
+            for _ in range(2):
+                deploy(x)  # dry runs: Detect builds its anchors for this size once, outside the traced graph
+        base = f'{stem}_{size}' if len(imgsz) > 1 else stem
+        if bench:
+            artifacts['eager', size] = f = base + SUFFIX['eager']
+            torch.save({'model': deploy}, f)
+        for fmt in formats:
+            f = base + SUFFIX[fmt]
+            try:
+                if fmt == 'torchscript':
+                    export_torchscript(deploy, x, f)
+                else:
+                    export_onnx(deploy, x, f, dynamic_batch=dynamic_batch)
+            except ImportError as e:
+                print(f'{fmt} export skipped: {e}')
+                continue
+            artifacts[fmt, size] = f
+            try:
+                sizes = [batch, batch + 1] if dynamic_batch and fmt == 'onnx' else batch
+                err = check_equivalence(model, f, size, sizes, rtol=rtol)
+                print(f'{f}: {os.path.getsize(f) / 2 ** 20:.2f} MB, max relative error vs eager {err:.2e}')
+            except ImportError as e:
+                print(f'{f}: {os.path.getsize(f) / 2 ** 20:.2f} MB, equivalence check skipped: {e}')
+    if bench:
+        print(f"{'artifact':40s} {'load ms':>9s} {'first ms':>9s} {'median ms':>10s}")
+        for (fmt, size), f in artifacts.items():
+            try:
+                load, first, median = bench_artifact(f, size, batch, repeat, threads)
+            except ImportError as e:
+                print(f'{f:40s} skipped: {e}')
+                continue
+            print(f'{f:40s} {load * 1e3:9.1f} {first * 1e3:9.1f} {median * 1e3:10.2f}')
+        for size in imgsz:
+            os.remove(artifacts.pop(('eager', size)))
+    return artifacts
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Reparameterize and export a model to TorchScript / ONNX')
+    parser.add_argument('--weights', default=None, help='checkpoint to export, builds --cfg with random weights if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--imgsz', type=int, nargs='+', default=[640], help='input sizes, one static artifact each')
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--dynamic-batch', action='store_true', help='symbolic batch axis in the ONNX artifact')
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=FORMATS)
+    parser.add_argument('--output', default=None, help='artifact path without suffix, defaults next to --weights')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='allowed relative error against the eager model')
+    parser.add_argument('--no-bench', action='store_true', help='skip the load / first-inference benchmark')
+    parser.add_argument('--repeat', type=int, default=10, help='timed inferences after the first one')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    if opt.weights:
+        model = load_model(opt.weights)
+    else:  # random BN statistics and branch vectors, otherwise the equivalence check compares collapsed outputs
+        model = randomize_stats(build_model(opt.cfg, opt.scale)).eval()
+    stem = opt.output or (os.path.splitext(opt.weights)[0] if opt.weights else f'deo-yolo{opt.scale}')
+    export(model, stem, opt.imgsz, opt.batch, opt.formats, opt.rtol, not opt.no_bench, opt.repeat, opt.threads,
+           opt.dynamic_batch)
@@ -1,15 +1,89 @@
-
-
-
 import os
 import cv2
+import json
 import math
+import time
 import shutil
+import hashlib
+import argparse
+import threading
+import numpy as np
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# 透射率图缓存: 同一数据集中的大部分图片分辨率相同, 以 (row, col, beta, A, center) 为键复用
+_TD_CACHE = OrderedDict()
+_TD_CACHE_SIZE = 16
+
+IMAGE_EXTS = ('.jpg', '.png', '.jpeg')
+MANIFEST_NAME = '.fog_manifest.json'
+
+
+@lru_cache(maxsize=4)
+def distanceMap(row, col, center):
+    '''
+    计算 d = -0.02 * 到雾化中心的距离 + 雾化尺寸, 与 beta, A 无关, 多个雾浓度共享
+    返回 (row, col) 的 float64 只读数组
+    '''
+    size = math.sqrt(max(row, col))  # 雾化尺寸
+    dj = np.arange(row, dtype=np.float64)[:, None] - center[0]
+    dl = np.arange(col, dtype=np.float64)[None, :] - center[1]
+    d = -0.02 * np.sqrt(dj * dj + dl * dl) + size
+    d.flags.writeable = False
+    return d
+
+
+def transmissionMap(row, col, beta=0.02, A=0.5, center=None):
+    '''
+    计算大气散射模型的透射率图, 结果按 (row, col, beta, A, center) 缓存
+    row, col 是图片的高和宽
+    center 是雾化中心 (行, 列), 默认为图片中心
+    返回 (td, airlight), 两者均为 (row, col, 1) 的 float32 数组:
+    td = exp(-beta * d), airlight = 255 * A * (1 - td)
+    '''
+    if center is None:
+        center = (row // 2, col // 2)
+    key = (row, col, float(beta), float(A), tuple(center))
+    cached = _TD_CACHE.get(key)
+    if cached is not None:
+        _TD_CACHE.move_to_end(key)
+        return cached
+
+    td = np.exp(-beta * distanceMap(row, col, tuple(center)))
+    airlight = (255.0 * A) * (1.0 - td)
+    cached = (td.astype(np.float32)[..., None], airlight.astype(np.float32)[..., None])
+
+    _TD_CACHE[key] = cached
+    if len(_TD_CACHE) > _TD_CACHE_SIZE:
+        _TD_CACHE.popitem(last=False)
+    return cached
+
+
+def fogImage(img, beta=0.02, A=0.5, center=None):
+    '''
+    对内存中的 uint8 图片 (H, W) 或 (H, W, C) 整体计算 I * td + A * (1 - td)
+    直接在 [0, 255] 范围内计算, 不生成 img / 255.0 的 float64 副本
+    返回 uint8 图片
+    '''
+    row, col = img.shape[:2]
+    td, airlight = transmissionMap(row, col, beta, A, center)
+    if img.ndim == 2:
+        td, airlight = td[..., 0], airlight[..., 0]
+
+    out = np.multiply(img, td, dtype=np.float32)
+    out += airlight
+    # 与 cv2.imwrite 对浮点图的 saturate_cast 一致: 四舍五入并截断到 [0, 255]
+    np.rint(out, out=out)
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
 
-def processImage(filepath, destsource):
+
+def processImage(filepath, destsource, A=0.5, beta=0.02, center=None):
     '''
     filepath是待处理图片的绝对路径
     destsource是存放雾化后图片的目录
+    A是亮度, beta是雾的浓度, center是雾化中心 (默认为图片中心)
     '''
     # 打开图片
     img = cv2.imread(filepath)
@@ -17,19 +91,7 @@ def processImage(filepath, destsource):
         print(f"无法读取图片：{filepath}")
         return
 
-    img_f = img / 255.0
-    (row, col, chs) = img.shape
-
-    A = 0.5  # 亮度
-    beta = 0.02  # 雾的浓度
-    size = math.sqrt(max(row, col))  # 雾化尺寸
-    center = (row // 2, col // 2)  # 雾化中心
-
-    for j in range(row):
-        for l in range(col):
-            d = -0.02 * math.sqrt((j - center[0]) ** 2 + (l - center[1]) ** 2) + size
-            td = math.exp(-beta * d)
-            img_f[j][l][:] = img_f[j][l][:] * td + A * (1 - td)
+    img_fog = fogImage(img, beta, A, center)
 
     # 确保输出目录存在
     if not os.path.exists(destsource):
@@ -37,44 +99,248 @@ def processImage(filepath, destsource):
 
     # 保存雾化后的图片
     output_path = os.path.join(destsource, os.path.basename(filepath))
-    cv2.imwrite(output_path, img_f * 255)
+    cv2.imwrite(output_path, img_fog)
 
 def processLabels(label_path, dest_labels):
     '''
-    复制标签文件到新的目录
+    将标签文件放到新的目录
     label_path是待处理标签的绝对路径
     dest_labels是存放更新后标签文件的目录
+    文件系统支持时使用硬链接, 否则退回到复制; 已有的副本大小和修改时间与原文件一致时不再复制
     '''
     if not os.path.exists(dest_labels):
-        os.makedirs(dest_labels)
+        os.makedirs(dest_labels, exist_ok=True)
+
+    dest_path = os.path.join(dest_labels, os.path.basename(label_path))
+    if os.path.exists(dest_path):
+        if os.path.samefile(label_path, dest_path):
+            return
+        src, dst = os.stat(label_path), os.stat(dest_path)
+        if src.st_size == dst.st_size and src.st_mtime_ns == dst.st_mtime_ns:
+            return  # 之前复制的副本 (copy2 保留修改时间) 仍是最新的
+        os.remove(dest_path)
+    try:
+        os.link(label_path, dest_path)
+    except OSError:
+        # 跨盘符/不支持硬链接的文件系统
+        shutil.copy2(label_path, dest_path)
+
+def loadManifest(manifest_path, params):
+    '''
+    读取断点续处理用的清单文件
+    清单记录每张图片的内容哈希, 参数 (A, beta) 改变时清单作废
+    '''
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('params') != params:
+        return {}
+    return manifest.get('images', {})
+
+def saveManifest(manifest_path, params, images):
+    '''
+    原子地写入清单文件, 中断时不会留下损坏的清单
+    '''
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'params': params, 'images': images}, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def _initWorker():
+    # 并行度由进程池提供, 避免每个进程内 OpenCV 再开线程
+    cv2.setNumThreads(1)
 
-    # 复制标签文件
-    shutil.copy(label_path, os.path.join(dest_labels, os.path.basename(label_path)))
+def severityName(beta, A):
+    '''
+    雾浓度等级对应的子目录名
+    '''
+    return f'beta{beta:g}_A{A:g}'
 
-def processDataset(image_dir, label_dir, dest_image_dir, dest_label_dir):
+def _fogBytes(data, ext, severities, imgsz=None, encode=True):
+    '''
+    进程池任务: 解码一次 -> 按每个 (beta, A) 雾化, 返回 (编码后的字节列表, 分片数据), 失败返回 None
+    encode 为 False 时不编码 (图片已是最新, 只需写分片), 字节列表为空
+    imgsz 不为 None 时分片数据为 ((h0, w0), 按长边缩放到 imgsz 的雾化图片列表), 否则为 None
+    '''
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    outputs, resized = [], []
+    for beta, A in severities:
+        fogged = fogImage(img, beta, A)
+        if encode:
+            ok, buf = cv2.imencode(ext, fogged)
+            if not ok:
+                return None
+            outputs.append(buf.tobytes())
+        if imgsz is not None:
+            from shards import resize_long_side
+            resized.append(resize_long_side(fogged, imgsz))
+    return outputs, (img.shape[:2], resized) if imgsz is not None else None
+
+def processDataset(image_dir, label_dir, dest_image_dir, dest_label_dir, A=0.5, beta=0.02,
+                   workers=None, io_threads=4, resume=True, verbose=True, severities=None,
+                   shards=None, imgsz=640, shard_size=1024):
     '''
     处理整个数据集，将图像和标签分别存储到指定目录
     image_dir: 原始图片文件夹
     label_dir: 原始标签文件夹
     dest_image_dir: 雾化后图片存储文件夹
     dest_label_dir: 更新标签存储文件夹
+    A, beta: 雾的亮度和浓度
+    workers: 解码/雾化/编码的进程数, 默认为 CPU 核数
+    io_threads: 读写文件的线程数
+    resume: 根据 dest_image_dir 中的清单只处理新增或内容变化的图片
+    severities: [(beta, A), ...] 多个雾浓度等级, 每张图片只解码一次, 所有等级共享距离图,
+                分别写入 dest_image_dir/beta*_A*/ 和 dest_label_dir/beta*_A*/, 此时忽略 A, beta 参数;
+                各等级的标签硬链接到同一个原始文件
+    shards: 同时把雾化结果按长边缩放到 imgsz 后写入该文件夹的内存映射分片 (见 shards.py), 与写图片共用同一次解码,
+            只包含本次输出的图片 (同样跳过没有标签的图片); 多个等级时各等级写入 shards/beta*_A*/.
+            分片总是完整重建, 断点续处理跳过的图片仍会解码一次, 只是不再编码写出; 分片内的顺序为完成顺序
+    返回统计信息 dict: total, processed, skipped, failed, seconds, images_per_second
     '''
-    image_files = [f for f in os.listdir(image_dir) if f.endswith(('.jpg', '.png', '.jpeg'))]
+    t0 = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    if severities is None:
+        params = {'A': A, 'beta': beta}
+        severities = [(beta, A)]
+        outputs = [(dest_image_dir, dest_label_dir)]
+    else:
+        severities = [(float(b), float(a)) for b, a in severities]
+        params = {'severities': [list(sev) for sev in severities]}
+        outputs = [(os.path.join(dest_image_dir, severityName(*sev)), os.path.join(dest_label_dir, severityName(*sev)))
+                   for sev in severities]
+    os.makedirs(dest_image_dir, exist_ok=True)
+    for image_out, label_out in outputs:
+        os.makedirs(image_out, exist_ok=True)
+        os.makedirs(label_out, exist_ok=True)
+
+    manifest_path = os.path.join(dest_image_dir, MANIFEST_NAME)
+    manifest = loadManifest(manifest_path, params) if resume else {}
+
+    image_files = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTS))
+    jobs = []
     for image_file in image_files:
-        image_path = os.path.join(image_dir, image_file)
         label_path = os.path.join(label_dir, os.path.splitext(image_file)[0] + '.txt')
 
         if not os.path.exists(label_path):
             print(f"未找到标签文件：{label_path}，跳过该图片。")
             continue
 
-        processImage(image_path, dest_image_dir)
-        processLabels(label_path, dest_label_dir)
+        for _, label_out in outputs:
+            processLabels(label_path, label_out)
+        jobs.append(image_file)
+    manifest = {name: manifest[name] for name in jobs if name in manifest}  # 丢弃已删除的原图的记录
+
+    stats = {'total': len(jobs), 'processed': 0, 'skipped': 0, 'failed': 0}
+    if shards:
+        from shards import read_label, shardWriters
+        writers = shardWriters(shards, imgsz, shard_size, severities)
+    lock = threading.Lock()
+    window = 4 * workers + io_threads  # 同时在内存中的图片数上限
+    slots = threading.BoundedSemaphore(window)
+
+    def finish(name, status, entry=None):
+        with lock:
+            stats[status] += 1
+            if entry is not None:
+                manifest[name] = entry
+            elif status == 'failed':
+                manifest.pop(name, None)
+            if status == 'processed' and stats['processed'] % 200 == 0:
+                saveManifest(manifest_path, params, dict(manifest))
+        slots.release()
+
+    def write(name, entry, future, status='processed'):
+        try:
+            result = future.result()
+            if result is None:
+                print(f"无法读取图片：{os.path.join(image_dir, name)}")
+                finish(name, 'failed')
+                return
+            data, shard = result
+            for (image_out, _), encoded in zip(outputs, data):
+                output_path = os.path.join(image_out, name)
+                with open(output_path + '.tmp', 'wb') as f:
+                    f.write(encoded)
+                os.replace(output_path + '.tmp', output_path)
+            if shard is not None:
+                labels = read_label(os.path.join(label_dir, os.path.splitext(name)[0] + '.txt'))
+                with lock:
+                    for writer, img in zip(writers, shard[1]):
+                        writer.add(name, img, shard[0], labels)
+            finish(name, status, entry)
+        except Exception as e:
+            print(f"处理失败：{name}，{e}")
+            finish(name, 'failed')
+
+    def read(name):
+        try:
+            image_path = os.path.join(image_dir, name)
+            st = os.stat(image_path)
+            entry = manifest.get(name)
+            done = all(os.path.exists(os.path.join(image_out, name)) for image_out, _ in outputs)
+            unchanged = done and entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+            if unchanged and not shards:
+                finish(name, 'skipped')
+                return
+            with open(image_path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            new_entry = {'hash': digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            skip = bool(done and entry and entry['hash'] == digest)  # 仅修改时间变化时也跳过
+            if skip and not shards:
+                finish(name, 'skipped', new_entry)
+                return
+            future = pool.submit(_fogBytes, data, os.path.splitext(name)[1], severities,
+                                 imgsz if shards else None, not skip)
+            status = 'skipped' if skip else 'processed'
+            future.add_done_callback(lambda fut: io.submit(write, name, new_entry, fut, status))
+        except Exception as e:
+            print(f"处理失败：{name}，{e}")
+            finish(name, 'failed')
+
+    with ProcessPoolExecutor(workers, initializer=_initWorker) as pool, ThreadPoolExecutor(io_threads) as io:
+        for name in jobs:
+            slots.acquire()
+            io.submit(read, name)
+        for _ in range(window):  # 等待所有图片写完
+            slots.acquire()
+
+    saveManifest(manifest_path, params, manifest)
+    if shards:
+        for writer in writers:
+            writer.close()
+    stats['seconds'] = time.perf_counter() - t0
+    stats['images_per_second'] = stats['processed'] / max(stats['seconds'], 1e-9)
+    if verbose:
+        print(f"共 {stats['total']} 张：处理 {stats['processed']}，跳过 {stats['skipped']}，失败 {stats['failed']}，"
+              f"用时 {stats['seconds']:.1f}s，{stats['images_per_second']:.1f} 张/秒")
+    return stats
 
-# 示例用法
-image_dir = r'D:\w\wjy\da\mydata1_JYZ\images\test'  # 原始图片文件夹路径
-label_dir = r'D:\w\wjy\da\mydata1_JYZ\labels\test'  # 原始标签文件夹路径
-dest_image_dir = r'D:\w\wjy\da\mydata1_JYZ\images2\test'  # 雾化后图片存储路径
-dest_label_dir = r'D:\w\wjy\da\mydata1_JYZ\labels2\test'  # 更新后标签存储路径
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='对 YOLO 数据集批量添加雾化效果')
+    parser.add_argument('--images', required=True, help='原始图片文件夹')
+    parser.add_argument('--labels', required=True, help='原始标签文件夹')
+    parser.add_argument('--dest-images', required=True, help='雾化后图片存储文件夹')
+    parser.add_argument('--dest-labels', required=True, help='标签存储文件夹')
+    parser.add_argument('--A', type=float, default=0.5, help='亮度')
+    parser.add_argument('--beta', type=float, default=0.02, help='雾的浓度')
+    parser.add_argument('--severity', type=float, nargs=2, action='append', metavar=('BETA', 'A'),
+                        help='雾浓度等级, 可重复指定以一次生成多个等级 (覆盖 --A/--beta)')
+    parser.add_argument('--workers', type=int, default=None, help='进程数, 默认为 CPU 核数')
+    parser.add_argument('--io-threads', type=int, default=4, help='读写线程数')
+    parser.add_argument('--no-resume', action='store_true', help='忽略清单, 重新处理全部图片')
+    parser.add_argument('--shards', default=None, help='同时将雾化结果按 --imgsz 缩放后打包为内存映射分片, 写入该文件夹')
+    parser.add_argument('--imgsz', type=int, default=640, help='分片中图片长边的尺寸')
+    return parser.parse_args(argv)
 
-processDataset(image_dir, label_dir, dest_image_dir, dest_label_dir)
+if __name__ == '__main__':
+    # 示例: python fog.py --images D:\w\wjy\da\mydata1_JYZ\images\test --labels D:\w\wjy\da\mydata1_JYZ\labels\test
+    #       --dest-images D:\w\wjy\da\mydata1_JYZ\images2\test --dest-labels D:\w\wjy\da\mydata1_JYZ\labels2\test
+    opt = parseArgs()
+    processDataset(opt.images, opt.labels, opt.dest_images, opt.dest_labels, A=opt.A, beta=opt.beta,
+                   workers=opt.workers, io_threads=opt.io_threads, resume=not opt.no_resume, severities=opt.severity,
+                   shards=opt.shards, imgsz=opt.imgsz)
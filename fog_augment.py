@@ -0,0 +1,118 @@
+import math
+import random
+from functools import lru_cache
+
+import numpy as np
+from ultralytics.models.yolo.detect import DetectionTrainer
+
+from train_settings import TrainSettingsMixin
+
+
+@lru_cache(maxsize=8)
+def distance_grid(h, w):
+    """Distance of every cell of a (2h, 2w) grid to cell (h, w).
+
+    The distance map of an (h, w) image to any center (cy, cx) inside it is the view
+    grid[h - cy:2h - cy, w - cx:2w - cx], so one grid per letterboxed size serves every random center.
+    """
+    dy = np.arange(2 * h, dtype=np.float32)[:, None] - h
+    dx = np.arange(2 * w, dtype=np.float32)[None, :] - w
+    grid = np.sqrt(dy * dy + dx * dx)
+    grid.flags.writeable = False
+    return grid
+
+
+def distance_map(h, w, center):
+    """Zero-copy (h, w) view of the distance to center = (cy, cx), cy in [0, h), cx in [0, w)."""
+    cy, cx = center
+    return distance_grid(h, w)[h - cy:2 * h - cy, w - cx:2 * w - cx]
+
+
+def fog_kernel(img, beta, A, center):
+    """Atmospheric-scattering fog of fog.processImage with an arbitrary center: I * td + 255A * (1 - td)."""
+    h, w = img.shape[:2]
+    d = distance_map(h, w, center) * np.float32(-0.02) + np.float32(math.sqrt(max(h, w)))
+    td = np.exp(d * np.float32(-beta))
+    airlight = np.float32(255.0 * A)
+    if img.ndim == 3:
+        td = td[..., None]
+    out = img.astype(np.float32)
+    out -= airlight
+    out *= td
+    out += airlight
+    np.rint(out, out=out)
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+class RandomFog:
+    """Randomized fog augmentation for the Ultralytics training pipeline.
+
+    Applies the fog.py scattering model in memory, sampling beta, A and the fog center per sample, so no fogged copy of
+    the dataset has to be materialized on disk and each epoch sees different fog.
+    """
+
+    def __init__(self, p=0.5, beta=(0.01, 0.08), A=(0.3, 0.9), center=0.25):
+        """
+        Args:
+            p (float): Probability of fogging a sample.
+            beta (tuple): Range of the fog density.
+            A (tuple): Range of the atmospheric light.
+            center (float): Max offset of the fog center from the image center, as a fraction of height/width.
+        """
+        self.p = p
+        self.beta = beta
+        self.A = A
+        self.center = center
+
+    def sample(self, h, w):
+        """Sample (beta, A, center) for an (h, w) image."""
+        beta = random.uniform(*self.beta)
+        A = random.uniform(*self.A)
+        cy = int(h / 2 + random.uniform(-self.center, self.center) * h)
+        cx = int(w / 2 + random.uniform(-self.center, self.center) * w)
+        return beta, A, (min(max(cy, 0), h - 1), min(max(cx, 0), w - 1))
+
+    def __call__(self, labels):
+        """Fog labels['img'] in place of the original image with probability p."""
+        if random.random() < self.p:
+            img = labels['img']
+            labels['img'] = fog_kernel(img, *self.sample(*img.shape[:2]))
+        return labels
+
+
+class FogTransforms:
+    """Picklable wrapper of Dataset.build_transforms that inserts RandomFog before the final Format transform."""
+
+    def __init__(self, build_transforms, fog):
+        self.build_transforms = build_transforms
+        self.fog = fog
+
+    def __call__(self, hyp=None):
+        transforms = self.build_transforms(hyp)
+        transforms.insert(-1, self.fog)
+        return transforms
+
+
+def add_fog(dataset, fog):
+    """Add fog augmentation to an Ultralytics YOLODataset, also after close_mosaic rebuilds its transforms."""
+    dataset.build_transforms = FogTransforms(dataset.build_transforms, fog)
+    dataset.transforms.insert(-1, fog)
+    return dataset
+
+
+class FogDetectionTrainer(TrainSettingsMixin, DetectionTrainer):
+    """DetectionTrainer that fogs training samples on the fly, inside the dataloader workers.
+
+    fog is passed with the training arguments like the TrainSettingsMixin settings, model.train(trainer=
+    FogDetectionTrainer, fog=RandomFog(p=0.3), ...); a RandomFog() by default, None turns the augmentation off.
+    """
+
+    SETTINGS = {**TrainSettingsMixin.SETTINGS, 'fog': RandomFog()}
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        """Build the YOLO dataset and add RandomFog to the training transforms."""
+        dataset = super().build_dataset(img_path, mode, batch)
+        if mode == 'train' and self.fog is not None:
+            add_fog(dataset, self.fog)
+        return dataset
@@ -0,0 +1,207 @@
+import time
+import queue
+import argparse
+import threading
+
+import cv2
+import numpy as np
+
+from fog import transmissionMap
+
+_END = object()
+
+
+def readFrames(source):
+    '''
+    逐帧读取视频
+    source 可以是视频路径/摄像头编号 (使用 cv2.VideoCapture), 或任意产生 (H, W, 3) uint8 帧的可迭代对象
+    '''
+    if not isinstance(source, (str, int)):
+        yield from source
+        return
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise IOError(f"无法打开视频：{source}")
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+def prefetch(frames, maxsize=16, timeout=0.1):
+    '''
+    在后台线程中读取/解码帧, 最多缓存 maxsize 帧, 使解码与雾化计算重叠
+    消费者提前停止 (break / 异常 / close) 时, 后台线程在 timeout 秒内退出并关闭 frames (释放 VideoCapture)
+    '''
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+    error = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for frame in frames:
+                if not put(frame):
+                    break
+        except Exception as e:
+            error.append(e)
+        finally:
+            if hasattr(frames, 'close'):
+                frames.close()  # 生成器只能由迭代它的线程关闭, 其 finally 释放 VideoCapture
+            put(_END)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            frame = q.get()
+            if frame is _END:
+                break
+            yield frame
+    finally:
+        stop.set()
+        thread.join()
+    if error:
+        raise error[0]
+
+
+def fogBatch(frames, td, airlight):
+    '''
+    对 (N, H, W, C) 的 uint8 帧批量计算 I * td + 255A * (1 - td), td/airlight 为共享的 (H, W, 1) 透射率图
+    '''
+    out = np.multiply(frames, td, dtype=np.float32)
+    out += airlight
+    np.rint(out, out=out)
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def fogFrames(frames, beta=0.02, A=0.5, center=None, batch_size=8):
+    '''
+    流式雾化生成器: 每次最多攒 batch_size 帧一起计算, 内存占用与视频长度无关
+    帧尺寸固定, 透射率图只计算一次
+    '''
+    batch = None
+    n = 0
+    td = airlight = None
+    for frame in frames:
+        if batch is None:
+            td, airlight = transmissionMap(frame.shape[0], frame.shape[1], beta, A, center)
+            batch = np.empty((batch_size, *frame.shape), dtype=np.uint8)
+        elif frame.shape != batch.shape[1:]:
+            raise ValueError(f"帧尺寸变化：{frame.shape} != {batch.shape[1:]}")
+        batch[n] = frame
+        n += 1
+        if n == batch_size:
+            yield from fogBatch(batch, td, airlight)
+            n = 0
+    if n:
+        yield from fogBatch(batch[:n], td, airlight)
+
+
+class FrameWriter:
+    '''
+    后台线程写视频, 与解码和雾化计算重叠; 队列有上限, 写入慢时会阻塞生产者
+    '''
+
+    def __init__(self, path, fps, size, fourcc='mp4v', maxsize=16):
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        if not self.writer.isOpened():
+            raise IOError(f"无法写入视频：{path}")
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is _END:
+                break
+            try:
+                self.writer.write(frame)
+            except Exception as e:
+                self.error = e
+        self.writer.release()
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def close(self):
+        self.queue.put(_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def fogVideo(source, dest, beta=0.02, A=0.5, center=None, batch_size=8, fourcc='mp4v', fps=None, verbose=True):
+    '''
+    雾化整个视频并写入 dest
+    source: 视频路径/摄像头编号或帧迭代器
+    fps: 输出帧率, 默认取输入视频的帧率 (帧迭代器时为 25)
+    返回统计信息 dict: frames, seconds, fps
+    '''
+    t0 = time.perf_counter()
+    if fps is None:
+        fps = 25.0
+        if isinstance(source, (str, int)):
+            cap = cv2.VideoCapture(source)
+            fps = cap.get(cv2.CAP_PROP_FPS) or fps
+            cap.release()
+
+    frames = fogFrames(prefetch(readFrames(source), 2 * batch_size), beta, A, center, batch_size)
+    writer = None
+    n = 0
+    try:
+        for frame in frames:
+            if writer is None:
+                writer = FrameWriter(dest, fps, (frame.shape[1], frame.shape[0]), fourcc, 2 * batch_size)
+            writer.write(frame)
+            n += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+    seconds = time.perf_counter() - t0
+    stats = {'frames': n, 'seconds': seconds, 'fps': n / max(seconds, 1e-9)}
+    if verbose:
+        print(f"共 {n} 帧，用时 {seconds:.1f}s，{stats['fps']:.1f} 帧/秒")
+    return stats
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='对视频流式添加雾化效果')
+    parser.add_argument('--source', required=True, help='输入视频路径或摄像头编号')
+    parser.add_argument('--dest', required=True, help='输出视频路径')
+    parser.add_argument('--A', type=float, default=0.5, help='亮度')
+    parser.add_argument('--beta', type=float, default=0.02, help='雾的浓度')
+    parser.add_argument('--batch-size', type=int, default=8, help='每批雾化的帧数')
+    parser.add_argument('--fourcc', default='mp4v', help='输出编码')
+    parser.add_argument('--fps', type=float, default=None, help='输出帧率, 默认与输入相同')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    source = int(opt.source) if opt.source.isdigit() else opt.source
+    fogVideo(source, opt.dest, beta=opt.beta, A=opt.A, batch_size=opt.batch_size, fourcc=opt.fourcc, fps=opt.fps)
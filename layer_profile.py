@@ -0,0 +1,184 @@
+import json
+import time
+import itertools
+import argparse
+import threading
+import statistics
+
+import torch
+
+from utils import MODEL_CFG, build_model, flatten_outputs, load_model
+
+COLUMNS = {  # sort key -> (header, format spec, value of a row)
+    'index': ('layer', '>5d', lambda r: r['index']),
+    'type': ('type', '<18s', lambda r: r['type']),
+    'time': ('ms', '>9.3f', lambda r: r['time_ms']),
+    'share': ('time %', '>6.1f', lambda r: r['share']),
+    'flops': ('GFLOPs', '>8.3f', lambda r: r['flops'] / 1e9),
+    'params': ('params', '>11,d', lambda r: r['params']),
+    'act': ('act MiB', '>8.2f', lambda r: r['act_bytes'] / 2 ** 20),
+    'shape': ('output', '<s', lambda r: ' '.join('x'.join(map(str, s)) for s in r['shapes'])),
+}
+
+
+def _header(title, spec):
+    width = ''.join(itertools.takewhile(str.isdigit, spec[1:]))
+    return f'{title:{spec[0]}{width}s}'
+
+
+class LayerProfiler:
+    """Per-layer wall time, FLOPs, parameters, activation bytes and output shapes of a YAML-built model.
+
+    Forward hooks are registered on every layer of model.model (one per YAML line) by attach() and removed again by
+    detach(), so a detached model runs its plain forward. Usable as a context manager:
+
+        with LayerProfiler(model) as prof:
+            model(x)
+        prof.table()
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.layers = list(model.model)
+        self.handles = []
+        self.events = []  # (layer index, thread id, start ns, end ns)
+        self.outputs = {}  # layer index -> (shapes, bytes) of the last output
+        self.flops = {}
+        self._start = {}
+
+    def attach(self):
+        if not self.handles:
+            for i, m in enumerate(self.layers):
+                self.handles.append(m.register_forward_pre_hook(self._pre_hook(i)))
+                self.handles.append(m.register_forward_hook(self._post_hook(i)))
+        return self
+
+    def detach(self):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+        return self
+
+    def reset(self):
+        self.events, self.outputs, self._start = [], {}, {}
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.detach()
+
+    def _pre_hook(self, i):
+        def hook(module, args):
+            self._start[i, threading.get_ident()] = time.perf_counter_ns()
+        return hook
+
+    def _post_hook(self, i):
+        def hook(module, args, output):
+            end, tid = time.perf_counter_ns(), threading.get_ident()
+            self.events.append((i, tid, self._start.pop((i, tid)), end))
+            tensors = flatten_outputs(output)
+            self.outputs[i] = ([tuple(t.shape) for t in tensors], sum(t.numel() * t.element_size() for t in tensors))
+        return hook
+
+    @torch.no_grad()
+    def count_flops(self, *inputs):
+        """FLOPs of every layer for one forward of inputs, counted per aten op (2 per multiply-add)."""
+        from torch.utils.flop_counter import FlopCounterMode
+
+        counter = FlopCounterMode(display=False)
+        with counter:
+            self.model(*inputs)
+        counts = counter.get_flop_counts()
+        prefix = type(self.model).__name__
+        self.flops = {i: sum(counts.get(f'{prefix}.model.{i}', {}).values()) for i in range(len(self.layers))}
+        return self.flops
+
+    def rows(self):
+        """One dict per layer: mean wall time over the recorded calls, FLOPs, params, activation bytes and shapes."""
+        times = {}
+        for i, _, start, end in self.events:
+            times.setdefault(i, []).append((end - start) / 1e6)
+        total = sum(statistics.fmean(t) for t in times.values()) or 1.0
+        rows = []
+        for i, m in enumerate(self.layers):
+            t = statistics.fmean(times[i]) if i in times else 0.0
+            shapes, act = self.outputs.get(i, ([], 0))
+            rows.append({'index': i, 'type': type(m).__name__, 'from': getattr(m, 'f', -1),
+                         'calls': len(times.get(i, ())), 'time_ms': t, 'share': 100 * t / total,
+                         'flops': self.flops.get(i, 0), 'params': sum(p.numel() for p in m.parameters()),
+                         'act_bytes': act, 'shapes': shapes})
+        return rows
+
+    def table(self, sort='index', descending=None, file=None):
+        """Print the per-layer table sorted by a COLUMNS key, largest first for numeric columns, plus a total row."""
+        rows = self.rows()
+        if descending is None:
+            descending = sort not in ('index', 'type', 'shape')
+        rows.sort(key=COLUMNS[sort][2], reverse=descending)
+        print('  '.join(_header(h, spec) for h, spec, _ in COLUMNS.values()), file=file)
+        for r in rows:
+            print('  '.join(f'{v(r):{spec}}' for _, spec, v in COLUMNS.values()), file=file)
+        total = {'index': 0, 'type': 'total', 'time_ms': sum(r['time_ms'] for r in rows), 'share': 100.0,
+                 'flops': sum(r['flops'] for r in rows), 'params': sum(r['params'] for r in rows),
+                 'act_bytes': sum(r['act_bytes'] for r in rows), 'shapes': []}
+        cells = [f'{v(total):{spec}}' for k, (_, spec, v) in COLUMNS.items() if k != 'index']
+        print(' ' * 7 + '  '.join(cells), file=file)
+
+    def chrome_trace(self, path):
+        """Write the recorded calls as Chrome trace events (open in chrome://tracing or https://ui.perfetto.dev)."""
+        rows = {r['index']: r for r in self.rows()}
+        t0 = min((e[2] for e in self.events), default=0)
+        events = []
+        for i, tid, start, end in self.events:
+            r = rows[i]
+            events.append({'name': f"{i} {r['type']}", 'cat': r['type'], 'ph': 'X', 'pid': 0, 'tid': tid,
+                           'ts': (start - t0) / 1e3, 'dur': (end - start) / 1e3,
+                           'args': {'flops': r['flops'], 'params': r['params'], 'act_bytes': r['act_bytes'],
+                                    'shapes': r['shapes'], 'from': r['from']}})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+
+@torch.inference_mode()
+def profile_model(model, imgsz=640, batch=1, repeat=10, warmup=2):
+    """Profile repeat forwards of a random batch and return the LayerProfiler holding the records."""
+    x = torch.rand(batch, 3, imgsz, imgsz)
+    prof = LayerProfiler(model.eval())
+    for _ in range(warmup):
+        model(x)
+    prof.count_flops(x)
+    with prof:
+        for _ in range(repeat):
+            model(x)
+    return prof
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Per-layer time / FLOPs / memory report of a YAML-built model')
+    parser.add_argument('--weights', default=None, help='checkpoint to profile, builds --cfg with random weights if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=10, help='profiled forwards, times are averaged')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--fused', action='store_true', help='reparameterize the model first (see reparam.py)')
+    parser.add_argument('--sort', default='index', choices=list(COLUMNS), help='table sort column')
+    parser.add_argument('--trace', default=None, help='write a Chrome trace JSON here')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    model = load_model(opt.weights) if opt.weights else build_model(opt.cfg, opt.scale).eval()
+    if opt.fused:
+        from reparam import reparameterize
+        reparameterize(model)
+    prof = profile_model(model, opt.imgsz, opt.batch, opt.repeat)
+    prof.table(opt.sort)
+    if opt.trace:
+        print(f'trace written to {prof.chrome_trace(opt.trace)}')
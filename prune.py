@@ -0,0 +1,557 @@
+import copy
+import argparse
+import statistics
+
+import torch
+import torch.nn as nn
+import yaml
+from ultralytics.nn.modules import SPPF, Concat, Detect
+from ultralytics.nn.modules.conv import Conv
+
+from C3k2_OREPA import C2f, C3, C3k2, C3k2_OREPA, Bottleneck, CachedWeightGen, OREPA
+from DSConv import DSConv
+from ESE import EffectiveSELayer
+from reparam import reparameterize, verify
+from utils import MODEL_CFG, build_model, count_params, load_model, timeit
+
+WIDTH_SCALED = {'Conv', 'DWConv', 'DSConv2D', 'C2f', 'C3', 'C3k2', 'C3k2_OREPA', 'SPPF', 'C2PSA'}  # YAML args[0] = c2
+CHANNEL_FREE = {'Concat', 'nn.Upsample', 'EffectiveSELayer', 'Detect'}  # channels follow the inputs
+
+
+class Group:
+    """Channel spaces whose kept size is set by one constructor argument, e.g. the hidden width C2f.c.
+
+    A derived group takes its size from the kept size of its parent through fn, like Detect's c3 = max(ch[0], nc) or
+    a bottleneck's int(c * e); a fixed group is never pruned.
+    """
+
+    def __init__(self, name, size, parent=None, fn=None):
+        self.name, self.size, self.parent, self.fn = name, size, parent, fn
+        self.spaces, self.fixed, self.target = [], False, size
+
+
+class Space:
+    """Channels pruned together: every tensor dimension indexed by the space keeps the same channels."""
+
+    def __init__(self, size, group):
+        self.size, self.group = size, group
+        self.scores = []  # one importance vector per producing layer
+        self.keep = None
+        group.spaces.append(self)
+
+    def score(self):
+        """Mean over the producing layers of their channel importance relative to that layer's mean."""
+        if not self.scores:
+            return torch.ones(self.size)
+        return torch.stack([s / s.mean().clamp(min=1e-12) for s in self.scores]).mean(0)
+
+
+def layout_size(layout, planned=False):
+    """Channels of a layout, a list of (space, expand) segments: expand consecutive entries per channel."""
+    return sum((s.group.target if planned else s.size) * e for s, e in layout)
+
+
+def layout_index(layout):
+    """Indices of the kept entries of a layout dimension, None when nothing is pruned."""
+    if all(s.keep is None or len(s.keep) == s.size for s, _ in layout):
+        return None
+    idx, offset = [], 0
+    for s, e in layout:
+        keep = torch.arange(s.size) if s.keep is None else s.keep
+        idx.append(offset + (keep[:, None] * e + torch.arange(e)).flatten())
+        offset += s.size * e
+    return torch.cat(idx)
+
+
+def conv_of(m):
+    """The nn.Conv2d / DSConv holding the kernel of a Conv, DSConv2D, deployed OREPA or plain conv."""
+    if hasattr(m, 'orepa_reparam'):
+        return m.orepa_reparam
+    return m.conv if isinstance(m, Conv) else m
+
+
+def leaves(seq):
+    """Conv-like layers of a (nested) nn.Sequential in order."""
+    for m in seq.children() if isinstance(seq, nn.Sequential) else [seq]:
+        if isinstance(m, nn.Sequential):
+            yield from leaves(m)
+        else:
+            yield m
+
+
+def out_channels(m):
+    return m.weight_orepa_origin.shape[0] if hasattr(m, 'weight_orepa_origin') else conv_of(m).out_channels
+
+
+def is_depthwise(conv):
+    return conv.groups > 1 and conv.groups == conv.in_channels == conv.out_channels
+
+
+def orepa_fold(m):
+    """Fold the 1x1 -> kxk branch of a trainable OREPA into its kxk factor, exactly.
+
+    conv2 (o, t, k, k) o (idconv1 + id) (t, i) becomes conv2' (o, i, k, k) o id, so the internal channels of the branch
+    are the input channels again and can be pruned with them.
+    """
+    a = (m.weight_orepa_1x1_kxk_idconv1 + m.id_tensor).flatten(1)
+    m.weight_orepa_1x1_kxk_conv2.data = torch.einsum('othw,ti->oihw', m.weight_orepa_1x1_kxk_conv2, a)
+    m.weight_orepa_1x1_kxk_idconv1.data.zero_()
+
+
+@torch.enable_grad()  # C2f's no-grad concat buffer path calls the convs without their hooks
+def output_shapes(model, imgsz):
+    """Output shape of every submodule (by id) for one forward of a 1 x 3 x imgsz x imgsz image."""
+    shapes = {}
+
+    def hook(m, args, y):
+        if isinstance(y, torch.Tensor):
+            shapes[id(m)] = tuple(y.shape)
+
+    hooks = [m.register_forward_hook(hook) for m in model.modules() if m is not model]
+    try:
+        model(torch.zeros(1, 3, imgsz, imgsz))
+    finally:
+        for h in hooks:
+            h.remove()
+    return shapes
+
+
+class Pruner:
+    """Structured channel pruning of a YAML-built DEO-YOLO model, trainable or reparameterized.
+
+    trace() follows model.model and records which channel space indexes every weight dimension: Concat joins the
+    spaces of its inputs, C2f chunks and residual bottlenecks share one space, EffectiveSELayer and depthwise convs
+    keep their input space and Detect heads read the spaces of their inputs. Layers it does not know pin their inputs.
+    plan() picks the channels to keep from their importance and apply() slices the model in place, once.
+
+    Channel importance is the BN scale |gamma| of the producing layer (network slimming), times the relative strength
+    of the OREPA branch vector ||vector[:, c]||_1 for OREPA; without BN (a reparameterized model) it is the norm of the
+    fused output filter, in which both are folded.
+    """
+
+    def __init__(self, model, imgsz=640):
+        self.model = model.eval()
+        for m in model.modules():
+            if isinstance(m, DSConv):
+                m.decompress()  # packed integer kernels are not sliceable, DSConv.compress_model repacks them
+        self.groups, self.edits, self.convs, self.folds = [], [], [], []
+        self.shapes = output_shapes(model, imgsz)
+        self.trace()
+
+    # tracing
+    def group(self, name, size, parent=None, fn=None):
+        g = Group(name, size, parent, fn)
+        if parent is not None and fn(parent.size) != size:
+            g.fixed = True  # not the constructor's relation, leave it alone
+        self.groups.append(g)
+        return g
+
+    def new(self, name, size, fixed=False):
+        g = self.group(name, size)
+        g.fixed = fixed
+        return [(Space(size, g), 1)]
+
+    @staticmethod
+    def pin(*layouts):
+        for layout in layouts:
+            for s, _ in layout or ():
+                s.group.fixed = True
+
+    def edit(self, module, name, dim, layout):
+        if layout is not None and (module._parameters.get(name) is not None or module._buffers.get(name) is not None):
+            self.edits.append((module, name, dim, layout))
+
+    def score(self, layout, s):
+        offset = 0
+        for space, e in layout:
+            space.scores.append(s[offset:offset + space.size * e].view(space.size, e).sum(1))
+            offset += space.size * e
+
+    def conv(self, m, x, out, hw):
+        """Register a Conv / DSConv2D / OREPA / nn.Conv2d from layout x to layout out (None: output not prunable)."""
+        if hasattr(m, 'weight_orepa_origin'):
+            return self.orepa(m, x, out, hw)
+        conv, bn = conv_of(m), getattr(m, 'bn', None)
+        k = conv.kernel_size[0] * conv.kernel_size[1]
+        if is_depthwise(conv):
+            out = x
+        elif conv.groups > 1 or getattr(conv, 'KDSBias', False):
+            self.pin(x, out)  # grouped kernels and KDS block biases tie channels across the input
+        self.edit(conv, 'weight', 0, out)
+        self.edit(conv, 'weight', 1, None if is_depthwise(conv) else x)
+        for name in ('bias', 'CDSw', 'CDSb'):
+            self.edit(conv, name, 0, out)
+        if bn is not None:
+            for name in ('weight', 'bias', 'running_mean', 'running_var'):
+                self.edit(bn, name, 0, out)
+        if out is not None and out is not x:
+            weight = conv.get_weight() if isinstance(conv, DSConv) else conv.weight
+            self.score(out, bn.weight.abs() if bn is not None else weight.flatten(1).norm(dim=1))
+        self.convs.append((x, out or conv.out_channels, k, is_depthwise(conv), hw))
+
+    def orepa(self, m, x, out, hw):
+        if m.groups != 1 or m.weight_only or not hasattr(m, 'weight_orepa_1x1_kxk_idconv1') or \
+                m.id_tensor.shape[0] != m.in_channels:
+            self.pin(x, out)
+        expand = m.weight_orepa_gconv_dw.shape[0] // m.in_channels
+        for name in ('weight_orepa_origin', 'weight_orepa_avg_conv', 'weight_orepa_pfir_conv', 'weight_orepa_1x1',
+                     'weight_orepa_1x1_kxk_conv2'):
+            self.edit(m, name, 0, out)
+            self.edit(m, name, 1, x)
+        for name in ('weight_orepa_1x1_kxk_idconv1', 'id_tensor'):
+            self.edit(m, name, 0, x)
+            self.edit(m, name, 1, x)
+        self.edit(m, 'weight_orepa_gconv_dw', 0, [(s, e * expand) for s, e in x])
+        self.edit(m, 'weight_orepa_gconv_pw', 0, out)
+        self.edit(m, 'weight_orepa_gconv_pw', 1, [(s, e * expand) for s, e in x])
+        self.edit(m, 'vector', 1, out)
+        self.edit(m, 'weight_orepa_prior', 0, out)
+        for name in ('weight', 'bias', 'running_mean', 'running_var'):
+            self.edit(m.bn, name, 0, out)
+        if out is not None:
+            strength = m.vector.abs().sum(0)
+            self.score(out, m.bn.weight.abs() * strength / strength.mean().clamp(min=1e-12))
+        self.folds.append((m, x))
+        self.convs.append((x, out or m.out_channels, m.kernel_size ** 2, False, hw))
+
+    def hw(self, m):
+        shape = self.shapes[id(m)]
+        return shape[2] * shape[3]
+
+    def trace(self):
+        layouts = []
+        image = self.new('input', 3, fixed=True)
+        for i, m in enumerate(self.model.model):
+            if m.f == -1 or isinstance(m.f, int):
+                x = image if i == 0 else layouts[m.f]
+            else:
+                x = [layouts[j] for j in m.f]
+            name = f'{i}.{type(m).__name__}'
+            if isinstance(m, Concat):
+                out = [seg for layout in x for seg in layout]
+            elif isinstance(m, nn.Upsample):
+                out = x
+            elif isinstance(m, EffectiveSELayer):
+                out = x
+                for dim in (0, 1):
+                    self.edit(m.fc, 'weight', dim, x)
+                self.edit(m.fc, 'bias', 0, x)
+            elif isinstance(m, Detect):
+                out = self.detect(m, x)
+            elif isinstance(m, Conv):
+                out = self.new(name, out_channels(m))
+                self.conv(m, x, out, self.hw(m))
+            elif isinstance(m, (C3k2, C3k2_OREPA)) and all(isinstance(b, (Bottleneck, C3)) for b in m.m):
+                out = self.c2f(m, x, name)
+            elif isinstance(m, SPPF) and len(x) == 1:
+                out = self.sppf(m, x, name)
+            else:
+                self.pin(*(x if isinstance(m.f, list) else [x]))
+                out = self.new(name, self.shapes[id(m)][1], fixed=True)
+            layouts.append(out)
+        for g in reversed(self.groups):  # a fixed derived size fixes the size it derives from
+            if g.fixed and g.parent is not None:
+                g.parent.fixed = True
+
+    def c2f(self, m, x, name):
+        hidden = self.group(f'{name}.c', m.c)
+        a, b = [(Space(m.c, hidden), 1)], [(Space(m.c, hidden), 1)]
+        self.conv(m.cv1, x, a + b, self.hw(m.cv1))
+        ys = [a, b]
+        for block in m.m:
+            ys.append(self.block(block, ys[-1], hidden, name))
+        out = self.new(name, out_channels(m.cv2))
+        self.conv(m.cv2, [seg for y in ys for seg in y], out, self.hw(m.cv2))
+        return out
+
+    def block(self, m, x, group, name):
+        """Bottleneck or C3k inside a C2f, x is its input layout and group the width of its output."""
+        if isinstance(m, C3):
+            e = out_channels(m.cv1) / group.size
+            sub = self.group(f'{name}.c3k', out_channels(m.cv1), group, lambda n, e=e: int(n * e))
+            p, q = [(Space(sub.size, sub), 1)], [(Space(sub.size, sub), 1)]
+            self.conv(m.cv1, x, p, self.hw(m.cv1))
+            self.conv(m.cv2, x, q, self.hw(m.cv2))
+            for bottleneck in m.m:
+                p = self.block(bottleneck, p, sub, name)
+            out = [(Space(group.size, group), 1)]
+            self.conv(m.cv3, p + q, out, self.hw(m.cv3))
+            return out
+        e = out_channels(m.cv1) / out_channels(m.cv2)
+        hidden = self.group(f'{name}.bottleneck', out_channels(m.cv1), group, lambda n, e=e: int(n * e))
+        h = [(Space(hidden.size, hidden), 1)]
+        self.conv(m.cv1, x, h, self.hw(m.cv1))
+        out = x if m.add else [(Space(group.size, group), 1)]
+        self.conv(m.cv2, h, out, self.hw(m.cv2))
+        return out
+
+    def sppf(self, m, x, name):
+        parent = x[0][0].group
+        if x[0][1] != 1:
+            self.pin(x)
+        hidden = self.group(f'{name}.c_', out_channels(m.cv1), parent, lambda n: n // 2)
+        h = [(Space(hidden.size, hidden), 1)]
+        self.conv(m.cv1, x, h, self.hw(m.cv1))
+        out = self.new(name, out_channels(m.cv2))
+        self.conv(m.cv2, h * 4, out, self.hw(m.cv2))
+        return out
+
+    def detect(self, m, inputs):
+        """Detect reads its inputs in cv2 / cv3, whose widths c2 and c3 Detect derives from ch[0]."""
+        first = inputs[0]
+        parent = first[0][0].group
+        if len(first) != 1 or first[0][1] != 1:
+            self.pin(*inputs)
+        c2 = self.group('detect.c2', out_channels(m.cv2[0][0]), parent, lambda n: max(16, n // 4, m.reg_max * 4))
+        c3_conv = m.cv3[0][0] if m.legacy else m.cv3[0][0][1]
+        c3 = self.group('detect.c3', out_channels(c3_conv), parent, lambda n: max(n, min(m.nc, 100)))
+        heads = [(m.cv2, c2), (m.cv3, c3)]
+        if hasattr(m, 'one2one_cv2'):
+            heads += [(m.one2one_cv2, c2), (m.one2one_cv3, c3)]
+        for branch, group in heads:
+            for x, seq in zip(inputs, branch):
+                self.chain(seq, x, group)
+        return None
+
+    def chain(self, seq, x, group):
+        """A Detect branch: convs of width group, depthwise convs in place, a last conv with fixed outputs."""
+        layers = list(leaves(seq))
+        for j, m in enumerate(layers):
+            if j == len(layers) - 1:
+                self.conv(m, x, None, self.hw(m))
+            elif is_depthwise(conv_of(m)):
+                self.conv(m, x, x, self.hw(m))
+            else:
+                out = [(Space(group.size, group), 1)]
+                self.conv(m, x, out, self.hw(m))
+                x = out
+
+    # planning
+    def plan(self, ratio, mode='uniform', max_ratio=0.75, multiple=8):
+        """Choose the channels to keep: prune ratio of every free group, or below one global importance threshold.
+
+        In both modes a group keeps a multiple of multiple channels and at least (1 - max_ratio) of them; derived
+        groups follow their parent; within every space the channels of highest importance are kept.
+        """
+        base = [g for g in self.groups if g.parent is None and not g.fixed and g.size >= 2 * multiple]
+        threshold = None
+        if mode == 'global' and ratio > 0 and base:
+            scores = torch.cat([s.score() for g in base for s in g.spaces])
+            threshold = scores.sort().values[min(int(ratio * len(scores)), len(scores) - 1)]
+        for g in self.groups:
+            if g.fixed:
+                g.target = g.size
+            elif g.parent is not None:
+                g.target = min(g.size, g.fn(g.parent.target))
+            elif g in base:
+                if threshold is None:
+                    n = int(g.size * ratio)
+                else:
+                    n = int(statistics.fmean(int((s.score() < threshold).sum()) for s in g.spaces))
+                n = min(n, int(g.size * max_ratio), g.size - multiple)
+                g.target = g.size - (n - n % multiple)
+            else:
+                g.target = g.size
+        for g in self.groups:
+            for s in g.spaces:
+                s.keep = None if g.target == s.size else s.score().topk(g.target).indices.sort().values
+        return self
+
+    def flops(self, planned=True):
+        """Convolution FLOPs (2 per multiply-add) of the traced convs at the planned or original widths."""
+        total = 0
+        for x, out, k, depthwise, hw in self.convs:
+            cin = layout_size(x, planned)
+            cout = out if isinstance(out, int) else layout_size(out, planned)
+            total += 2 * hw * k * (cin if depthwise else cin * cout)
+        return total
+
+    def search(self, target, mode='uniform', max_ratio=0.75, multiple=8, steps=20):
+        """Smallest ratio whose planned conv FLOPs are at most target times the original, by bisection."""
+        original = self.flops(planned=False)
+        lo, hi = 0.0, max_ratio
+        for _ in range(steps):
+            mid = (lo + hi) / 2
+            if self.plan(mid, mode, max_ratio, multiple).flops() <= target * original:
+                hi = mid
+            else:
+                lo = mid
+        return self.plan(hi, mode, max_ratio, multiple), hi
+
+    # applying
+    @torch.no_grad()
+    def apply(self):
+        """Slice every registered tensor to the planned channels and update the module attributes."""
+        for m, x in self.folds:
+            if layout_index(x) is not None:
+                orepa_fold(m)
+        for module, name, dim, layout in self.edits:
+            idx = layout_index(layout)
+            if idx is None:
+                continue
+            if name in module._parameters:
+                p = module._parameters[name]
+                module._parameters[name] = nn.Parameter(p.index_select(dim, idx.to(p.device)),
+                                                        requires_grad=p.requires_grad)
+            else:
+                b = module._buffers[name]
+                module._buffers[name] = b.index_select(dim, idx.to(b.device))
+        for m in self.model.modules():
+            if isinstance(m, nn.modules.conv._ConvNd) and 'weight' in m._parameters:
+                w = m.weight
+                if is_depthwise(m):
+                    m.groups = m.in_channels = m.out_channels = w.shape[0]
+                else:
+                    m.in_channels, m.out_channels = w.shape[1] * m.groups, w.shape[0]
+            elif isinstance(m, nn.BatchNorm2d):
+                m.num_features = m.running_mean.shape[0]
+            if isinstance(m, OREPA):
+                w = m.orepa_reparam.weight if hasattr(m, 'orepa_reparam') else m.weight_orepa_origin
+                m.in_channels, m.out_channels = w.shape[1] * m.groups, w.shape[0]
+            if isinstance(m, CachedWeightGen):
+                m._weight_cache = None
+        for m in self.model.modules():  # after the convs, which modules() visits after their C2f
+            if isinstance(m, C2f):
+                m.c = out_channels(m.cv1) // 2
+                m._buffers_cache = None
+        self.model.yaml = self.yaml()
+        return self.model
+
+    def yaml(self):
+        """Model YAML dict that builds the pruned architecture: width 1.0, every args[0] the real channel count."""
+        d = copy.deepcopy(self.model.yaml)
+        shapes = output_shapes(self.model, 64)
+        rows = d['backbone'] + d['head']
+        widths = []
+        for i, (row, m) in enumerate(zip(rows, self.model.model)):
+            module = row[2]
+            if module in CHANNEL_FREE:
+                continue
+            if module not in WIDTH_SCALED:
+                raise ValueError(f'layer {i}: cannot write the channels of {module} to a YAML')
+            c2 = shapes[id(m)][1]
+            args = list(row[3])
+            args[0] = c2
+            if isinstance(m, (C3k2, C3k2_OREPA)):
+                e = round(m.c / c2, 6)
+                if int(c2 * e) != m.c:
+                    e = round((m.c + 0.5) / c2, 6)
+                args = [c2, args[1] if len(args) > 1 else False, e, *args[3:]]
+            row[3] = args
+            widths.append(c2)
+        scale = d.get('scale')
+        if d.get('scales') and scale:
+            depth = d['scales'][scale][0]
+            d['scales'] = {scale: [depth, 1.0, max(widths)]}
+        else:
+            d['width_multiple'] = 1.0
+        return d
+
+
+def write_yaml(d, path):
+    """Write a model YAML dict with one flow-style row per layer, like the hand-written model YAMLs."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# written by prune.py: structured channel pruning, args[0] are the pruned channels at width 1.0\n')
+        for k, v in d.items():
+            if k in ('backbone', 'head'):
+                f.write(f'\n{k}:\n')
+                for row in v:
+                    f.write(f'  - {yaml.safe_dump(row, default_flow_style=True, width=1 << 16).strip()}\n')
+            elif k != 'yaml_file':
+                flow = None if isinstance(v, dict) else False  # scales rows inline, {k: scalar} as a plain key
+                f.write(yaml.safe_dump({k: v}, default_flow_style=flow, sort_keys=False))
+
+
+def check_yaml(model, d, imgsz=160):
+    """Build d, load the pruned weights into it strictly and compare outputs: the YAML is exactly the pruned model."""
+    fresh = build_model(copy.deepcopy(d), d.get('scale'), nc=model.model[-1].nc)
+    if not any(hasattr(m, 'bn') for m in model.modules() if isinstance(m, (Conv, OREPA))):
+        reparameterize(fresh)
+    fresh.load_state_dict(model.state_dict(), strict=True)
+    return verify(model, fresh, imgsz, batch=1, n=1, rtol=1e-5)
+
+
+def count_flops(model, imgsz):
+    from torch.utils.flop_counter import FlopCounterMode
+
+    counter = FlopCounterMode(display=False)
+    with torch.no_grad(), counter:
+        model(torch.zeros(1, 3, imgsz, imgsz))
+    return counter.get_total_flops()
+
+
+def evaluate(model, data, imgsz, batch):
+    """mAP50-95 and mAP50 of model on the val split of a dataset YAML with the Ultralytics validator."""
+    from ultralytics.models.yolo.detect import DetectionValidator
+
+    validator = DetectionValidator(args={'data': data, 'imgsz': imgsz, 'batch': batch, 'device': 'cpu',
+                                         'plots': False, 'verbose': False})
+    stats = validator(model=copy.deepcopy(model))
+    return stats['metrics/mAP50-95(B)'], stats['metrics/mAP50(B)']
+
+
+def model_report(model, imgsz, repeat, data=None, batch=16):
+    """FLOPs, parameters and latency of the reparameterized model and optionally its mAP."""
+    fused = reparameterize(copy.deepcopy(model))
+    x = torch.rand(1, 3, imgsz, imgsz)
+    with torch.no_grad():
+        latency = statistics.median(timeit(lambda: fused(x), repeat))
+    r = {'flops': count_flops(fused, imgsz), 'params': count_params(fused)[0], 'latency_ms': latency * 1e3}
+    if data:
+        r['map50_95'], r['map50'] = evaluate(model, data, imgsz, batch)
+    return r
+
+
+def print_report(before, after):
+    rows = [('GFLOPs', 'flops', 1e-9, '{:.2f}'), ('params', 'params', 1, '{:,.0f}'),
+            ('latency ms', 'latency_ms', 1, '{:.2f}'), ('mAP50-95', 'map50_95', 1, '{:.4f}'),
+            ('mAP50', 'map50', 1, '{:.4f}')]
+    print(f"{'':12s} {'original':>14s} {'pruned':>14s} {'ratio':>7s}")
+    for name, key, unit, fmt in rows:
+        if key in before:
+            a, b = before[key] * unit, after[key] * unit
+            print(f'{name:12s} {fmt.format(a):>14s} {fmt.format(b):>14s} {b / a if a else 0:7.3f}')
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Structured channel pruning of a DEO-YOLO model')
+    parser.add_argument('--weights', default=None, help='checkpoint to prune, builds --cfg randomly if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--flops', type=float, default=0.6, help='target fraction of the original FLOPs to keep')
+    parser.add_argument('--ratio', type=float, default=None, help='prune this fraction directly instead of --flops')
+    parser.add_argument('--mode', choices=('uniform', 'global'), default='uniform',
+                        help='same fraction in every layer, or one importance threshold across layers')
+    parser.add_argument('--max-ratio', type=float, default=0.75, help='largest fraction pruned from one layer')
+    parser.add_argument('--multiple', type=int, default=8, help='kept channel counts are multiples of this')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--data', default=None, help='dataset YAML, also report mAP before / after')
+    parser.add_argument('--batch', type=int, default=16, help='validation batch size')
+    parser.add_argument('--repeat', type=int, default=10, help='timed forwards per latency measurement')
+    parser.add_argument('--save', default='pruned.pt', help='pruned checkpoint')
+    parser.add_argument('--save-yaml', default='pruned.yaml', help='model YAML of the pruned architecture')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    model = load_model(opt.weights) if opt.weights else build_model(opt.cfg, opt.scale).eval()
+    before = model_report(model, opt.imgsz, opt.repeat, opt.data, opt.batch)
+    pruner = Pruner(model, opt.imgsz)
+    if opt.ratio is not None:
+        pruner.plan(opt.ratio, opt.mode, opt.max_ratio, opt.multiple)
+    else:
+        _, ratio = pruner.search(opt.flops, opt.mode, opt.max_ratio, opt.multiple)
+        kept = pruner.flops() / pruner.flops(planned=False)
+        print(f'ratio {ratio:.3f}: conv FLOPs x{kept:.3f}')
+        if kept > opt.flops:
+            print(f'--flops {opt.flops} is out of reach with --max-ratio {opt.max_ratio} and the fixed layers')
+    for g in pruner.groups:
+        if g.target != g.size:
+            print(f'  {g.name:28s} {g.size:5d} -> {g.target:5d}')
+    pruner.apply()
+    print(f'YAML check: max relative error {check_yaml(model, model.yaml):.2e}')
+    print_report(before, model_report(model, opt.imgsz, opt.repeat, opt.data, opt.batch))
+    write_yaml(model.yaml, opt.save_yaml)
+    torch.save({'model': model}, opt.save)
+    print(f'saved {opt.save} and {opt.save_yaml}; fine-tune with YOLO({opt.save_yaml!r}).load({opt.save!r}).train(...)')
@@ -0,0 +1,214 @@
+import copy
+import argparse
+import statistics
+
+import torch
+from ultralytics.nn.modules.conv import Conv, RepConv
+from ultralytics.utils.torch_utils import fuse_conv_and_bn
+
+from C3k2_OREPA import deploy_construction
+from utils import MODEL_CFG, build_model, count_params, flatten_outputs, load_model, peak_memory, timeit
+
+FUSED_FORMAT = 'deo-yolo-fused'
+
+
+def _fuse(module):
+    """Switch every fusable submodule of module to its single-conv deploy form."""
+    for child in module.children():
+        if hasattr(child, 'switch_to_deploy'):
+            # OREPA, OREPA_LargeConv, OREPA_3x3_RepVGG, ConvBN and DSConv2D fuse their own children
+            child.switch_to_deploy()
+        elif isinstance(child, RepConv) and hasattr(child, 'conv1'):
+            child.fuse_convs()
+        elif isinstance(child, Conv) and hasattr(child, 'bn'):
+            child.conv = fuse_conv_and_bn(child.conv, child.bn)
+            del child.bn
+            child.forward = child.forward_fuse
+        else:
+            _fuse(child)
+
+
+@torch.no_grad()
+def reparameterize(model):
+    """Fuse model in place for deployment and return it in eval mode.
+
+    Every OREPA / OREPA_LargeConv / OREPA_3x3_RepVGG / ConvBN / DSConv2D is collapsed into one nn.Conv2d with the BN
+    folded in, every remaining Conv + BN pair is fused and the training-only branch parameters are released.
+    Running it again on a fused model is a no-op.
+    """
+    model.eval()
+    if hasattr(model, 'switch_to_deploy'):
+        model.switch_to_deploy()
+    else:
+        _fuse(model)
+    return model.eval()
+
+
+def build_deploy(cfg=MODEL_CFG, scale='n', nc=None):
+    """Build the fused architecture directly, with uninitialized weights to be loaded from a fused checkpoint.
+
+    The reparameterizable modules are constructed in their deploy form (see deploy_construction) and the Conv + BN
+    pairs are given the fused layout, so the model has exactly the state dict of a reparameterized one without any
+    training branch or BN ever being computed.
+    """
+    with deploy_construction():
+        model = build_model(cfg, scale, nc)
+        for m in model.modules():
+            if isinstance(m, Conv) and hasattr(m, 'bn'):  # what _fuse makes of it, without computing the weights
+                m.conv.bias = torch.nn.Parameter(torch.empty(m.conv.out_channels), requires_grad=False)
+                m.conv.requires_grad_(False)
+                del m.bn
+                m.forward = m.forward_fuse
+    return reparameterize(model)
+
+
+def save_fused(model, path):
+    """Save model as a fused checkpoint: the model YAML, class names and the state dict of its reparameterized form.
+
+    Unlike a pickled module the file holds only tensors and plain data, so load_fused can read it with
+    weights_only=True and memory-map it. model itself is left as it is; a copy is fused.
+    """
+    model = reparameterize(copy.deepcopy(model))
+    torch.save({'format': FUSED_FORMAT, 'version': 1, 'yaml': model.yaml, 'names': getattr(model, 'names', None),
+                'state_dict': model.state_dict()}, path)
+
+
+def is_fused(ckpt):
+    return isinstance(ckpt, dict) and ckpt.get('format') == FUSED_FORMAT
+
+
+def load_fused(path, mmap=True):
+    """Load a save_fused checkpoint into a model built by build_deploy.
+
+    With mmap the weights are not read up front: the parameters are assigned the tensors of the memory-mapped file
+    (load_state_dict(assign=True)), so pages are read on first use and shared between processes loading one file.
+    """
+    return from_fused(torch.load(path, map_location='cpu', mmap=mmap, weights_only=True))
+
+
+def from_fused(ckpt):
+    model = build_deploy(ckpt['yaml'], None)
+    model.load_state_dict(ckpt['state_dict'], strict=True, assign=True)
+    if ckpt.get('names') is not None:
+        model.names = ckpt['names']
+    return model.eval()
+
+
+@torch.no_grad()
+def randomize_stats(model, seed=0):
+    """Random BN statistics and affine parameters, OREPA branch vectors and identity offsets, in place.
+
+    A freshly built model has running_mean 0 / running_var 1 / gamma 1 everywhere, so its BN folds are identities
+    and its activations shrink towards 0 with depth; fused and unfused outputs then agree whatever the fusion does.
+    Call this on a randomly initialized model before verify() so that every fold and branch is exercised.
+    """
+    g = torch.Generator().manual_seed(seed)
+
+    def fill(t, low, high):
+        t.copy_(torch.rand(t.shape, generator=g, dtype=t.dtype) * (high - low) + low)
+
+    for name, p in model.named_parameters():
+        if name.endswith('vector'):
+            fill(p, 0.2, 0.8)
+        elif name.endswith('idconv1'):
+            fill(p, -0.1, 0.1)
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            fill(m.running_mean, -0.5, 0.5)
+            fill(m.running_var, 0.5, 2.0)
+            fill(m.weight, 0.5, 1.5)
+            fill(m.bias, -0.2, 0.2)
+    return model
+
+
+def relative_error(a, b, floor=1e-3):
+    """max |a - b| / max |a| per channel (dim 1) of one output, the worst channel.
+
+    Each channel is measured against its own scale, so box coordinates do not hide errors in class scores; channels
+    below floor times the largest magnitude of the output are measured against that instead.
+    """
+    if a.dim() < 2:
+        a, b = a.reshape(1, -1), b.reshape(1, -1)
+    dims = [d for d in range(a.dim()) if d != 1]
+    scale = a.abs().amax(dims)
+    scale = scale.clamp(min=max(scale.max().item() * floor, torch.finfo(a.dtype).tiny))
+    return ((a - b).abs().amax(dims) / scale).max().item()
+
+
+@torch.no_grad()
+def verify(reference, fused, imgsz=640, batch=2, n=3, rtol=1e-3, seed=0):
+    """Compare the outputs of reference and fused on n random batches, raise if they differ by more than rtol.
+
+    The error is relative_error() of every output, returns the worst. A randomly initialized reference needs
+    randomize_stats() first, otherwise the comparison is vacuous.
+    """
+    g = torch.Generator().manual_seed(seed)
+    reference.eval()
+    fused.eval()
+    worst = 0.0
+    for _ in range(n):
+        x = torch.rand(batch, 3, imgsz, imgsz, generator=g)
+        for a, b in zip(flatten_outputs(reference(x)), flatten_outputs(fused(x))):
+            worst = max(worst, relative_error(a, b))
+    if worst > rtol:
+        raise AssertionError(f'fused model deviates from the original: relative error {worst:.2e} > {rtol:.0e}')
+    return worst
+
+
+@torch.no_grad()
+def model_stats(model, imgsz=640, batch=1, repeat=10):
+    """Parameter count, parameter + buffer bytes, median latency and peak activation memory of one forward."""
+    x = torch.rand(batch, 3, imgsz, imgsz)
+    params, state_bytes = count_params(model)
+    return {'params': params,
+            'state_bytes': state_bytes,
+            'latency_ms': statistics.median(timeit(lambda: model(x), repeat)) * 1e3,
+            'peak_bytes': peak_memory(lambda: model(x))}
+
+
+def report(before, after):
+    rows = [('params', 'params', '{:,}'), ('weights MB', 'state_bytes', '{:.2f}'),
+            ('latency ms', 'latency_ms', '{:.2f}'), ('peak mem MB', 'peak_bytes', '{:.1f}')]
+    print(f"{'':12s} {'before':>14s} {'after':>14s} {'ratio':>7s}")
+    for name, key, fmt in rows:
+        a, b = before[key], after[key]
+        if key.endswith('bytes'):
+            a, b = a / 2 ** 20, b / 2 ** 20
+        print(f'{name:12s} {fmt.format(a):>14s} {fmt.format(b):>14s} {b / a if a else 0:7.3f}')
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Reparameterize a model for deployment')
+    parser.add_argument('--weights', default=None, help='checkpoint to fuse, builds --cfg with random weights if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--repeat', type=int, default=10, help='timed forwards per measurement')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--save', default=None, help='write the fused model to this file')
+    parser.add_argument('--save-fused', default=None, help='write a fused checkpoint (weights only, see load_fused)')
+    parser.add_argument('--no-verify', action='store_true', help='skip the equivalence check')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    if opt.weights:
+        model = load_model(opt.weights)
+    else:  # random weights: random BN statistics and branch vectors, so that the equivalence check means something
+        model = randomize_stats(build_model(opt.cfg, opt.scale)).eval()
+    before = model_stats(model, opt.imgsz, repeat=opt.repeat)
+    reference = None if opt.no_verify else copy.deepcopy(model)
+    reparameterize(model)
+    if reference is not None:
+        print(f'equivalence: max relative error {verify(reference, model, opt.imgsz):.2e}')
+        del reference
+    report(before, model_stats(model, opt.imgsz, repeat=opt.repeat))
+    if opt.save:
+        torch.save({'model': model}, opt.save)
+        print(f'saved {opt.save}')
+    if opt.save_fused:
+        save_fused(model, opt.save_fused)
+        print(f'saved {opt.save_fused}')
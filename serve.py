@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+from utils import MODEL_CFG
+
+_model = None  # per worker process: (model, imgsz, stride)
+
+
+class Overloaded(Exception):
+    """The request queue is full, the client should back off and retry."""
+
+
+def _worker_init(weights, cfg, scale, imgsz, threads, cores):
+    """Load and reparameterize the model once per worker process and pin its intra-op threads (and cores)."""
+    global _model
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    if weights and weights.endswith('.torchscript'):
+        extra = {'config.txt': ''}  # metadata written by export.py
+        model = torch.jit.load(weights, map_location='cpu', _extra_files=extra)
+        stride = json.loads(extra['config.txt'] or '{}').get('stride', 32)
+    else:
+        from reparam import reparameterize
+        from utils import build_model, load_model
+
+        model = reparameterize(load_model(weights) if weights else build_model(cfg, scale))
+        stride = int(model.stride.max())
+    _model = model, imgsz, stride
+    _run_batch([_dummy_image(imgsz)], 0.25, 0.45)  # warm up allocator and kernels before taking traffic
+
+
+def _dummy_image(imgsz):
+    import cv2
+    import numpy as np
+
+    return cv2.imencode('.jpg', np.zeros((imgsz, imgsz, 3), np.uint8))[1].tobytes()
+
+
+def _run_batch(images, conf, iou):
+    """Decode, letterbox, infer and NMS one batch of encoded images; runs inside a worker process.
+
+    Returns one list of [x1, y1, x2, y2, conf, cls] rows per image in original image coordinates (None for images
+    that could not be decoded) and the forward time in seconds.
+    """
+    import cv2
+    import numpy as np
+    from ultralytics.data.augment import LetterBox
+    from ultralytics.utils.nms import non_max_suppression
+    from ultralytics.utils.ops import scale_boxes
+
+    model, imgsz, stride = _model
+    letterbox = LetterBox((imgsz, imgsz), auto=False, stride=stride)
+    decoded = [cv2.imdecode(np.frombuffer(b, np.uint8), cv2.IMREAD_COLOR) for b in images]
+    ok = [i for i, im in enumerate(decoded) if im is not None]
+    results = [None] * len(images)
+    if not ok:
+        return results, 0.0
+    batch = np.stack([letterbox(image=decoded[i]) for i in ok])
+    x = torch.from_numpy(batch[..., ::-1].transpose(0, 3, 1, 2).copy()).float().div_(255)  # BGR HWC -> RGB CHW
+    t = time.perf_counter()
+    with torch.inference_mode():
+        pred = model(x)
+        pred = pred[0] if isinstance(pred, (list, tuple)) else pred
+    elapsed = time.perf_counter() - t
+    for i, det in zip(ok, non_max_suppression(pred, conf, iou)):
+        det[:, :4] = scale_boxes(x.shape[2:], det[:, :4], decoded[i].shape[:2])
+        results[i] = det.tolist()
+    return results, elapsed
+
+
+class Metrics:
+    """Rolling request latencies, queue waits and batch sizes of the server."""
+
+    def __init__(self, window=10000):
+        self.start = time.perf_counter()
+        self.latency, self.wait, self.batches = deque(maxlen=window), deque(maxlen=window), deque(maxlen=window)
+        self.forward = deque(maxlen=window)
+        self.completed = self.rejected = self.failed = self.restarts = 0
+
+    @staticmethod
+    def percentiles(values):
+        """p50 / p90 / p95 / p99 / max in ms, the same keys for any number of samples (all 0.0 without any)."""
+        if len(values) < 2:
+            q = [values[0] if values else 0.0] * 99
+        else:
+            q = statistics.quantiles(values, n=100, method='inclusive')
+        return {'p50': q[49] * 1e3, 'p90': q[89] * 1e3, 'p95': q[94] * 1e3, 'p99': q[98] * 1e3,
+                'max': max(values, default=0.0) * 1e3}
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return {'completed': self.completed, 'rejected': self.rejected, 'failed': self.failed,
+                'restarts': self.restarts, 'images_per_s': self.completed / elapsed, 'uptime_s': elapsed,
+                'latency_ms': self.percentiles(self.latency), 'queue_wait_ms': self.percentiles(self.wait),
+                'forward_ms': self.percentiles(self.forward),
+                'mean_batch': statistics.fmean(self.batches) if self.batches else 0.0}
+
+
+class BatchingServer:
+    """Dynamic-batching inference front end over a pool of single-process model workers.
+
+    Requests wait in a bounded asyncio queue. A batcher takes the first waiting request, then keeps collecting until
+    max_batch requests are gathered or max_wait seconds have passed, and hands the batch to the next idle worker.
+    Every worker is its own process with threads intra-op threads, optionally pinned to its own cores, so batches on
+    different workers never compete for the same OpenMP pool; pin raises ValueError when workers * threads exceeds
+    the cores available to the process. submit() raises Overloaded when the queue is full.
+    A worker process that dies (BrokenProcessPool) fails its batch and is replaced by a fresh one; a worker that cannot
+    be restarted is dropped.
+    """
+
+    def __init__(self, weights=None, cfg=MODEL_CFG, scale='n', imgsz=640, workers=1, threads=None, max_batch=8,
+                 max_wait=0.005, queue_size=256, conf=0.25, iou=0.45, pin=False):
+        self.max_batch, self.max_wait, self.conf, self.iou = max_batch, max_wait, conf, iou
+        self.queue = asyncio.Queue(queue_size)
+        self.metrics = Metrics()
+        self.workers = workers
+        # pinned workers get disjoint slices of the cores this process may run on
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count() or 1)
+        cores = list(cores)
+        threads = threads or max(1, len(cores) // workers)
+        if pin and workers * threads > len(cores):
+            raise ValueError(f'pin needs workers * threads = {workers * threads} cores, '
+                             f'only {len(cores)} are available to this process')
+        self._initargs = [(weights, cfg, scale, imgsz, threads, cores[i * threads:(i + 1) * threads] if pin else None)
+                          for i in range(workers)]
+        self.executors = [self._executor(i) for i in range(workers)]
+        self.idle = asyncio.Queue()
+        self._tasks = set()
+
+    def _executor(self, i):
+        return ProcessPoolExecutor(1, multiprocessing.get_context('spawn'), initializer=_worker_init,
+                                   initargs=self._initargs[i])
+
+    async def _replace(self, executor):
+        """Swap a crashed worker for a fresh process on the same cores, drop it if that one does not start either."""
+        executor.shutdown(wait=False, cancel_futures=True)
+        i = self.executors.index(executor)
+        self.executors[i] = fresh = self._executor(i)
+        self.metrics.restarts += 1
+        try:
+            await asyncio.get_running_loop().run_in_executor(fresh, time.sleep, 0)
+        except Exception as e:
+            print(f'worker {i} could not be restarted, dropped: {e!r}')
+            fresh.shutdown(wait=False, cancel_futures=True)
+            self.executors.remove(fresh)
+            if not self.executors:
+                for _, future, _ in self._drain(self.queue.qsize()):
+                    future.set_exception(RuntimeError('no model worker left'))
+            return
+        self.idle.put_nowait(fresh)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        # make sure every worker has loaded its model before accepting requests
+        await asyncio.gather(*(loop.run_in_executor(e, time.sleep, 0) for e in self.executors))
+        for e in self.executors:
+            self.idle.put_nowait(e)
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def close(self):
+        self._batcher.cancel()
+        # shutdown() joins the worker processes, off the event loop
+        await asyncio.gather(*(asyncio.to_thread(e.shutdown, cancel_futures=True) for e in self.executors))
+
+    async def submit(self, image):
+        """Detections of one encoded (JPEG / PNG) image; raises Overloaded when the queue is full."""
+        if not self.executors:
+            raise RuntimeError('no model worker left')
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((image, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            raise Overloaded from None
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            executor = await self.idle.get()  # only collect a batch once a worker can take it
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    batch.extend(self._drain(self.max_batch - len(batch)))
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._run(executor, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _drain(self, n):
+        items = []
+        while len(items) < n and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    async def _run(self, executor, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            results, forward = await loop.run_in_executor(executor, _run_batch, [b[0] for b in batch],
+                                                          self.conf, self.iou)
+        except Exception as e:
+            self.metrics.failed += len(batch)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, BrokenProcessPool):
+                await self._replace(executor)
+            else:
+                self.idle.put_nowait(executor)
+            return
+        self.idle.put_nowait(executor)
+        end = time.perf_counter()
+        m = self.metrics
+        m.batches.append(len(batch))
+        m.forward.append(forward)
+        for (_, future, t0), result in zip(batch, results):
+            m.wait.append(start - t0)
+            m.latency.append(end - t0)
+            m.completed += 1
+            if not future.done():
+                future.set_result(result)
+
+
+async def _respond(writer, status, body, keep_alive=True):
+    data = json.dumps(body).encode()
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error',
+              503: 'Service Unavailable'}[status]
+    head = (f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n')
+    if status == 503:
+        head += 'Retry-After: 1\r\n'
+    writer.write(head.encode() + b'\r\n' + data)
+    await writer.drain()
+
+
+def http_handler(server):
+    """Minimal HTTP/1.1 keep-alive handler: POST /predict (image bytes body), GET /metrics, GET /health."""
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method == 'POST' and path == '/predict':
+                    try:
+                        result = await server.submit(body)
+                        status, payload = (200, {'detections': result}) if result is not None else \
+                            (400, {'error': 'could not decode image'})
+                    except Overloaded:
+                        status, payload = 503, {'error': 'queue full'}
+                    except Exception as e:
+                        status, payload = 500, {'error': repr(e)}
+                elif method == 'GET' and path == '/metrics':
+                    status, payload = 200, server.metrics.summary()
+                elif method == 'GET' and path == '/health':
+                    status, payload = 200, {'status': 'ok'}
+                else:
+                    status, payload = 404, {'error': f'unknown endpoint {method} {path}'}
+                await _respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(opt):
+    server = BatchingServer(opt.weights, opt.cfg, opt.scale, opt.imgsz, opt.workers, opt.threads, opt.max_batch,
+                            opt.max_wait / 1e3, opt.queue_size, opt.conf, opt.iou, opt.pin)
+    await server.start()
+    tcp = await asyncio.start_server(http_handler(server), opt.host, opt.port, backlog=1024)
+    print(f'serving on http://{opt.host}:{opt.port} ({opt.workers} workers, max batch {opt.max_batch}, '
+          f'max wait {opt.max_wait} ms)', flush=True)
+    try:
+        async with tcp:
+            await tcp.serve_forever()
+    finally:
+        await server.close()
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Dynamic-batching HTTP inference server for the reparameterized model')
+    parser.add_argument('--weights', default=None, help='checkpoint or .torchscript, builds --cfg with random weights if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1, help='model worker processes')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads per worker, default cores / workers')
+    parser.add_argument('--pin', action='store_true', help='pin every worker to its own cores')
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-wait', type=float, default=5.0, help='ms to wait for a batch to fill')
+    parser.add_argument('--queue-size', type=int, default=256, help='queued requests before answering 503')
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--iou', type=float, default=0.45)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(parseArgs()))
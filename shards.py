@@ -0,0 +1,279 @@
+import os
+import json
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from ultralytics.data import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+
+from fog import IMAGE_EXTS, fogImage, severityName
+from train_settings import TrainSettingsMixin
+
+SHARD_VERSION = 1
+INDEX_FIELDS = ('shard', 'offset', 'h0', 'w0', 'h', 'w')  # columns of index.npy
+
+
+def resize_long_side(img, imgsz):
+    """Resize so that the long side equals imgsz, like YOLODataset.load_image(rect_mode=True)."""
+    h0, w0 = img.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        w, h = min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz)
+        img = cv2.resize(img, (w, h), interpolation=cv2.INTER_LINEAR)
+    return img
+
+
+def read_label(path):
+    """Read a YOLO label file into an (n, 5) float32 array of [cls, x, y, w, h]; polygons are reduced to boxes."""
+    rows = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f.read().splitlines():
+                v = [float(x) for x in line.split()]
+                if len(v) == 5:
+                    rows.append(v)
+                elif len(v) > 5:
+                    xy = np.array(v[1:], dtype=np.float32).reshape(-1, 2)
+                    (x0, y0), (x1, y1) = xy.min(0), xy.max(0)
+                    rows.append([v[0], (x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0])
+    return np.array(rows, dtype=np.float32).reshape(-1, 5)
+
+
+class ShardWriter:
+    """Writes letterboxed uint8 images into fixed-layout memory-mapped shard files.
+
+    Every image occupies one (imgsz, imgsz, C) slot with the resized image at its top-left, so slot i of a shard starts at
+    byte i * imgsz * imgsz * C. index.npy stores (shard, offset, h0, w0, h, w) per image, labels.npy all boxes as one
+    (N, 5) float32 table and label_offsets.npy the (num_images + 1) row offsets into it.
+    """
+
+    def __init__(self, path, imgsz=640, shard_size=1024, channels=3):
+        self.path = path
+        self.imgsz = imgsz
+        self.shard_size = shard_size
+        self.channels = channels
+        self.slot_bytes = imgsz * imgsz * channels
+        self.index, self.files, self.labels, self.counts = [], [], [], []
+        self.shard = None
+        os.makedirs(path, exist_ok=True)
+
+    def _open_shard(self):
+        self.flush()
+        self.counts.append(0)
+        shape = (self.shard_size, self.imgsz, self.imgsz, self.channels)
+        self.shard = np.memmap(self._shard_path(len(self.counts) - 1), np.uint8, 'w+', shape=shape)
+
+    def _shard_path(self, i):
+        return os.path.join(self.path, f'shard_{i:05d}.bin')
+
+    def add(self, name, img, hw0, labels):
+        """Add an image already resized by resize_long_side, its original (h0, w0) and its (n, 5) label array."""
+        if self.shard is None or self.counts[-1] == self.shard_size:
+            self._open_shard()
+        h, w = img.shape[:2]
+        slot = self.counts[-1]
+        self.shard[slot, :h, :w] = img.reshape(h, w, self.channels)
+        self.counts[-1] += 1
+        self.index.append((len(self.counts) - 1, slot * self.slot_bytes, hw0[0], hw0[1], h, w))
+        self.files.append(name)
+        self.labels.append(labels)
+
+    def flush(self):
+        """Flush the current shard and truncate it to the slots actually used."""
+        if self.shard is not None:
+            self.shard.flush()
+            del self.shard
+            self.shard = None
+            os.truncate(self._shard_path(len(self.counts) - 1), self.counts[-1] * self.slot_bytes)
+
+    def close(self):
+        self.flush()
+        counts = np.array([len(x) for x in self.labels], dtype=np.int64)
+        np.save(os.path.join(self.path, 'index.npy'), np.array(self.index, dtype=np.int64).reshape(-1, 6))
+        np.save(os.path.join(self.path, 'labels.npy'),
+                np.concatenate(self.labels) if self.labels else np.zeros((0, 5), np.float32))
+        np.save(os.path.join(self.path, 'label_offsets.npy'), np.concatenate(([0], np.cumsum(counts))))
+        meta = {'version': SHARD_VERSION, 'imgsz': self.imgsz, 'channels': self.channels,
+                'shard_size': self.shard_size, 'shards': self.counts, 'files': self.files}
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader:
+    """Zero-copy reader of a shard directory written by ShardWriter.
+
+    Shards are memory-mapped lazily in each process, so the reader pickles cheaply into dataloader workers and all
+    workers share the same page-cache pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        assert meta['version'] == SHARD_VERSION, f"unsupported shard version {meta['version']}"
+        self.imgsz, self.channels, self.files = meta['imgsz'], meta['channels'], meta['files']
+        self.counts = meta['shards']
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self.labels = np.load(os.path.join(path, 'labels.npy'))
+        self.label_offsets = np.load(os.path.join(path, 'label_offsets.npy'))
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def shard(self, s):
+        m = self._shards.get(s)
+        if m is None:
+            shape = (self.counts[s], self.imgsz, self.imgsz, self.channels)
+            m = self._shards[s] = np.memmap(os.path.join(self.path, f'shard_{s:05d}.bin'), np.uint8, 'r', shape=shape)
+        return m
+
+    def image(self, i):
+        """Read-only (h, w, C) view of image i straight from the mapped shard, plus its original (h0, w0)."""
+        s, offset, h0, w0, h, w = self.index[i]
+        return self.shard(s)[offset // (self.imgsz * self.imgsz * self.channels), :h, :w], (int(h0), int(w0))
+
+    def label(self, i):
+        """(n, 5) [cls, x, y, w, h] view of the label table for image i."""
+        return self.labels[self.label_offsets[i]:self.label_offsets[i + 1]]
+
+    def __getitem__(self, i):
+        img, hw0 = self.image(i)
+        return img, self.label(i)
+
+
+def _load(args):
+    path, imgsz, severities = args
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    hw0 = img.shape[:2]
+    if not severities:
+        return hw0, [resize_long_side(img, imgsz)]
+    return hw0, [resize_long_side(fogImage(img, beta, A), imgsz) for beta, A in severities]
+
+
+def shardWriters(dest, imgsz=640, shard_size=1024, severities=None):
+    """One ShardWriter per (beta, A) in severities, in dest/beta*_A*/, or a single one in dest."""
+    if severities and len(severities) > 1:
+        return [ShardWriter(os.path.join(dest, severityName(*sev)), imgsz, shard_size) for sev in severities]
+    return [ShardWriter(dest, imgsz, shard_size)]
+
+
+def buildShards(image_dir, label_dir, dest, imgsz=640, shard_size=1024, severities=None, workers=None):
+    """Pack an image/label folder into shards, optionally fogging each image with every (beta, A) in severities.
+
+    With several severities every image is decoded once and each level gets its own shard folder dest/beta*_A*/.
+    Images without a label file are skipped, as fog.processDataset does (which can also write the shards of the
+    images it fogs in the same pass, see its shards argument).
+    """
+    image_files = []
+    for f in sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTS)):
+        if os.path.exists(os.path.join(label_dir, os.path.splitext(f)[0] + '.txt')):
+            image_files.append(f)
+        else:
+            print(f"未找到标签文件：{os.path.join(label_dir, os.path.splitext(f)[0] + '.txt')}，跳过该图片。")
+    writers = shardWriters(dest, imgsz, shard_size, severities)
+    workers = workers or os.cpu_count() or 1
+    window = 16 * workers  # decoded images held in memory at once
+    with ProcessPoolExecutor(workers) as pool:
+        for start in range(0, len(image_files), window):
+            names = image_files[start:start + window]
+            jobs = [(os.path.join(image_dir, f), imgsz, severities) for f in names]
+            for name, result in zip(names, pool.map(_load, jobs, chunksize=4)):
+                if result is None:
+                    print(f"无法读取图片：{os.path.join(image_dir, name)}")
+                    continue
+                hw0, imgs = result
+                labels = read_label(os.path.join(label_dir, os.path.splitext(name)[0] + '.txt'))
+                for writer, img in zip(writers, imgs):
+                    writer.add(name, img, hw0, labels)
+    for writer in writers:
+        writer.close()
+    return len(writers[0].files)
+
+
+class ShardYOLODataset(YOLODataset):
+    """YOLODataset backed by a shard folder: page-cache reads instead of per-sample JPEG decode."""
+
+    def get_img_files(self, img_path):
+        self.shards = ShardReader(img_path)
+        return [os.path.join(img_path, f) for f in self.shards.files]
+
+    def get_labels(self):
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            lb = self.shards.label(i)
+            labels.append(dict(im_file=im_file, shape=tuple(int(x) for x in self.shards.index[i, 2:4]),
+                               cls=lb[:, 0:1].copy(), bboxes=lb[:, 1:].copy(), segments=[], keypoints=None,
+                               normalized=True, bbox_format='xywh'))
+        return labels
+
+    def load_image(self, i, rect_mode=True, **kwargs):
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+        im, (h0, w0) = self.shards.image(i)
+        if not rect_mode:
+            im = cv2.resize(np.ascontiguousarray(im), (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+        elif self.imgsz != self.shards.imgsz:
+            im = resize_long_side(np.ascontiguousarray(im), self.imgsz)
+        elif self.augment:
+            im = im.copy()  # augmentations such as RandomHSV write into the image in place
+        if self.augment:
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                if self.cache != 'ram':
+                    self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+        return im, (h0, w0), im.shape[:2]
+
+
+class ShardDetectionTrainer(TrainSettingsMixin, DetectionTrainer):
+    """DetectionTrainer reading train/val splits from shard folders written by buildShards.
+
+    Takes the checkpointing and CPU settings of TrainSettingsMixin with the training arguments.
+    """
+
+    def build_dataset(self, img_path, mode='train', batch=None):
+        gs = max(int(self.model.stride.max() if self.model else 0), 32)
+        return ShardYOLODataset(img_path=img_path, imgsz=self.args.imgsz, batch_size=batch,
+                                augment=mode == 'train', hyp=self.args, rect=self.args.rect or mode == 'val',
+                                cache=None, single_cls=self.args.single_cls or False, stride=gs,
+                                pad=0.0 if mode == 'train' else 0.5, prefix=colorstr(f'{mode}: '),
+                                task=self.args.task, classes=self.args.classes, data=self.data,
+                                fraction=self.args.fraction if mode == 'train' else 1.0)
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='将 YOLO 数据集 (可选雾化) 打包为内存映射分片')
+    parser.add_argument('--images', required=True, help='原始图片文件夹')
+    parser.add_argument('--labels', required=True, help='原始标签文件夹')
+    parser.add_argument('--dest', required=True, help='分片输出文件夹')
+    parser.add_argument('--imgsz', type=int, default=640, help='长边缩放到的尺寸')
+    parser.add_argument('--shard-size', type=int, default=1024, help='每个分片的图片数')
+    parser.add_argument('--severity', type=float, nargs=2, action='append', metavar=('BETA', 'A'),
+                        help='雾浓度等级, 可重复指定; 不指定时不雾化')
+    parser.add_argument('--workers', type=int, default=None, help='进程数, 默认为 CPU 核数')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    n = buildShards(opt.images, opt.labels, opt.dest, opt.imgsz, opt.shard_size, opt.severity, opt.workers)
+    print(f"共写入 {n} 张图片到 {opt.dest}")
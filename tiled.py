@@ -0,0 +1,184 @@
+import os
+import time
+import argparse
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+
+from fog import IMAGE_EXTS
+from utils import MODEL_CFG, build_model, load_model
+
+PAD_VALUE = 114  # letterbox grey, as in training
+
+
+def tile_starts(size, tile, overlap):
+    """Start offsets of tiles of length tile covering [0, size) with at least overlap pixels shared by neighbours.
+
+    The last tile is aligned to the far edge, so every tile lies fully inside the image when size >= tile.
+    overlap must be in [0, tile).
+    """
+    if not 0 <= overlap < tile:
+        raise ValueError(f'tile overlap must be in [0, {tile}) pixels, got {overlap}')
+    if size <= tile:
+        return [0]
+    step = tile - overlap
+    n = -(-(size - tile) // step) + 1  # ceil
+    return [round(i * (size - tile) / (n - 1)) for i in range(n)]
+
+
+def overlap_pixels(overlap, tile):
+    """Overlap in pixels: values in [0, 1) are a fraction of tile, values >= 1 a pixel count (1.0 is one pixel)."""
+    pixels = int(overlap * tile) if overlap < 1 else int(overlap)
+    if not 0 <= pixels < tile:
+        raise ValueError(f'tile overlap {overlap} is {pixels} pixels, it must be in [0, {tile})')
+    return pixels
+
+
+def tile_grid(h, w, tile=640, overlap=0.2):
+    """(x0, y0) offsets of the tiles of an h x w image; overlap as in overlap_pixels."""
+    overlap = overlap_pixels(overlap, tile)
+    return [(x, y) for y in tile_starts(h, tile, overlap) for x in tile_starts(w, tile, overlap)]
+
+
+def iter_tile_batches(img, tile=640, overlap=0.2, batch=8):
+    """Stream (offsets, uint8 (B, tile, tile, 3) array) batches of tiles of img.
+
+    Only one batch of tiles exists at a time, so memory is bounded by batch * tile * tile * 3 bytes on top of the
+    image itself whatever its resolution. Edge tiles of images smaller than tile are padded bottom / right.
+    """
+    h, w = img.shape[:2]
+    grid = tile_grid(h, w, tile, overlap)
+    buf = np.full((min(batch, len(grid)), tile, tile, 3), PAD_VALUE, np.uint8)
+    for start in range(0, len(grid), batch):
+        offsets = grid[start:start + batch]
+        for i, (x, y) in enumerate(offsets):
+            crop = img[y:y + tile, x:x + tile]
+            if crop.shape[:2] != (tile, tile):
+                buf[i] = PAD_VALUE
+            buf[i, :crop.shape[0], :crop.shape[1]] = crop
+        yield offsets, buf[:len(offsets)]
+
+
+def to_tensor(images):
+    """uint8 BGR (B, H, W, 3) -> float RGB (B, 3, H, W) in [0, 1]."""
+    return torch.from_numpy(np.ascontiguousarray(images[..., ::-1].transpose(0, 3, 1, 2))).float().div_(255)
+
+
+class TiledPredictor:
+    """Sliced inference of large images with an imgsz-trained detector.
+
+    The image is cut into tile x tile crops with the given overlap, the crops are run in batches of batch tiles, and
+    an optional full-image pass at imgsz adds the large objects that tiles cut apart. All boxes are shifted back to
+    image coordinates and merged with class-aware NMS.
+    """
+
+    def __init__(self, model, tile=640, overlap=0.2, batch=8, full=True, imgsz=640, conf=0.25, iou=0.45,
+                 max_det=1000):
+        self.model = model.eval()
+        self.tile, self.overlap, self.batch, self.full, self.imgsz = tile, overlap, batch, full, imgsz
+        self.conf, self.iou, self.max_det = conf, iou, max_det
+        self.stats = {'images': 0, 'tiles': 0, 'seconds': 0.0}
+
+    def forward(self, x):
+        from ultralytics.utils.nms import non_max_suppression
+
+        pred = self.model(x)
+        pred = pred[0] if isinstance(pred, (list, tuple)) else pred
+        return non_max_suppression(pred, self.conf, self.iou, max_det=self.max_det)
+
+    def full_pass(self, img):
+        from ultralytics.data.augment import LetterBox
+        from ultralytics.utils.ops import scale_boxes
+
+        x = to_tensor(LetterBox((self.imgsz, self.imgsz), auto=False)(image=img)[None])
+        det = self.forward(x)[0]
+        det[:, :4] = scale_boxes(x.shape[2:], det[:, :4], img.shape[:2])
+        return det
+
+    @torch.inference_mode()
+    def __call__(self, img):
+        """(N, 6) [x1, y1, x2, y2, conf, cls] detections of a BGR uint8 image in its own pixel coordinates."""
+        t = time.perf_counter()
+        dets, tiles = [], 0
+        for offsets, batch in iter_tile_batches(img, self.tile, self.overlap, self.batch):
+            for (x, y), det in zip(offsets, self.forward(to_tensor(batch))):
+                det[:, [0, 2]] += x
+                det[:, [1, 3]] += y
+                dets.append(det)
+            tiles += len(offsets)
+        if self.full and max(img.shape[:2]) > self.tile:
+            dets.append(self.full_pass(img))
+        det = torch.cat(dets) if dets else torch.zeros(0, 6)
+        h, w = img.shape[:2]
+        det[:, [0, 2]] = det[:, [0, 2]].clamp(0, w)
+        det[:, [1, 3]] = det[:, [1, 3]].clamp(0, h)
+        keep = torchvision.ops.batched_nms(det[:, :4], det[:, 4], det[:, 5].long(), self.iou)[:self.max_det]
+        self.stats['images'] += 1
+        self.stats['tiles'] += tiles
+        self.stats['seconds'] += time.perf_counter() - t
+        return det[keep]
+
+    def tiles_per_second(self):
+        return self.stats['tiles'] / self.stats['seconds'] if self.stats['seconds'] else 0.0
+
+
+def draw(img, det, names=None):
+    for *xyxy, conf, cls in det.tolist():
+        p1, p2 = (int(xyxy[0]), int(xyxy[1])), (int(xyxy[2]), int(xyxy[3]))
+        cv2.rectangle(img, p1, p2, (0, 0, 255), max(1, round(sum(img.shape[:2]) / 1000)))
+        label = f'{names[int(cls)] if names else int(cls)} {conf:.2f}'
+        cv2.putText(img, label, (p1[0], max(p1[1] - 4, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+    return img
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Sliced (tiled) inference of high-resolution images')
+    parser.add_argument('--source', required=True, help='image file or folder')
+    parser.add_argument('--weights', default=None, help='checkpoint, builds --cfg with random weights if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--tile', type=int, default=640, help='tile size, the training imgsz')
+    parser.add_argument('--overlap', type=float, default=0.2,
+                        help='tile overlap: below 1 a fraction of --tile, from 1 on pixels (less than --tile)')
+    parser.add_argument('--batch', type=int, default=8, help='tiles per forward')
+    parser.add_argument('--no-full', action='store_true', help='skip the full-image low-resolution pass')
+    parser.add_argument('--imgsz', type=int, default=640, help='input size of the full-image pass')
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--iou', type=float, default=0.45)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--save', default=None, help='folder to write images with the merged boxes drawn')
+    opt = parser.parse_args(argv)
+    try:
+        overlap_pixels(opt.overlap, opt.tile)
+    except ValueError as e:
+        parser.error(str(e))
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    from reparam import reparameterize
+
+    model = reparameterize(load_model(opt.weights) if opt.weights else build_model(opt.cfg, opt.scale))
+    predictor = TiledPredictor(model, opt.tile, opt.overlap, opt.batch, not opt.no_full, opt.imgsz, opt.conf, opt.iou)
+    if os.path.isdir(opt.source):
+        files = sorted(os.path.join(opt.source, f) for f in os.listdir(opt.source) if f.lower().endswith(IMAGE_EXTS))
+    else:
+        files = [opt.source]
+    if opt.save:
+        os.makedirs(opt.save, exist_ok=True)
+    for f in files:
+        img = cv2.imread(f)
+        if img is None:
+            print(f'cannot read {f}')
+            continue
+        det = predictor(img)
+        print(f'{f}: {img.shape[1]}x{img.shape[0]}, {len(det)} detections')
+        if opt.save:
+            cv2.imwrite(os.path.join(opt.save, os.path.basename(f)), draw(img, det, getattr(model, 'names', None)))
+    s = predictor.stats
+    print(f"{s['images']} images, {s['tiles']} tiles in {s['seconds']:.2f} s: {predictor.tiles_per_second():.2f} tiles/s")
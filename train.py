@@ -2,11 +2,16 @@
 import warnings
 warnings.filterwarnings('ignore')
 from ultralytics import YOLO
+from fog_augment import FogDetectionTrainer, RandomFog
 
 if __name__ == '__main__':
     model = YOLO(r'D:\fog_11\ultralytics_niou\ultralytics\cfg\models\11+2\yolo11_DSConv+ese+orepa.yaml')
     # model.load('yolo11n.pt') # loading pretrain weights
-    model.train(data=r'D:\fog_11\ultralytics_niou\ultralytics\cfg\datasets\my_detect_wu.yaml',
+    # tuned = autotune.apply('autotune.yaml') # CPU 训练: python autotune.py 按本机测出的 batch/workers/cache/线程/channels_last/bf16, 以 **tuned 覆盖下方对应参数
+    model.train(data=r'D:\fog_11\ultralytics_niou\ultralytics\cfg\datasets\my_detect_wu.yaml', # 离线雾化的数据集
+                trainer=FogDetectionTrainer,
+                fog=None, # 离线雾化数据集不再在线雾化; 在线雾化时 data 改为未雾化的 my_detect.yaml 并设 fog=RandomFog(p=0.5, beta=(0.01, 0.08), A=(0.3, 0.9))
+                # checkpoint=[13, 16, 19, 22], # 激活重计算的层, True 为全部 C3k2/C3k2_OREPA, 显存不足时用于增大 batch
                 cache=False,
                 imgsz=640,
                 epochs=600,
@@ -0,0 +1,90 @@
+import torch
+from ultralytics.cfg import DEFAULT_CFG
+
+from C3k2_OREPA import set_checkpoint
+
+
+def _enter_bf16(model, args):
+    if model.training and torch.is_grad_enabled():
+        autocast = torch.autocast('cpu', dtype=torch.bfloat16)
+        autocast.__enter__()
+        model._bf16_autocast.append(autocast)
+
+
+def _exit_bf16(model, args, output):
+    if model._bf16_autocast:
+        model._bf16_autocast.pop().__exit__(None, None, None)
+
+
+def bf16_autocast(model):
+    """Run every training forward of model, the loss included, under CPU bfloat16 autocast.
+
+    The autocast is entered by forward hooks inside the model call: Ultralytics wraps forward + loss in
+    autocast(amp, device='cpu'), which is disabled on CPU and switches off any autocast entered around it. Eval and
+    no-grad calls (validation, the EMA copy) stay fp32.
+    """
+    model._bf16_autocast = []
+    model.register_forward_pre_hook(_enter_bf16)
+    model.register_forward_hook(_exit_bf16, always_call=True)
+    return model
+
+
+def configure_model(model, checkpoint=None, channels_last=False, bf16=False):
+    """Set up a freshly built model for training, independent of the trainer.
+
+    checkpoint is True / False or the layer indices of the C3k2 / C3k2_OREPA blocks to recompute in backward
+    (see C3k2_OREPA.set_checkpoint), None takes the 'checkpoint' key of the model YAML. channels_last converts the
+    parameters, bf16 adds bf16_autocast.
+    """
+    set_checkpoint(model, checkpoint if checkpoint is not None else model.yaml.get('checkpoint', False))
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if bf16:
+        bf16_autocast(model)
+    return model
+
+
+class TrainSettingsMixin:
+    """Activation checkpointing and CPU training settings for any Ultralytics trainer, configured per instance.
+
+    Mix in before the trainer, class Trainer(TrainSettingsMixin, DetectionTrainer), and pass the settings with the
+    other training arguments, model.train(trainer=Trainer, checkpoint=[13, 16], threads=8, ...):
+      checkpoint       True / False or the C3k2 / C3k2_OREPA layers to recompute in backward, None for the YAML key
+      threads          torch intra-op threads
+      interop_threads  torch inter-op threads
+      cpu_workers      dataloader workers on CPU, where Ultralytics forces 0
+      bf16             bfloat16 autocast of the training forward + loss on CPU, which the amp option only provides
+                       on CUDA
+    They are taken out of the overrides before Ultralytics validates them, and are not saved with the run arguments.
+    The Ultralytics channels_last argument applies to the training model and batches as well. autotune.py picks the
+    CPU settings per machine.
+    """
+
+    SETTINGS = {'checkpoint': None, 'threads': None, 'interop_threads': None, 'cpu_workers': None, 'bf16': False}
+
+    def __init__(self, cfg=DEFAULT_CFG, overrides=None, _callbacks=None):
+        overrides = dict(overrides or {})
+        for k, v in self.SETTINGS.items():
+            setattr(self, k, overrides.pop(k, v))
+        super().__init__(cfg, overrides, _callbacks)
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        if self.interop_threads:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError:  # can only be set before the first inter-op parallel work of the process
+                pass
+        if self.device.type == 'cpu' and self.cpu_workers is not None:
+            self.args.workers = self.cpu_workers
+
+    def get_model(self, cfg=None, weights=None, verbose=True):
+        """Build the model and apply the checkpointing, memory format and precision settings to it."""
+        model = super().get_model(cfg, weights, verbose)
+        return configure_model(model, self.checkpoint, bool(self.args.channels_last),
+                               self.bf16 and self.device.type == 'cpu')
+
+    def preprocess_batch(self, batch):
+        batch = super().preprocess_batch(batch)
+        if self.args.channels_last:
+            batch['img'] = batch['img'].contiguous(memory_format=torch.channels_last)
+        return batch
@@ -0,0 +1,86 @@
+import os
+import time
+import itertools
+import zipfile
+
+import torch
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL_CFG = os.path.join(ROOT, 'yolo11_DSConv+ese+orepa.yaml')
+
+
+def build_model(cfg=MODEL_CFG, scale='n', nc=None, verbose=False):
+    """Build a DetectionModel from a model YAML at the given scale (n/s/m/l/x)."""
+    from ultralytics.nn.tasks import DetectionModel, yaml_model_load
+
+    d = yaml_model_load(cfg) if isinstance(cfg, (str, os.PathLike)) else dict(cfg)
+    if scale:
+        d['scale'] = scale
+    return DetectionModel(d, nc=nc, verbose=verbose)
+
+
+def load_model(weights):
+    """Load the float model of an Ultralytics checkpoint (EMA weights when present) or of a fused deploy file.
+
+    Fused checkpoints written by reparam.save_fused are loaded memory-mapped into a model built in deploy form.
+    """
+    ckpt = torch.load(weights, map_location='cpu', weights_only=False, mmap=zipfile.is_zipfile(weights))
+    from reparam import from_fused, is_fused
+
+    if is_fused(ckpt):
+        return from_fused(ckpt)
+    model = ckpt.get('ema') or ckpt['model'] if isinstance(ckpt, dict) else ckpt
+    return model.float().eval()
+
+
+def timeit(fn, repeat=10, warmup=2):
+    """Run fn warmup + repeat times and return the per-call times in seconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def peak_memory(fn):
+    """Peak bytes of CPU tensor memory allocated while fn runs, relative to the start.
+
+    Replays the allocations and frees recorded by the torch profiler in time order, so it is exact at op granularity
+    and independent of allocator caching and of the rest of the process.
+    """
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted((e for e in prof.events() if e.self_cpu_memory_usage), key=lambda e: e.time_range.start)
+    return max(itertools.accumulate((e.self_cpu_memory_usage for e in events), initial=0))
+
+
+def allocation_stats(fn):
+    """Number and total bytes of the CPU tensor allocations made while fn runs."""
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0]
+    return len(sizes), sum(sizes)
+
+
+def count_params(model):
+    """Number of parameters and bytes of parameters + buffers."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(p.numel() for p in model.parameters()), sum(t.numel() * t.element_size() for t in tensors)
+
+
+def flatten_outputs(out):
+    """All tensors of a nested model output, in order."""
+    if isinstance(out, torch.Tensor):
+        return [out]
+    if isinstance(out, dict):
+        out = list(out.values())
+    if isinstance(out, (list, tuple)):
+        return [t for o in out for t in flatten_outputs(o)]
+    return []
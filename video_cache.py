@@ -0,0 +1,196 @@
+import time
+import argparse
+from contextlib import closing
+
+import cv2
+import numpy as np
+import torch
+
+from fog_video import prefetch, readFrames
+from utils import MODEL_CFG, build_model, load_model
+
+
+def backbone_end(model):
+    """Index of the last backbone layer (10 for yolo11_DSConv+ese+orepa.yaml)."""
+    return len(model.yaml['backbone']) - 1
+
+
+def backbone_taps(model):
+    """Backbone layers whose outputs the head reads, shallowest first (4, 6 and 10: P3, P4 and P5)."""
+    end = backbone_end(model)
+    taps = {end}
+    for m in model.model[end + 1:]:
+        taps.update(j for j in ([m.f] if isinstance(m.f, int) else m.f) if 0 <= j <= end)
+    return sorted(taps)
+
+
+def run_layers(model, x, y, start, stop):
+    """Run layers start..stop - 1 of model.model like DetectionModel._predict_once, y holds the saved outputs."""
+    for m in model.model[start:stop]:
+        if m.f != -1:
+            x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]
+        x = m(x)
+        y[m.i] = x if m.i in model.save or m.i == stop - 1 else None
+    return x
+
+
+class FrameGate:
+    """Cheap keyframe gate: mean absolute difference of small grayscale thumbnails against the last keyframe.
+
+    A frame becomes a keyframe when it differs from the last keyframe by more than threshold grey levels (0-255) or
+    when max_stale frames have reused the cached features since.
+    """
+
+    def __init__(self, threshold=4.0, max_stale=10, size=64):
+        self.threshold, self.max_stale, self.size = threshold, max_stale, size
+        self.reference, self.stale = None, 0
+
+    def thumbnail(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        return cv2.resize(gray, (self.size, self.size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def __call__(self, frame):
+        thumb = self.thumbnail(frame)
+        if self.reference is None or self.stale >= self.max_stale or \
+                np.abs(thumb - self.reference).mean() > self.threshold:
+            self.reference, self.stale = thumb, 0
+            return True
+        self.stale += 1
+        return False
+
+
+class CachedVideoDetector:
+    """Video inference that runs the deep backbone stages on keyframes only.
+
+    The shallow stage up to the first feature the head reads (layers 0-4, P3) runs on every frame. The deeper
+    stages (layers 5-10, P4 / P5) run on keyframes only, and their outputs are cached. The head runs on every frame
+    with the current P3 and the cached P4 / P5, so detections follow the new frame at P3 resolution. The staleness
+    bound of the gate limits how old the reused deep features can be.
+    """
+
+    def __init__(self, model, imgsz=640, threshold=4.0, max_stale=10, conf=0.25, iou=0.45):
+        self.model = model.eval()
+        self.imgsz, self.conf, self.iou = imgsz, conf, iou
+        self.gate = FrameGate(threshold, max_stale)
+        taps = backbone_taps(model)
+        self.shallow, self.split = taps[0] + 1, taps[-1] + 1  # layers [0, shallow) every frame, [shallow, split) cached
+        self.cache = None
+        self.stats = {'frames': 0, 'keyframes': 0, 'seconds': 0.0}
+
+    def preprocess(self, frame):
+        from ultralytics.data.augment import LetterBox
+
+        img = LetterBox((self.imgsz, self.imgsz), auto=False)(image=frame)
+        return torch.from_numpy(np.ascontiguousarray(img[..., ::-1].transpose(2, 0, 1))).float().div_(255)[None]
+
+    def postprocess(self, pred, x, frame):
+        from ultralytics.utils.nms import non_max_suppression
+        from ultralytics.utils.ops import scale_boxes
+
+        pred = pred[0] if isinstance(pred, (list, tuple)) else pred
+        det = non_max_suppression(pred, self.conf, self.iou)[0]
+        det[:, :4] = scale_boxes(x.shape[2:], det[:, :4], frame.shape[:2])
+        return det
+
+    @torch.inference_mode()
+    def full(self, frame):
+        """Detections of the whole model on frame, without touching the cache (the every-frame reference)."""
+        x = self.preprocess(frame)
+        return self.postprocess(self.model(x), x, frame)
+
+    @torch.inference_mode()
+    def __call__(self, frame):
+        """(N, 6) [x1, y1, x2, y2, conf, cls] detections of one BGR frame, and whether it was a keyframe."""
+        t = time.perf_counter()
+        keyframe = self.gate(frame) or self.cache is None
+        x = self.preprocess(frame)
+        y = [None] * len(self.model.model)
+        p3 = run_layers(self.model, x, y, 0, self.shallow)
+        if keyframe:
+            run_layers(self.model, p3, y, self.shallow, self.split)
+            self.cache = {i: y[i] for i in range(self.shallow, self.split) if y[i] is not None}
+            self.stats['keyframes'] += 1
+        else:
+            for i, feature in self.cache.items():
+                y[i] = feature
+        pred = run_layers(self.model, y[self.split - 1], y, self.split, len(self.model.model))
+        det = self.postprocess(pred, x, frame)
+        self.stats['frames'] += 1
+        self.stats['seconds'] += time.perf_counter() - t
+        return det, keyframe
+
+    def fps(self):
+        return self.stats['frames'] / self.stats['seconds'] if self.stats['seconds'] else 0.0
+
+
+def match_f1(det, ref, iou=0.5):
+    """F1 of det against the reference detections ref: same class and IoU >= iou, greedy by confidence."""
+    if len(det) == 0 and len(ref) == 0:
+        return 1.0
+    if len(det) == 0 or len(ref) == 0:
+        return 0.0
+    from torchvision.ops import box_iou
+
+    ious = box_iou(det[:, :4], ref[:, :4])
+    ious[det[:, 5, None] != ref[None, :, 5]] = 0
+    matched, used = 0, set()
+    for i in det[:, 4].argsort(descending=True).tolist():
+        j = int(ious[i].argmax())
+        if ious[i, j] >= iou and j not in used:
+            used.add(j)
+            matched += 1
+    return 2 * matched / (len(det) + len(ref))
+
+
+def run_video(detector, source, compare=False, limit=None, verbose=True):
+    """Run detector over every frame of source; with compare also run the full model per frame and score the delta."""
+    f1, full_seconds = [], 0.0
+    with closing(prefetch(readFrames(source))) as frames:  # stopping early releases the reader thread and capture
+        for n, frame in enumerate(frames):
+            if limit and n >= limit:
+                break
+            det, keyframe = detector(frame)
+            if compare:
+                t = time.perf_counter()
+                ref = detector.full(frame)
+                full_seconds += time.perf_counter() - t
+                f1.append(match_f1(det, ref))
+    s = detector.stats
+    report = {'frames': s['frames'], 'keyframes': s['keyframes'], 'fps': detector.fps()}
+    if compare and s['frames']:
+        report.update(full_fps=s['frames'] / full_seconds, speedup=report['fps'] * full_seconds / s['frames'],
+                      f1_vs_full=float(np.mean(f1)), min_f1_vs_full=float(np.min(f1)))
+    if verbose:
+        print(f"{report['frames']} frames, {report['keyframes']} keyframes: {report['fps']:.2f} effective fps")
+        if 'full_fps' in report:
+            print(f"every-frame model {report['full_fps']:.2f} fps, x{report['speedup']:.2f}; detections vs every "
+                  f"frame: mean F1 {report['f1_vs_full']:.3f}, worst frame {report['min_f1_vs_full']:.3f}")
+    return report
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Video inference reusing cached backbone features between keyframes')
+    parser.add_argument('--source', required=True, help='video path or camera index')
+    parser.add_argument('--weights', default=None, help='checkpoint, builds --cfg with random weights if omitted')
+    parser.add_argument('--cfg', default=MODEL_CFG, help='model YAML used without --weights')
+    parser.add_argument('--scale', default='n', help='model scale used without --weights')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--threshold', type=float, default=4.0, help='keyframe gate: mean abs grey-level difference')
+    parser.add_argument('--max-stale', type=int, default=10, help='frames that may reuse one keyframe, 0 disables')
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--iou', type=float, default=0.45)
+    parser.add_argument('--compare', action='store_true', help='also run every frame fully and report the delta')
+    parser.add_argument('--frames', type=int, default=None, help='stop after this many frames')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    opt = parseArgs()
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    from reparam import reparameterize
+
+    model = reparameterize(load_model(opt.weights) if opt.weights else build_model(opt.cfg, opt.scale))
+    detector = CachedVideoDetector(model, opt.imgsz, opt.threshold, opt.max_stale, opt.conf, opt.iou)
+    run_video(detector, int(opt.source) if opt.source.isdigit() else opt.source, opt.compare, opt.frames)